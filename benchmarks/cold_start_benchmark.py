@@ -0,0 +1,216 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Offline cold and warm start benchmark of the Producer and Consumer Lambdas.
+
+Every cold start runs in a new Python process, like a new Lambda container: the INIT phase
+imports boto3 and the handler module, then the handler is invoked once. Warm starts are the
+next invocations in the same process. The Producer Lambda handles CreateManagedAccount events
+and the Consumer Lambda batches of 10 messages, each for another account.
+
+With boto3 installed, the real boto3 and botocore clients are created and their calls are
+answered by the fakes of benchmarks/fakes.py (install_botocore_hooks); without it, the fake
+boto3 module is used and creating clients costs nothing.
+
+Lambda allocates CPU in proportion to memory, one vCPU at 1769 MB. The CPU time measured here
+is also reported scaled to --memory-mb (default: 128, the MemorySize of both functions in
+template.yaml) as an estimate of the Lambda duration, and peak resident memory is compared
+with the same size. Warm invocations are --interval-ms apart, so that the wall time does not
+include the pacing of RATE_CONTROLLER, which allows 5 CloudFormation calls per second.
+
+Example:
+    python benchmarks/cold_start_benchmark.py --runs 5 --warm-invocations 20
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+# Memory at which Lambda allocates one full vCPU
+FULL_VCPU_MEMORY_MB = 1769
+HANDLER_MODULES = {
+    'producer': 'ct_configrecorder_override_producer',
+    'consumer': 'ct_configrecorder_override_consumer',
+}
+CONSUMER_BATCH_SIZE = 10
+
+
+def consumer_event(messages, queue_url):
+    """
+    Return an SQS event with one version 2 message per account.
+    """
+    from fleet_simulator import queue_arn
+    records = []
+    for index, message in enumerate(messages):
+        records.append({
+            'messageId': f'cold-start-{index}',
+            'body': json.dumps(message),
+            'attributes': {'SentTimestamp': str(int(time.time() * 1000)), 'ApproximateReceiveCount': '1'},
+            'messageAttributes': {},
+            'eventSourceARN': queue_arn(queue_url),
+        })
+    return {'Records': records}
+
+
+def run_child(function, accounts, regions, warm_invocations, interval):
+    """
+    Measure one cold start and the warm starts after it in this process, and return the measurements.
+    """
+    real_boto3 = importlib.util.find_spec('boto3') is not None
+    # Lambda provides the credentials of the execution role in the environment
+    os.environ.update(AWS_ACCESS_KEY_ID='offline', AWS_SECRET_ACCESS_KEY='offline', AWS_SESSION_TOKEN='offline',
+                      AWS_EC2_METADATA_DISABLED='true')
+
+    import fakes
+    import fleet_simulator
+    os.environ.update(fleet_simulator.LAMBDA_ENVIRONMENT, AWS_DEFAULT_REGION=fleet_simulator.HOME_REGION,
+                      STATE_STORE_PATH='')
+    aws = fakes.FakeAWS(accounts=accounts, regions=regions)
+    # EMF documents and span records are written to stdout as in Lambda, and discarded
+    result_stream, sys.stdout = sys.stdout, open(os.devnull, 'w')
+
+    init_start = time.perf_counter()
+    init_cpu = time.process_time()
+    if real_boto3:
+        fakes.install_botocore_hooks(aws)
+    else:
+        fakes.install(aws)
+    handler = importlib.import_module(HANDLER_MODULES[function])
+    init_seconds = time.perf_counter() - init_start
+
+    if function == 'producer':
+        events = [fleet_simulator.create_managed_account_event(account) for account in aws.account_ids]
+    else:
+        from ct_configrecorder_messages import build_message
+        messages = [build_message(account, 'controltower', aws.regions) for account in aws.account_ids]
+        events = [consumer_event(messages[index:index + CONSUMER_BATCH_SIZE], fleet_simulator.QUEUE_URL)
+                  for index in range(0, len(messages), CONSUMER_BATCH_SIZE)]
+
+    durations = []
+    cpu_times = []
+    for invocation in range(warm_invocations + 1):
+        if invocation:
+            time.sleep(interval)
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        handler.lambda_handler(events[invocation % len(events)], fakes.FakeContext(function_name=function))
+        durations.append(time.perf_counter() - start)
+        cpu_times.append(time.process_time() - start_cpu)
+        if invocation == 0:
+            cold_cpu_seconds = time.process_time() - init_cpu
+
+    sys.stdout = result_stream
+    return {
+        'function': function,
+        'boto3': 'installed' if real_boto3 else 'fake',
+        'init_ms': init_seconds * 1000,
+        'first_invocation_ms': durations[0] * 1000,
+        'cold_start_ms': (init_seconds + durations[0]) * 1000,
+        'cold_start_cpu_ms': cold_cpu_seconds * 1000,
+        'warm_ms': [duration * 1000 for duration in durations[1:]],
+        'warm_cpu_ms': [cpu_time * 1000 for cpu_time in cpu_times[1:]],
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_function(function, runs, accounts, regions, warm_invocations, interval, memory_mb):
+    """
+    Run `runs` cold starts of a function in new processes and return the report.
+    """
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', function, '--accounts', str(accounts),
+             '--regions', str(regions), '--warm-invocations', str(warm_invocations),
+             '--interval-ms', str(interval * 1000)],
+            check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    warm = [duration for result in results for duration in result['warm_ms']]
+    warm_cpu = [cpu_time for result in results for cpu_time in result['warm_cpu_ms']]
+    scale = FULL_VCPU_MEMORY_MB / memory_mb
+    cold_cpu_ms = statistics.median(result['cold_start_cpu_ms'] for result in results)
+    return {
+        'function': function,
+        'boto3': results[0]['boto3'],
+        'runs': runs,
+        'init_ms': round(statistics.median(result['init_ms'] for result in results), 1),
+        'first_invocation_ms': round(statistics.median(result['first_invocation_ms'] for result in results), 1),
+        'cold_start_ms': round(statistics.median(result['cold_start_ms'] for result in results), 1),
+        'cold_start_cpu_ms': round(cold_cpu_ms, 1),
+        'warm_p50_ms': round(statistics.median(warm), 2) if warm else 0.0,
+        'warm_max_ms': round(max(warm), 2) if warm else 0.0,
+        'warm_cpu_p50_ms': round(statistics.median(warm_cpu), 2) if warm_cpu else 0.0,
+        'memory_mb': memory_mb,
+        'estimated_cold_start_ms': round(cold_cpu_ms * scale, 0),
+        'estimated_warm_p50_ms': round(statistics.median(warm_cpu) * scale, 1) if warm_cpu else 0.0,
+        'peak_rss_mib': round(max(result['peak_rss_mib'] for result in results), 1),
+    }
+
+
+def format_report(report):
+    return '\n'.join([
+        f'{report["function"]} (boto3 {report["boto3"]}, {report["runs"]} cold starts)',
+        f'  cold start       {report["cold_start_ms"]:.1f} ms: init {report["init_ms"]:.1f} ms, '
+        f'first invocation {report["first_invocation_ms"]:.1f} ms ({report["cold_start_cpu_ms"]:.1f} ms CPU)',
+        f'  warm start       p50 {report["warm_p50_ms"]:.2f} ms, max {report["warm_max_ms"]:.2f} ms '
+        f'(p50 {report["warm_cpu_p50_ms"]:.2f} ms CPU)',
+        f'  at {report["memory_mb"]} MB       ~{report["estimated_cold_start_ms"]:.0f} ms cold, '
+        f'~{report["estimated_warm_p50_ms"]:.1f} ms warm (estimated from CPU time)',
+        f'  peak memory      {report["peak_rss_mib"]:.1f} MiB of {report["memory_mb"]} MB',
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--functions', nargs='+', default=['producer', 'consumer'], choices=sorted(HANDLER_MODULES))
+    parser.add_argument('--runs', type=int, default=5, help='Cold starts per function (default: 5)')
+    parser.add_argument('--warm-invocations', type=int, default=20, help='Warm starts after each cold start (default: 20)')
+    parser.add_argument('--interval-ms', type=float, default=250, help='Time between warm starts (default: 250)')
+    parser.add_argument('--accounts', type=int, default=50, help='Accounts of the fake landing zone (default: 50)')
+    parser.add_argument('--regions', type=int, default=17, help='Governed regions per account (default: 17)')
+    parser.add_argument('--memory-mb', type=int, default=128, help='Lambda memory size to estimate for (default: 128)')
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON lines')
+    parser.add_argument('--child', choices=sorted(HANDLER_MODULES), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.accounts, args.regions, args.warm_invocations, args.interval_ms / 1000)))
+        return
+
+    for function in args.functions:
+        report = run_function(function, args.runs, args.accounts, args.regions, args.warm_invocations,
+                              args.interval_ms / 1000, args.memory_mb)
+        print(json.dumps(report) if args.json else format_report(report), flush=True)
+
+
+if __name__ == '__main__':
+    main()
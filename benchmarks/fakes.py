@@ -0,0 +1,446 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+In-process fakes of the AWS APIs used by the Producer and Consumer Lambdas.
+
+install() puts a fake boto3 module in sys.modules, so the Lambda modules imported
+afterwards talk to a FakeAWS instance instead of AWS. botocore and urllib3 are used
+when they are installed; otherwise minimal stand-ins providing the names the Lambda
+modules import are installed, so everything runs offline.
+
+When boto3 is installed, install_botocore_hooks() keeps the real boto3 and botocore
+clients, so their creation and request serialization cost is measured, and answers
+their calls from a FakeAWS instead of sending them.
+"""
+
+import copy
+import io
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+
+MANAGEMENT_ACCOUNT = '000000000000'
+STACK_INSTANCES_PAGE_SIZE = 100
+# LastOperationId of every stack instance of the baseline Config StackSet
+BASELINE_OPERATION_ID = '11111111-2222-3333-4444-555555555555'
+
+# Organization of the fake landing zone: the managed accounts are spread over Sandbox, Prod and Dev
+ORGANIZATION_ROOT = 'r-fake'
+ORGANIZATIONAL_UNITS = {
+    'ou-fake-sandbox0': (ORGANIZATION_ROOT, 'Sandbox'),
+    'ou-fake-workload': (ORGANIZATION_ROOT, 'Workloads'),
+    'ou-fake-prod0000': ('ou-fake-workload', 'Prod'),
+    'ou-fake-dev00000': ('ou-fake-workload', 'Dev'),
+}
+ACCOUNT_ORGANIZATIONAL_UNITS = ['ou-fake-sandbox0', 'ou-fake-prod0000', 'ou-fake-dev00000']
+ORGANIZATIONS_PAGE_SIZE = 20
+
+REGIONS = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1',
+    'ap-south-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3',
+    'ap-southeast-1', 'ap-southeast-2', 'sa-east-1',
+]
+
+
+def _install_botocore():
+    try:
+        import botocore.config  # noqa: F401
+        import botocore.exceptions  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    class BotoCoreError(Exception):
+        pass
+
+    class ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            self.response = error_response
+            self.operation_name = operation_name
+            error = error_response.get('Error', {})
+            super().__init__(f'An error occurred ({error.get("Code")}) when calling the {operation_name} '
+                             f'operation: {error.get("Message", "")}')
+
+    class Config:
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+
+    botocore = types.ModuleType('botocore')
+    botocore.__version__ = 'offline'
+    exceptions = types.ModuleType('botocore.exceptions')
+    exceptions.BotoCoreError = BotoCoreError
+    exceptions.ClientError = ClientError
+    exceptions.ConnectionError = type('ConnectionError', (BotoCoreError,), {})
+    exceptions.ReadTimeoutError = type('ReadTimeoutError', (BotoCoreError,), {})
+    config = types.ModuleType('botocore.config')
+    config.Config = Config
+    botocore.exceptions = exceptions
+    botocore.config = config
+    sys.modules.update({'botocore': botocore, 'botocore.exceptions': exceptions, 'botocore.config': config})
+
+
+def _install_urllib3():
+    try:
+        import urllib3  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    class PoolManager:
+        def request(self, *args, **kwargs):
+            return types.SimpleNamespace(status=200, data=b'')
+
+    urllib3 = types.ModuleType('urllib3')
+    urllib3.PoolManager = PoolManager
+    sys.modules['urllib3'] = urllib3
+
+
+def client_error(code, operation, message=''):
+    import botocore.exceptions
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeAWS:
+    """
+    State and behaviour of the fake AWS account: the baseline Config StackSet, the
+    organization, the SQS queues, STS, S3 objects and the configuration recorder of
+    every account/region.
+
+    Args:
+        accounts (int): Number of managed accounts in the StackSet
+        regions (int): Number of governed regions per account
+        latency (dict): Seconds of latency added to every call, per service
+        throttle_rate (dict): Probability of a ThrottlingException, per service
+        failure_rate (dict): Probability of failing with `failure_code`, per service
+        failure_code (str): Error code of injected failures
+        seed (int): Seed for the injected latency jitter, throttles and failures
+    """
+
+    def __init__(self, accounts=50, regions=17, latency=None, throttle_rate=None, failure_rate=None,
+                 failure_code='InternalFailure', seed=0):
+        self.account_ids = [f'{100000000000 + index:012d}' for index in range(accounts)]
+        self.regions = list(itertools.islice(itertools.cycle(REGIONS), regions))
+        self.stack_instances = [{'Account': account, 'Region': region, 'Status': 'CURRENT', 'LastOperationId': BASELINE_OPERATION_ID}
+                                for account in self.account_ids for region in self.regions]
+        self.latency = latency or {}
+        self.throttle_rate = throttle_rate or {}
+        self.failure_rate = failure_rate or {}
+        self.failure_code = failure_code
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.queues = {}
+        self.recorders = {}
+        self.invocations = deque()
+        self.account_parents = {account: ACCOUNT_ORGANIZATIONAL_UNITS[index % len(ACCOUNT_ORGANIZATIONAL_UNITS)]
+                                for index, account in enumerate(self.account_ids)}
+        self.account_parents[MANAGEMENT_ACCOUNT] = ORGANIZATION_ROOT
+        self.objects = {}  # (bucket, key) -> bytes
+        # Seconds a received message stays invisible unless it is deleted
+        self.visibility_timeout = 1.0
+        # (queue URL, message ID, seconds from SentTimestamp to deletion) of every processed message
+        self.applied = []
+        # Held by every reader and writer of the queues, including the simulated event source mappings
+        self.queue_lock = threading.Lock()
+        self._message_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def queue(self, url):
+        with self._lock:
+            return self.queues.setdefault(url, deque())
+
+    def api_call(self, service, operation):
+        """
+        Count the call, wait for the configured latency and inject throttles and failures.
+        """
+        with self._lock:
+            self.calls[(service, operation)] += 1
+            roll = self.random.random()
+        delay = self.latency.get(service, 0)
+        if delay:
+            time.sleep(delay)
+        throttle_rate = self.throttle_rate.get(service, 0)
+        if roll < throttle_rate:
+            raise client_error('ThrottlingException', operation, 'Rate exceeded')
+        if roll < throttle_rate + self.failure_rate.get(service, 0):
+            raise client_error(self.failure_code, operation, 'Injected failure')
+
+    def record_applied(self, queue_url, message):
+        sent = int(message['attributes']['SentTimestamp']) / 1000
+        self.applied.append((queue_url, message['messageId'], time.time() - sent))
+
+    def calls_per_service(self):
+        per_service = Counter()
+        for (service, _), count in self.calls.items():
+            per_service[service] += count
+        return per_service
+
+
+class FakeClient:
+    """
+    boto3 client stand-in; only the operations used by the Lambdas are implemented.
+    """
+
+    def __init__(self, aws, service, region, account):
+        self.aws = aws
+        self.service = service
+        self.region = region
+        self.account = account
+
+    # CloudFormation
+    def list_stack_instances(self, StackSetName, NextToken=None, StackInstanceAccount=None, **kwargs):
+        self.aws.api_call('cloudformation', 'ListStackInstances')
+        instances = self.aws.stack_instances
+        if StackInstanceAccount:
+            instances = [item for item in instances if item['Account'] == StackInstanceAccount]
+        start = int(NextToken or 0)
+        page = {'Summaries': instances[start:start + STACK_INSTANCES_PAGE_SIZE]}
+        if start + STACK_INSTANCES_PAGE_SIZE < len(instances):
+            page['NextToken'] = str(start + STACK_INSTANCES_PAGE_SIZE)
+        return page
+
+    # SQS
+    def _enqueue(self, queue, body, attributes=None, delay=0):
+        message_id = f'msg-{next(self.aws._message_ids)}'
+        with self.aws.queue_lock:
+            queue.append({
+                'messageId': message_id,
+                'body': body,
+                'attributes': {'SentTimestamp': str(int(time.time() * 1000)), 'ApproximateReceiveCount': '0'},
+                'messageAttributes': copy.deepcopy(attributes or {}),
+                'visibleAt': time.time() + delay,
+            })
+        return message_id
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, DelaySeconds=0, **kwargs):
+        self.aws.api_call('sqs', 'SendMessage')
+        return {'MessageId': self._enqueue(self.aws.queue(QueueUrl), MessageBody, MessageAttributes, DelaySeconds)}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.aws.api_call('sqs', 'SendMessageBatch')
+        queue = self.aws.queue(QueueUrl)
+        successful = []
+        for entry in Entries:
+            message_id = self._enqueue(queue, entry['MessageBody'], entry.get('MessageAttributes'),
+                                       entry.get('DelaySeconds', 0))
+            successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        self.aws.api_call('sqs', 'ReceiveMessage')
+        queue = self.aws.queue(QueueUrl)
+        messages = []
+        with self.aws.queue_lock:
+            now = time.time()
+            for message in queue:
+                if len(messages) == MaxNumberOfMessages:
+                    break
+                if message['visibleAt'] > now:
+                    continue
+                # Received messages stay in the queue, invisible, until deleted
+                message['visibleAt'] = now + self.aws.visibility_timeout
+                receive_count = int(message['attributes']['ApproximateReceiveCount']) + 1
+                message['attributes']['ApproximateReceiveCount'] = str(receive_count)
+                messages.append({'MessageId': message['messageId'], 'ReceiptHandle': message['messageId'],
+                                 'Body': message['body'], 'Attributes': dict(message['attributes']),
+                                 'MessageAttributes': message['messageAttributes']})
+        return {'Messages': messages} if messages else {}
+
+    def _delete(self, queue_url, receipt_handles):
+        queue = self.aws.queue(queue_url)
+        with self.aws.queue_lock:
+            for message in [message for message in queue if message['messageId'] in receipt_handles]:
+                queue.remove(message)
+                self.aws.record_applied(queue_url, message)
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        self.aws.api_call('sqs', 'DeleteMessage')
+        self._delete(QueueUrl, {ReceiptHandle})
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self.aws.api_call('sqs', 'DeleteMessageBatch')
+        self._delete(QueueUrl, {entry['ReceiptHandle'] for entry in Entries})
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None, **kwargs):
+        self.aws.api_call('sqs', 'GetQueueAttributes')
+        return {'Attributes': {'ApproximateNumberOfMessages': str(len(self.aws.queue(QueueUrl)))}}
+
+    # AWS Organizations
+    def list_roots(self, **kwargs):
+        self.aws.api_call('organizations', 'ListRoots')
+        return {'Roots': [{'Id': ORGANIZATION_ROOT, 'Name': 'Root'}]}
+
+    def list_organizational_units_for_parent(self, ParentId, **kwargs):
+        self.aws.api_call('organizations', 'ListOrganizationalUnitsForParent')
+        return {'OrganizationalUnits': [{'Id': unit_id, 'Name': name}
+                                        for unit_id, (parent_id, name) in ORGANIZATIONAL_UNITS.items() if parent_id == ParentId]}
+
+    def list_accounts_for_parent(self, ParentId, NextToken=None, **kwargs):
+        self.aws.api_call('organizations', 'ListAccountsForParent')
+        accounts = [account for account, parent_id in self.aws.account_parents.items() if parent_id == ParentId]
+        start = int(NextToken or 0)
+        page = {'Accounts': [{'Id': account} for account in accounts[start:start + ORGANIZATIONS_PAGE_SIZE]]}
+        if start + ORGANIZATIONS_PAGE_SIZE < len(accounts):
+            page['NextToken'] = str(start + ORGANIZATIONS_PAGE_SIZE)
+        return page
+
+    def list_parents(self, ChildId, **kwargs):
+        self.aws.api_call('organizations', 'ListParents')
+        parent_id = self.aws.account_parents.get(ChildId) or ORGANIZATIONAL_UNITS.get(ChildId, (None,))[0]
+        if parent_id is None:
+            return {'Parents': []}
+        return {'Parents': [{'Id': parent_id, 'Type': 'ROOT' if parent_id == ORGANIZATION_ROOT else 'ORGANIZATIONAL_UNIT'}]}
+
+    # S3
+    def get_object(self, Bucket, Key, **kwargs):
+        self.aws.api_call('s3', 'GetObject')
+        if (Bucket, Key) not in self.aws.objects:
+            raise client_error('NoSuchKey', 'GetObject', 'The specified key does not exist.')
+        return {'Body': io.BytesIO(self.aws.objects[(Bucket, Key)])}
+
+    # STS
+    def get_caller_identity(self, **kwargs):
+        self.aws.api_call('sts', 'GetCallerIdentity')
+        return {'Account': self.account, 'Arn': f'arn:aws:sts::{self.account}:assumed-role/ConsumerLambda/session'}
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self.aws.api_call('sts', 'AssumeRole')
+        account = RoleArn.split(':')[4]
+        return {'Credentials': {
+            'AccessKeyId': f'ASIA{account}',
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token',
+            'Expiration': datetime.now(timezone.utc) + timedelta(hours=1),
+        }}
+
+    # AWS Config
+    def describe_configuration_recorders(self, **kwargs):
+        self.aws.api_call('config', 'DescribeConfigurationRecorders')
+        recorder = self.aws.recorders.get((self.account, self.region))
+        if recorder is None:
+            recorder = {
+                'name': 'aws-controltower-BaselineConfigRecorder',
+                'roleARN': f'arn:aws:iam::{self.account}:role/aws-controltower-ConfigRecorderRole',
+                'recordingGroup': {'allSupported': True, 'includeGlobalResourceTypes': False},
+            }
+        return {'ConfigurationRecorders': [copy.deepcopy(recorder)]}
+
+    def put_configuration_recorder(self, ConfigurationRecorder, **kwargs):
+        self.aws.api_call('config', 'PutConfigurationRecorder')
+        self.aws.recorders[(self.account, self.region)] = copy.deepcopy(ConfigurationRecorder)
+        return {}
+
+    # Lambda
+    def invoke(self, FunctionName, Payload, InvocationType='RequestResponse', **kwargs):
+        self.aws.api_call('lambda', 'Invoke')
+        self.aws.invocations.append(json.loads(Payload))
+        return {'StatusCode': 202}
+
+
+class FakeSession:
+    def __init__(self, aws, aws_access_key_id=None, **kwargs):
+        self.aws = aws
+        # Assumed-role access keys of FakeClient.assume_role carry the account ID
+        self.account = aws_access_key_id[4:] if aws_access_key_id else MANAGEMENT_ACCOUNT
+
+    def client(self, service, region_name=None, aws_access_key_id=None, **kwargs):
+        # Clients of assumed-role credentials may come from a session without credentials
+        account = aws_access_key_id[4:] if aws_access_key_id else self.account
+        return FakeClient(self.aws, service, region_name, account)
+
+
+def install(aws):
+    """
+    Route boto3 in this process to the given FakeAWS. Can be called again to switch
+    to another FakeAWS; the Lambda modules must then be reloaded to drop their pooled clients.
+    """
+    _install_botocore()
+    _install_urllib3()
+
+    boto3 = sys.modules.get('boto3')
+    if boto3 is None or not getattr(boto3, 'offline_fake', False):
+        boto3 = types.ModuleType('boto3')
+        boto3.offline_fake = True
+        boto3.__version__ = 'offline'
+        sys.modules['boto3'] = boto3
+
+    boto3.client = lambda service, region_name=None, **kwargs: FakeClient(aws, service, region_name, MANAGEMENT_ACCOUNT)
+    boto3.Session = lambda **kwargs: FakeSession(aws, **kwargs)
+    return boto3
+
+
+def install_botocore_hooks(aws):
+    """
+    Answer the calls of real boto3 clients created afterwards from the given FakeAWS, by the
+    FakeClient of their account and region. Clients are created, and their parameters validated
+    and serialized, by boto3 and botocore as in Lambda; only sending the request is skipped.
+    Requires boto3, and credentials in the environment for the clients of the function's own role.
+    """
+    import boto3.session
+    from botocore import xform_name
+
+    http_ok = types.SimpleNamespace(status_code=200, headers={})
+    original = getattr(boto3.session.Session.client, 'offline_original', boto3.session.Session.client)
+
+    def client(self, service_name, region_name=None, *args, **kwargs):
+        real = original(self, service_name, region_name, *args, **kwargs)
+        access_key_id = kwargs.get('aws_access_key_id')
+        fake = FakeClient(aws, service_name, real.meta.region_name,
+                          access_key_id[4:] if access_key_id else MANAGEMENT_ACCOUNT)
+
+        def keep_params(params, context, **_):
+            context['offline_params'] = dict(params)
+
+        def answer(model, context, **_):
+            return http_ok, getattr(fake, xform_name(model.name))(**context['offline_params'])
+
+        real.meta.events.register('before-parameter-build', keep_params)
+        real.meta.events.register('before-call', answer)
+        return real
+
+    client.offline_original = original
+    boto3.session.Session.client = client
+    return boto3
+
+
+class FakeContext:
+    """
+    Lambda context with a deadline measured from its creation.
+    """
+
+    def __init__(self, timeout_seconds=300, function_name='ProducerLambda'):
+        self.deadline = time.monotonic() + timeout_seconds
+        self.function_name = function_name
+        self.invoked_function_arn = f'arn:aws:lambda:us-east-1:{MANAGEMENT_ACCOUNT}:function:{function_name}'
+        self.log_stream_name = f'{function_name}/stream'
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
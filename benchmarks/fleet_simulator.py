@@ -0,0 +1,454 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Offline fleet simulator for the Producer and Consumer Lambdas.
+
+Runs the real lambda_handler functions against the in-process fakes of benchmarks/fakes.py
+for a synthetic landing zone and reports wall time, API calls per service, messages per
+second and per-message latency percentiles.
+
+With --trace-output, the span records of both Lambdas are written to a file that
+ct_configrecorder_traces.py reads.
+
+With --state-store, the Lambdas share a temporary SQLite state store; use --rounds 2 to see
+the cost of a landing zone update once every account/region is up to date, and
+--new-accounts with --repeat-events to see bursts of Control Tower events coalesced.
+
+Example:
+    python benchmarks/fleet_simulator.py --accounts 50 1000 --regions 17 \
+        --latency-ms config=25,sts=15,sqs=8,cloudformation=40 --throttle-rate config=0.02
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/SQSConfigRecorder'
+PRIORITY_QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/SQSConfigRecorderPriority'
+DEAD_LETTER_QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/SQSConfigRecorderDeadLetter'
+LANES = {QUEUE_URL: 'sweep', PRIORITY_QUEUE_URL: 'priority'}
+# Consumer concurrency left to the priority lane, like ConsumerSweepMaximumConcurrency in template.yaml
+PRIORITY_RESERVED_CONCURRENCY = 2
+HOME_REGION = 'us-east-1'
+
+# Environment of the Lambda functions, as set by template.yaml with its default parameters
+LAMBDA_ENVIRONMENT = {
+    'AWS_REGION': HOME_REGION,
+    'LOG_LEVEL': 'CRITICAL',
+    'SQS_URL': QUEUE_URL,
+    'SQS_PRIORITY_URL': PRIORITY_QUEUE_URL,
+    'SQS_DEAD_LETTER_URL': DEAD_LETTER_QUEUE_URL,
+    'MESSAGE_VERSION': '2',
+    # Retries are sent again without DelaySeconds so scenarios do not wait for the backoff
+    'RETRY_BASE_DELAY_SECONDS': '0',
+    'ACCOUNT_SELECTION_MODE': 'EXCLUSION',
+    'EXCLUDED_ACCOUNTS': "['000000000000']",
+    'INCLUDED_ACCOUNTS': '[]',
+    'ACCOUNT_SELECTION_DOCUMENT': '',
+    'RECORDER_PROFILES_DOCUMENT': '',
+    'RESOURCE_TYPE_CATALOG_DOCUMENT': '',
+    'RESOURCE_TYPE_VALIDATION': 'ENFORCE',
+    'CONFIG_RECORDER_STRATEGY': 'EXCLUSION',
+    'CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST': 'AWS::AutoScaling::AutoScalingGroup,AWS::AutoScaling::LaunchConfiguration',
+    'CONFIG_RECORDER_OVERRIDE_DAILY_GLOBAL_RESOURCE_LIST': 'AWS::IAM::Policy,AWS::IAM::User,AWS::IAM::Role,AWS::IAM::Group',
+    'CONFIG_RECORDER_OVERRIDE_EXCLUDED_RESOURCE_LIST': 'AWS::HealthLake::FHIRDatastore,AWS::Pinpoint::Segment,AWS::Pinpoint::ApplicationSettings',
+    'CONFIG_RECORDER_OVERRIDE_INCLUDED_RESOURCE_LIST': 'AWS::S3::Bucket,AWS::CloudTrail::Trail',
+    'CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY': 'CONTINUOUS',
+    'CONTROL_TOWER_HOME_REGION': HOME_REGION,
+}
+
+# Lambda modules in import order; reloaded for every scenario so no warm state leaks between runs
+LAMBDA_MODULES = [
+    'ct_configrecorder_instrumentation',
+    'ct_configrecorder_throttling',
+    'ct_configrecorder_clients',
+    'ct_configrecorder_documents',
+    'ct_configrecorder_selection',
+    'ct_configrecorder_catalog',
+    'ct_configrecorder_recorder',
+    'ct_configrecorder_messages',
+    'ct_configrecorder_state',
+    'ct_configrecorder_profiles',
+    'ct_configrecorder_override_consumer',
+    'ct_configrecorder_override_producer',
+]
+
+# Embedded Metric Format documents of the Lambdas are discarded so they do not mix with the reports
+EMF_SINK = open(os.devnull, 'w')
+
+UPDATE_LANDING_ZONE_EVENT = {
+    'source': 'aws.controltower',
+    'detail-type': 'AWS Service Event via CloudTrail',
+    'detail': {'eventName': 'UpdateLandingZone'},
+}
+
+
+def create_managed_account_event(account):
+    return {
+        'id': str(uuid.uuid4()),
+        'source': 'aws.controltower',
+        'detail-type': 'AWS Service Event via CloudTrail',
+        'detail': {
+            'eventName': 'CreateManagedAccount',
+            'serviceEventDetails': {'createManagedAccountStatus': {'account': {'accountId': account}}},
+        },
+    }
+
+
+def queue_arn(queue_url):
+    host, account, name = queue_url.split('://', 1)[1].split('/')
+    return f'arn:aws:sqs:{host.split(".")[1]}:{account}:{name}'
+
+
+def load_lambdas(environment=None, trace_stream=None):
+    """
+    (Re)import the Lambda modules with the given environment and return them by name.
+    Span records are written to trace_stream, or discarded.
+    """
+    os.environ.update(LAMBDA_ENVIRONMENT)
+    os.environ.update(environment or {})
+    modules = {}
+    for name in LAMBDA_MODULES:
+        if name in sys.modules:
+            modules[name] = importlib.reload(sys.modules[name])
+        else:
+            modules[name] = importlib.import_module(name)
+        if hasattr(modules[name], 'METRICS'):
+            modules[name].METRICS.stream = EMF_SINK
+        if hasattr(modules[name], 'TRACER'):
+            modules[name].TRACER.stream = trace_stream or EMF_SINK
+            if trace_stream:
+                modules[name].TRACER.sample_rate = 1.0
+    return modules
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_producer(aws, producer, event):
+    """
+    Invoke the producer, then every continuation it hands off, like Lambda would.
+    """
+    invocations = 0
+    pending = [event]
+    while pending:
+        producer.lambda_handler(pending.pop(0), fakes.FakeContext(function_name='ProducerLambda'))
+        invocations += 1
+        while aws.invocations:
+            pending.append(aws.invocations.popleft())
+    return invocations
+
+
+def run_consumer(aws, consumer, queue_url, batch_size, concurrency, max_receive_count):
+    """
+    Drain the queue through the consumer with up to `concurrency` concurrent invocations.
+    Records reported in batchItemFailures are redelivered up to `max_receive_count` times.
+    """
+    queue = aws.queue(queue_url)
+    # Shared with the fake receive_message and delete_message_batch of the Consumer Lambda
+    lock = aws.queue_lock
+    stats = Counter()
+
+    def next_batch():
+        with lock:
+            now = time.time()
+            stats['in_flight'] += 1
+            batch = []
+            for _ in range(len(queue)):
+                if len(batch) == batch_size:
+                    break
+                message = queue.popleft()
+                if message['visibleAt'] > now:
+                    queue.append(message)
+                    continue
+                receive_count = int(message['attributes']['ApproximateReceiveCount']) + 1
+                message['attributes']['ApproximateReceiveCount'] = str(receive_count)
+                batch.append(message)
+            return batch
+
+    def worker():
+        while True:
+            batch = next_batch()
+            if not batch:
+                with lock:
+                    stats['in_flight'] -= 1
+                    # Failed records of batches still in flight may come back to the queue
+                    if not queue and not stats['in_flight']:
+                        return
+                # Only delayed or in-flight messages are left, wait for them
+                time.sleep(0.05)
+                continue
+            records = [{
+                'messageId': message['messageId'],
+                'body': message['body'],
+                'attributes': dict(message['attributes']),
+                'messageAttributes': message['messageAttributes'],
+                'eventSourceARN': queue_arn(queue_url),
+            } for message in batch]
+            response = consumer.lambda_handler({'Records': records}, fakes.FakeContext(180, 'ConsumerLambda'))
+            failed = {item['itemIdentifier'] for item in (response or {}).get('batchItemFailures', [])}
+            with lock:
+                stats['in_flight'] -= 1
+                stats['invocations'] += 1
+                for message in batch:
+                    if message['messageId'] not in failed:
+                        stats['deleted'] += 1
+                        aws.record_applied(queue_url, message)
+                    elif int(message['attributes']['ApproximateReceiveCount']) >= max_receive_count:
+                        stats['dead_lettered'] += 1
+                    else:
+                        stats['redelivered'] += 1
+                        queue.append(message)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return stats
+
+
+def run_scenario(accounts, regions=17, batch_size=10, consumer_concurrency=10, latency=None,
+                 throttle_rate=None, failure_rate=None, failure_code='InternalFailure',
+                 max_receive_count=3, event=None, environment=None, seed=0, rounds=1, new_accounts=0,
+                 repeat_events=1, trace_stream=None):
+    """
+    Simulate `rounds` producer sweeps, each followed by the consumer draining the queues.
+    `new_accounts` CreateManagedAccount events are sent right after each sweep is enqueued,
+    each of them `repeat_events` times like an enrollment retry.
+    Returns a report dict for the last round.
+    """
+    aws = fakes.FakeAWS(accounts, regions, latency, throttle_rate, failure_rate, failure_code, seed)
+    fakes.install(aws)
+    modules = load_lambdas(environment, trace_stream)
+    producer = modules['ct_configrecorder_override_producer']
+    consumer = modules['ct_configrecorder_override_consumer']
+    throttling = modules['ct_configrecorder_throttling']
+
+    # Every consumer container has its own rate limits; model them with scaled rates
+    throttling.RATE_CONTROLLER.rates = {service: rate * consumer_concurrency
+                                        for service, rate in throttling.RATE_CONTROLLER.rates.items()}
+
+    latencies = []
+    latencies_lock = threading.Lock()
+    update_config_recorder = consumer.update_config_recorder
+
+    def timed_update_config_recorder(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return update_config_recorder(*args, **kwargs)
+        finally:
+            with latencies_lock:
+                latencies.append(time.perf_counter() - start)
+
+    consumer.update_config_recorder = timed_update_config_recorder
+
+    # Like the event source mappings: the sweep lane cannot take the concurrency left to the priority lane
+    if os.environ.get('SQS_PRIORITY_URL'):
+        lanes = {QUEUE_URL: max(1, consumer_concurrency - PRIORITY_RESERVED_CONCURRENCY),
+                 PRIORITY_QUEUE_URL: min(consumer_concurrency, PRIORITY_RESERVED_CONCURRENCY)}
+    else:
+        lanes = {QUEUE_URL: consumer_concurrency}
+
+    for _ in range(rounds):
+        aws.calls.clear()
+        aws.applied.clear()
+        aws.queue(DEAD_LETTER_QUEUE_URL).clear()
+        with latencies_lock:
+            latencies.clear()
+
+        start = time.perf_counter()
+        sweep_event = event or UPDATE_LANDING_ZONE_EVENT
+        if 'source' in sweep_event:
+            # Every round is a new Control Tower event, with its own event ID and trace
+            sweep_event = dict(sweep_event, id=str(uuid.uuid4()))
+        producer_invocations = run_producer(aws, producer, sweep_event)
+        sweep_messages = {message['messageId'] for queue in aws.queues.values() for message in queue}
+        for account in aws.account_ids[:new_accounts]:
+            for _ in range(repeat_events):
+                producer_invocations += run_producer(aws, producer, create_managed_account_event(account))
+        new_account_messages = {message['messageId'] for queue in aws.queues.values() for message in queue} - sweep_messages
+        producer_seconds = time.perf_counter() - start
+        enqueued = sum(len(queue) for queue in aws.queues.values())
+
+        consumer_stats = Counter()
+        with ThreadPoolExecutor(max_workers=len(lanes)) as executor:
+            futures = [executor.submit(run_consumer, aws, consumer, queue_url, batch_size, concurrency, max_receive_count)
+                       for queue_url, concurrency in lanes.items()]
+            for future in futures:
+                consumer_stats.update(future.result())
+        wall_seconds = time.perf_counter() - start
+
+    # The Consumer Lambda only uses send_message to retry and quarantine messages
+    quarantined = len(aws.queue(DEAD_LETTER_QUEUE_URL))
+    time_to_apply = {}
+    for queue_url, message_id, seconds in aws.applied:
+        time_to_apply.setdefault(LANES[queue_url], []).append(seconds)
+        if message_id in new_account_messages:
+            time_to_apply.setdefault('new accounts', []).append(seconds)
+
+    return {
+        'round': rounds,
+        'accounts': accounts,
+        'regions': regions,
+        'account_regions': accounts * regions,
+        'messages_enqueued': enqueued,
+        'producer_invocations': producer_invocations,
+        'producer_seconds': round(producer_seconds, 3),
+        'consumer_invocations': consumer_stats['invocations'],
+        'messages_deleted': len(aws.applied),
+        'messages_redelivered': consumer_stats['redelivered'],
+        'messages_dead_lettered': consumer_stats['dead_lettered'],
+        'messages_retried': aws.calls[('sqs', 'SendMessage')] - quarantined,
+        'messages_quarantined': quarantined,
+        'wall_seconds': round(wall_seconds, 3),
+        'messages_per_second': round(enqueued / wall_seconds, 1) if wall_seconds else 0.0,
+        'api_calls': dict(sorted(aws.calls_per_service().items())),
+        'api_calls_per_operation': {f'{service}:{operation}': count
+                                    for (service, operation), count in sorted(aws.calls.items())},
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 2),
+            'p95': round(percentile(latencies, 95) * 1000, 2),
+            'p99': round(percentile(latencies, 99) * 1000, 2),
+        },
+        'time_to_apply_ms': {
+            lane: {
+                'messages': len(values),
+                'p50': round(percentile(values, 50) * 1000, 2),
+                'p95': round(percentile(values, 95) * 1000, 2),
+                'max': round(max(values) * 1000, 2),
+            } for lane, values in time_to_apply.items()
+        },
+    }
+
+
+def parse_service_values(value, scale=1.0):
+    """
+    Parse 'config=25,sts=15' into {'config': 25 * scale, 'sts': 15 * scale}.
+    """
+    values = {}
+    for item in filter(None, (value or '').split(',')):
+        service, number = item.split('=')
+        values[service.strip()] = float(number) * scale
+    return values
+
+
+def format_report(report):
+    lines = [
+        f'{report["accounts"]} accounts x {report["regions"]} regions ({report["account_regions"]} account/regions)'
+        + (f', round {report["round"]}' if report['round'] > 1 else ''),
+        f'  wall time        {report["wall_seconds"]:.3f} s (producer {report["producer_seconds"]:.3f} s '
+        f'in {report["producer_invocations"]} invocation(s))',
+        f'  messages         {report["messages_enqueued"]} enqueued, {report["messages_deleted"]} deleted, '
+        f'{report["messages_redelivered"]} redelivered, {report["messages_dead_lettered"]} dead-lettered',
+        f'  retries          {report["messages_retried"]} retried, {report["messages_quarantined"]} quarantined',
+        f'  consumer         {report["consumer_invocations"]} invocations, {report["messages_per_second"]} messages/s',
+        f'  latency          p50 {report["latency_ms"]["p50"]} ms, p95 {report["latency_ms"]["p95"]} ms, '
+        f'p99 {report["latency_ms"]["p99"]} ms',
+        '  api calls        ' + ', '.join(f'{service}={count}' for service, count in report['api_calls'].items()),
+    ]
+    for lane, values in report['time_to_apply_ms'].items():
+        lines.append(f'  time to apply    {lane}: {values["messages"]} messages, p50 {values["p50"]} ms, '
+                     f'p95 {values["p95"]} ms, max {values["max"]} ms')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--accounts', type=int, nargs='+', default=[50, 1000, 5000],
+                        help='Landing zone sizes to simulate (default: 50 1000 5000)')
+    parser.add_argument('--regions', type=int, default=17, help='Governed regions per account (default: 17)')
+    parser.add_argument('--batch-size', type=int, default=10, help='Consumer SQS batch size (default: 10)')
+    parser.add_argument('--consumer-concurrency', type=int, default=10,
+                        help='Concurrent consumer invocations (default: 10, as ReservedConcurrentExecutions)')
+    parser.add_argument('--latency-ms', default='', help='Per-service latency, e.g. config=25,sts=15,sqs=8')
+    parser.add_argument('--throttle-rate', default='', help='Per-service throttling probability, e.g. config=0.05')
+    parser.add_argument('--failure-rate', default='', help='Per-service failure probability, e.g. sts=0.01')
+    parser.add_argument('--failure-code', default='InternalFailure', help='Error code of injected failures')
+    parser.add_argument('--state-store', action='store_true',
+                        help='Give the Lambdas a temporary SQLite state store (STATE_STORE_PATH)')
+    parser.add_argument('--reconciliation-mode', default='INCREMENTAL', choices=['INCREMENTAL', 'FULL'],
+                        help='RECONCILIATION_MODE of the Producer Lambda (default: INCREMENTAL)')
+    parser.add_argument('--rounds', type=int, default=1,
+                        help='Landing zone updates per scenario; the report is for the last one (default: 1)')
+    parser.add_argument('--new-accounts', type=int, default=0,
+                        help='CreateManagedAccount events sent right after each sweep (default: 0)')
+    parser.add_argument('--repeat-events', type=int, default=1,
+                        help='Times each CreateManagedAccount event is sent (default: 1)')
+    parser.add_argument('--coalescing-window', type=int, default=600,
+                        help='COALESCING_WINDOW_SECONDS of the Producer Lambda, with --state-store (default: 600)')
+    parser.add_argument('--message-version', default='2', choices=['1', '2'],
+                        help='MESSAGE_VERSION of the Producer Lambda: 2 for one message per account (default: 2)')
+    parser.add_argument('--single-lane', action='store_true',
+                        help='Send every message to the sweep lane, as before priority lanes')
+    parser.add_argument('--selection-document',
+                        help='Local account selection document of the Producer Lambda (ACCOUNT_SELECTION_DOCUMENT); '
+                             'the fake organization has the OUs Root/Sandbox, Root/Workloads/Prod and Root/Workloads/Dev')
+    parser.add_argument('--profiles-document',
+                        help='Local recorder profiles document of both Lambdas (RECORDER_PROFILES_DOCUMENT)')
+    parser.add_argument('--trace-output', help='JSON lines file the span records of both Lambdas are written to')
+    parser.add_argument('--log-level', default='CRITICAL', help='LOG_LEVEL of the Lambda functions (default: CRITICAL)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON lines')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+    trace_stream = open(args.trace_output, 'w') if args.trace_output else None
+    for accounts in args.accounts:
+        environment = {'LOG_LEVEL': args.log_level, 'RECONCILIATION_MODE': args.reconciliation_mode, 'STATE_STORE_PATH': '',
+                       'COALESCING_WINDOW_SECONDS': str(args.coalescing_window), 'MESSAGE_VERSION': args.message_version}
+        if args.single_lane:
+            environment['SQS_PRIORITY_URL'] = ''
+        if args.selection_document:
+            environment['ACCOUNT_SELECTION_DOCUMENT'] = os.path.abspath(args.selection_document)
+        if args.profiles_document:
+            environment['RECORDER_PROFILES_DOCUMENT'] = os.path.abspath(args.profiles_document)
+        if args.state_store:
+            environment['STATE_STORE_PATH'] = os.path.join(tempfile.mkdtemp(), 'state.db')
+        report = run_scenario(
+            accounts, args.regions, args.batch_size, args.consumer_concurrency,
+            latency=parse_service_values(args.latency_ms, 0.001),
+            throttle_rate=parse_service_values(args.throttle_rate),
+            failure_rate=parse_service_values(args.failure_rate),
+            failure_code=args.failure_code, environment=environment, seed=args.seed, rounds=args.rounds,
+            new_accounts=args.new_accounts, repeat_events=args.repeat_events, trace_stream=trace_stream)
+        print(json.dumps(report) if args.json else format_report(report), flush=True)
+
+
+if __name__ == '__main__':
+    main()
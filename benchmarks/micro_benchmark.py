@@ -0,0 +1,379 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Micro-benchmarks of the per-message hot paths of the Producer and Consumer Lambdas, with a
+regression check against committed baselines.
+
+Each case times one operation of Lambda code, offline, against the in-process fakes of
+benchmarks/fakes.py:
+
+    selection_*        AccountSelector.should_process over large account lists and patterns
+    recorder_*         the recorder of the Consumer Lambda (desired_recorder) for both strategies,
+                       home and other regions and the Delete event, built without the memoized
+                       settings; recorder_memoized is the warm path
+    message_*          encoding and decoding of the SQS messages of 17 regions
+    producer_page      one synthetic list_stack_instances page indexed and sent to SQS by
+                       override_config_recorder, with up to SQS_MAX_INFLIGHT_BATCHES
+                       send_message_batch calls in flight as in the Producer Lambda
+
+Times are the best of --repeat runs, in nanoseconds per operation. Allocations are traced with
+tracemalloc on a separate run: the peak memory above the start of the run and the memory still
+allocated after it, per operation. call_with_retry runs on a virtual clock, so the rate limits
+of the SQS calls are computed but never waited for.
+
+Times depend on the machine and its load, so the runs of every case alternate with runs of a
+fixed calibration workload, and the baseline time of the case is scaled by the ratio of the
+calibration times before they are compared. A case regresses when its time
+or its peak memory exceeds the scaled baseline by more than --threshold; the exit status is then 1.
+The time of producer_page includes the scheduling of the threads of the SQS fan-out, so it gets
+CONCURRENT_REPEAT_FACTOR times more runs and is allowed a slowdown of CONCURRENT_THRESHOLD.
+After an intended change, record new baselines with --update-baseline.
+
+Example:
+    python benchmarks/micro_benchmark.py
+    python benchmarks/micro_benchmark.py --cases recorder message --threshold 0.1
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+from fleet_simulator import QUEUE_URL, load_lambdas  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'micro_benchmark_baseline.json')
+# Allowed slowdown, or growth of the peak memory, over the baseline
+REGRESSION_THRESHOLD = 0.25
+# Cases running a thread pool, their runs and allowed slowdown, or growth of the peak memory
+CONCURRENT_CASES = {'producer_page'}
+CONCURRENT_REPEAT_FACTOR = 3
+CONCURRENT_THRESHOLD = 1.0
+# Growth of the peak memory below this many KiB is noise of the allocator, not a regression
+MEMORY_NOISE_KIB = 4.0
+# Each timed run lasts at least this long
+MIN_RUN_SECONDS = 0.02
+# Operations of the allocation run
+ALLOCATION_OPERATIONS = 100
+ACCOUNTS = 1000
+VIRTUAL_CLOCK_TICK = 1e-6
+CALIBRATION_OPERATIONS = 200
+REGIONS = 17
+
+
+class VirtualClock:
+    """
+    Clock of a RateController that advances when it sleeps, instead of waiting. It advances by
+    at least VIRTUAL_CLOCK_TICK, as shorter sleeps can be lost to the rounding of the time.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += max(VIRTUAL_CLOCK_TICK, seconds)
+
+
+CALIBRATION_DOCUMENT = {'Account': '123456789012', 'Regions': [{'Region': f'region-{index}'} for index in range(17)]}
+
+
+def calibrate():
+    """
+    Run a fixed pure Python workload, timed next to every case to scale the baselines to the
+    speed of the machine at the time.
+    """
+    for _ in range(CALIBRATION_OPERATIONS):
+        json.loads(json.dumps(CALIBRATION_DOCUMENT))
+        sorted(str(index) for index in range(50))
+
+
+def selection_cases(selection, sizes):
+    """
+    Return the should_process cases: an account list of every size, and patterns over the largest one.
+    """
+    cases = {}
+    for size in sizes:
+        account_ids = [f'{200000000000 + index:012d}' for index in range(size * 2)]
+        # Half of the accounts processed are on the exclusion list
+        selector = selection.AccountSelector(selection.EXCLUSION, account_ids[::2])
+        accounts = deque(account_ids)
+        cases[f'selection_{size}_accounts'] = lambda selector=selector, accounts=accounts: (
+            selector.should_process(accounts[0]), accounts.rotate(1))
+    account_ids = [f'{300000000000 + index:012d}' for index in range(max(sizes))]
+    selector = selection.AccountSelector(selection.EXCLUSION, account_ids[:100],
+                                         patterns=['3000000001*', '30000000?5??', '3[0-9]000000000'])
+    accounts = deque(account_ids)
+    cases['selection_patterns'] = lambda: (selector.should_process(accounts[0]), accounts.rotate(1))
+    return cases
+
+
+def recorder_cases(recorder, consumer):
+    """
+    Return the Consumer recorder cases for both strategies, home and other regions and the Delete event.
+    """
+    home_region = recorder.CONTROL_TOWER_HOME_REGION
+    other_region = next(region for region in fakes.REGIONS if region != home_region)
+    profiles = {
+        'exclusion': recorder.DEFAULT_PROFILE._replace(strategy='EXCLUSION'),
+        'inclusion': recorder.DEFAULT_PROFILE._replace(strategy='INCLUSION'),
+    }
+    existing = {'name': 'aws-controltower-BaselineConfigRecorder'}
+
+    def build(profile, region, event):
+        # The memoized settings are dropped, so every operation builds the recorder
+        recorder.build_recorder_config.cache_clear()
+        recorder.supported_profile.cache_clear()
+        return consumer.desired_recorder(fakes.MANAGEMENT_ACCOUNT, region, event, existing, profile)
+
+    cases = {}
+    for strategy, profile in profiles.items():
+        for placement, region in (('home', home_region), ('other', other_region)):
+            cases[f'recorder_{strategy}_{placement}'] = lambda profile=profile, region=region: build(profile, region, 'Update')
+    cases['recorder_delete_home'] = lambda: build(profiles['exclusion'], home_region, 'Delete')
+    cases['recorder_delete_other'] = lambda: build(profiles['exclusion'], other_region, 'Delete')
+    cases['recorder_memoized'] = lambda: consumer.desired_recorder(
+        fakes.MANAGEMENT_ACCOUNT, other_region, 'Update', existing, profiles['exclusion'])
+    return cases
+
+
+def message_cases(messages, recorder):
+    """
+    Return the encoding and decoding cases of a message for REGIONS regions.
+    """
+    regions = fakes.REGIONS[:REGIONS]
+    account = '123456789012'
+
+    def build():
+        return messages.build_message(
+            account, 'controltower', regions,
+            operations={region: fakes.BASELINE_OPERATION_ID for region in regions},
+            fingerprints={region: recorder.desired_fingerprint(region, 'controltower') for region in regions},
+            trace_id='0123456789abcdef0123456789abcdef')
+
+    message = build()
+    body = messages.encode_message(message)
+    v1_body = messages.encode_v1_messages(message)[0]
+    return {
+        'message_encode': lambda: messages.encode_message(build()),
+        'message_encode_v1': lambda: messages.encode_v1_messages(message),
+        'message_decode': lambda: messages.decode_message(body),
+        'message_decode_v1': lambda: messages.decode_message(v1_body),
+    }
+
+
+def producer_cases(modules, aws):
+    """
+    Return the case of one synthetic list_stack_instances page going through override_config_recorder.
+    """
+    producer = modules['ct_configrecorder_override_producer']
+    selector = modules['ct_configrecorder_selection'].AccountSelector('EXCLUSION', [fakes.MANAGEMENT_ACCOUNT])
+    sqs_client = fakes.FakeClient(aws, 'sqs', fakes.REGIONS[0], fakes.MANAGEMENT_ACCOUNT)
+    page_size = fakes.STACK_INSTANCES_PAGE_SIZE
+    pages = deque({'Summaries': aws.stack_instances[start:start + page_size]}
+                  for start in range(0, len(aws.stack_instances), page_size))
+    queue = aws.queue(QUEUE_URL)
+
+    def process_page():
+        page = pages[0]
+        pages.rotate(1)
+        operations = {}
+        index = producer.index_stack_instances(page['Summaries'], operations=operations)
+        stats = producer.override_config_recorder(selector, sqs_client, QUEUE_URL, index, '', 'Update', operations)
+        # The fake queue and the metrics of the invocation do not outlive the operation
+        queue.clear()
+        producer.METRICS.clear()
+        return stats
+
+    return {'producer_page': process_page}
+
+
+def build_cases(sizes):
+    """
+    Load the Lambda modules against a fake landing zone of ACCOUNTS accounts and return the cases by name.
+    """
+    aws = fakes.FakeAWS(accounts=ACCOUNTS, regions=REGIONS)
+    fakes.install(aws)
+    modules = load_lambdas({'STATE_STORE_PATH': '', 'STATE_TABLE_NAME': ''})
+    throttling = modules['ct_configrecorder_throttling']
+    clock = VirtualClock()
+    throttling.RATE_CONTROLLER = throttling.RateController(clock=clock.monotonic, sleep=clock.sleep)
+
+    cases = {}
+    cases.update(selection_cases(modules['ct_configrecorder_selection'], sizes))
+    cases.update(recorder_cases(modules['ct_configrecorder_recorder'], modules['ct_configrecorder_override_consumer']))
+    cases.update(message_cases(modules['ct_configrecorder_messages'], modules['ct_configrecorder_recorder']))
+    cases.update(producer_cases(modules, aws))
+    return cases
+
+
+def measure(operation, repeat):
+    """
+    Time and trace the allocations of one operation.
+
+    Returns:
+        dict: Best 'ns_per_op' of `repeat` runs, the 'operations' of each run, the best 'calibration_ns'
+              of the calibration runs, the 'peak_kib' above the start of the allocation run and the
+              'retained_bytes_per_op' after it
+    """
+    # Warm up, and find the number of operations lasting MIN_RUN_SECONDS
+    number = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(number):
+            operation()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= MIN_RUN_SECONDS * 1e9:
+            break
+        number *= 2 if elapsed * 10 >= MIN_RUN_SECONDS * 1e9 else 10
+
+    # As in timeit, the garbage collector does not run in the timed runs. The calibration runs
+    # alternate with the runs of the case, so both see the same load of the machine
+    best = elapsed
+    calibration = None
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            calibrate()
+            elapsed = time.perf_counter_ns() - start
+            calibration = elapsed if calibration is None else min(calibration, elapsed)
+            start = time.perf_counter_ns()
+            for _ in range(number):
+                operation()
+            best = min(best, time.perf_counter_ns() - start)
+    finally:
+        gc.enable()
+
+    operations = min(number, ALLOCATION_OPERATIONS)
+    tracemalloc.start()
+    started, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for _ in range(operations):
+        operation()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'ns_per_op': round(best / number, 1),
+        'operations': number,
+        'calibration_ns': calibration,
+        'peak_kib': round((peak - started) / 1024, 1),
+        'retained_bytes_per_op': round((current - started) / operations, 1),
+    }
+
+
+def compare(name, result, baseline, threshold):
+    """
+    Add the change over the baseline, scaled by the calibration runs, to a result, and return True
+    if the case regressed.
+    """
+    reference = baseline.get('cases', {}).get(name)
+    if not reference:
+        result['status'] = 'new'
+        return False
+    expected_ns = reference['ns_per_op'] * result['calibration_ns'] / reference['calibration_ns']
+    result['time_change'] = round(result['ns_per_op'] / expected_ns - 1, 3)
+    slower = result['time_change'] > threshold
+    grown = (result['peak_kib'] > reference['peak_kib'] * (1 + threshold)
+             and result['peak_kib'] - reference['peak_kib'] > MEMORY_NOISE_KIB)
+    result['status'] = 'slower' if slower else 'memory' if grown else 'ok'
+    return slower or grown
+
+
+def load_baseline(path):
+    try:
+        with open(path) as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return {}
+
+
+def format_result(name, result):
+    change = f'{result["time_change"]:+.0%}' if 'time_change' in result else ''
+    return (f'{name:<28} {result["ns_per_op"] / 1000:>10.2f} us {change:>6}  peak {result["peak_kib"]:>8.1f} KiB  '
+            f'retained {result["retained_bytes_per_op"]:>9.1f} B/op  {result["status"]}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cases', nargs='+', help='Only run the cases whose name starts with one of these prefixes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000],
+                        help='Account list sizes of the selection cases (default: 1000 100000)')
+    parser.add_argument('--repeat', type=int, default=15, help='Timed runs per case (default: 15)')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help=f'Allowed slowdown or peak memory growth (default: {REGRESSION_THRESHOLD})')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file (default: %(default)s)')
+    parser.add_argument('--update-baseline', action='store_true', help='Record the results as the new baselines')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON lines')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.CRITICAL)
+    cases = build_cases(args.sizes)
+    if args.cases:
+        cases = {name: case for name, case in cases.items() if name.startswith(tuple(args.cases))}
+
+    baseline = load_baseline(args.baseline)
+    results = {}
+    regressions = []
+    for name, case in cases.items():
+        if name in CONCURRENT_CASES:
+            repeat, threshold = args.repeat * CONCURRENT_REPEAT_FACTOR, max(args.threshold, CONCURRENT_THRESHOLD)
+        else:
+            repeat, threshold = args.repeat, args.threshold
+        result = results[name] = measure(case, repeat)
+        if compare(name, result, baseline, threshold):
+            regressions.append(name)
+        print(json.dumps(dict(result, case=name)) if args.json else format_result(name, result), flush=True)
+
+    if args.update_baseline:
+        recorded = dict(baseline.get('cases', {}))
+        recorded.update((name, {key: result[key] for key in ('ns_per_op', 'calibration_ns', 'peak_kib', 'retained_bytes_per_op')})
+                        for name, result in results.items())
+        with open(args.baseline, 'w') as stream:
+            json.dump({'python': platform.python_version(), 'cases': dict(sorted(recorded.items()))}, stream,
+                      indent=2, sort_keys=True)
+            stream.write('\n')
+        print(f'Recorded {len(results)} baselines in {args.baseline}', file=sys.stderr)
+        return 0
+
+    if regressions:
+        print(f'{len(regressions)} regressions: {", ".join(regressions)}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
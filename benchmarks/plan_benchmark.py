@@ -0,0 +1,132 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Offline benchmark of the fleet plan (ct_configrecorder_plan.py).
+
+Plans a synthetic landing zone against the in-process fakes of benchmarks/fakes.py, with a
+share of the account/regions already in sync, and reports wall time, account/regions per
+second, drift categories and the peak memory traced while planning.
+
+Example:
+    python benchmarks/plan_benchmark.py --accounts 100 1000 --regions 17 --latency-ms config=25,sts=15
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+from fleet_simulator import EMF_SINK, load_lambdas, parse_service_values  # noqa: E402
+
+PLAN_OUTPUT = open(os.devnull, 'w')
+
+
+def run_plan(accounts, regions, max_workers, in_sync_rate=0.5, latency=None, failure_rate=None, seed=0):
+    """
+    Plan a fresh fake landing zone and return the report.
+    """
+    aws = fakes.FakeAWS(accounts=accounts, regions=regions, latency=latency, failure_rate=failure_rate,
+                        failure_code='AccessDenied', seed=seed)
+    fakes.install(aws)
+    modules = load_lambdas()
+    plan = importlib.reload(sys.modules['ct_configrecorder_plan']) if 'ct_configrecorder_plan' in sys.modules \
+        else importlib.import_module('ct_configrecorder_plan')
+    consumer = modules['ct_configrecorder_override_consumer']
+
+    # Account/regions whose recorder already has the desired settings
+    rng = random.Random(seed)
+    for item in aws.stack_instances:
+        if rng.random() < in_sync_rate:
+            aws.recorders[(item['Account'], item['Region'])] = consumer.desired_recorder(item['Account'], item['Region'], 'Update')
+
+    producer = modules['ct_configrecorder_override_producer']
+    pairs = plan.iter_account_regions(
+        fakes.FakeClient(aws, 'cloudformation', fakes.REGIONS[0], fakes.MANAGEMENT_ACCOUNT),
+        modules['ct_configrecorder_selection'].AccountSelector('EXCLUSION', [fakes.MANAGEMENT_ACCOUNT]))
+    for metrics in (consumer.METRICS, producer.METRICS):
+        metrics.stream = EMF_SINK
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    summary = plan.write_plan(pairs, 'Update', PLAN_OUTPUT, max_workers)
+    wall_seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    planned = sum(summary.values())
+    return {
+        'accounts': accounts,
+        'regions': regions,
+        'account_regions': planned,
+        'max_workers': max_workers,
+        'wall_seconds': round(wall_seconds, 3),
+        'account_regions_per_second': round(planned / wall_seconds, 1) if wall_seconds else 0.0,
+        'peak_memory_kib': round(peak / 1024, 1),
+        'drift': dict(sorted(summary.items())),
+        'api_calls': dict(sorted(aws.calls_per_service().items())),
+    }
+
+
+def format_report(report):
+    return '\n'.join([
+        f'{report["accounts"]} accounts x {report["regions"]} regions ({report["account_regions"]} account/regions), '
+        f'{report["max_workers"]} workers',
+        f'  wall time        {report["wall_seconds"]:.3f} s, {report["account_regions_per_second"]} account/regions/s',
+        f'  peak memory      {report["peak_memory_kib"]} KiB',
+        '  drift            ' + ', '.join(f'{drift}={count}' for drift, count in report['drift'].items()),
+        '  api calls        ' + ', '.join(f'{service}={count}' for service, count in report['api_calls'].items()),
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--accounts', type=int, nargs='+', default=[100, 1000, 5000],
+                        help='Landing zone sizes to plan (default: 100 1000 5000)')
+    parser.add_argument('--regions', type=int, default=17, help='Governed regions per account (default: 17)')
+    parser.add_argument('--max-workers', type=int, default=16, help='Account/regions described concurrently (default: 16)')
+    parser.add_argument('--in-sync-rate', type=float, default=0.5,
+                        help='Share of account/regions already in sync (default: 0.5)')
+    parser.add_argument('--latency-ms', default='', help='Per-service latency, e.g. config=25,sts=15')
+    parser.add_argument('--failure-rate', default='', help='Per-service AccessDenied probability, e.g. sts=0.01')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON lines')
+    args = parser.parse_args(argv)
+
+    # Errors injected with --failure-rate are counted in the report instead of logged
+    logging.basicConfig(level=logging.CRITICAL)
+    for accounts in args.accounts:
+        report = run_plan(accounts, args.regions, args.max_workers, args.in_sync_rate,
+                          latency=parse_service_values(args.latency_ms, 0.001),
+                          failure_rate=parse_service_values(args.failure_rate), seed=args.seed)
+        print(json.dumps(report) if args.json else format_report(report), flush=True)
+
+
+if __name__ == '__main__':
+    main()
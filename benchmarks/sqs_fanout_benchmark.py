@@ -0,0 +1,146 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""
+Benchmark of the SQS fan-out of the Producer Lambda: one send_message call per account/region,
+as before batching, against send_messages_to_sqs, which sends batches of SQS_BATCH_SIZE with up
+to SQS_MAX_INFLIGHT_BATCHES calls in flight.
+
+Both paths send the same message bodies to a local SQS stand-in that answers every call after
+--latency-ms, the round trip of an SQS call from Lambda, so the wall time is dominated by the
+number of calls and how many of them overlap, as it is in the Lambda function.
+
+Without boto3, the Producer Lambda is imported against the fake boto3 module of benchmarks/fakes.py.
+
+Example:
+    python benchmarks/sqs_fanout_benchmark.py --messages 1000 2000 --latency-ms 20
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/111111111111/ConfigRecorderQueue'
+
+
+class LocalSQS:
+    """
+    SQS client stand-in accepting every message after a fixed latency per call.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def _call(self, messages):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            self.messages += messages
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self._call(1)
+        return {'MessageId': str(self.messages)}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call(len(Entries))
+        return {'Successful': [{'Id': entry['Id'], 'MessageId': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+def import_producer():
+    """
+    Import the Producer Lambda, against the fake boto3 module when boto3 is not installed.
+    """
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    try:
+        import botocore  # noqa: F401
+    except ImportError:
+        import fakes
+        fakes.install(fakes.FakeAWS(accounts=1, regions=1))
+    import ct_configrecorder_override_producer
+    return ct_configrecorder_override_producer
+
+
+def message_bodies(count):
+    return [json.dumps({'Account': f'{100000000000 + index // 17}', 'Region': f'region-{index % 17}', 'Event': 'Update'})
+            for index in range(count)]
+
+
+def run_single(bodies, latency):
+    """
+    Send every message with its own send_message call, one after the other.
+    """
+    client = LocalSQS(latency)
+    started = time.perf_counter()
+    for body in bodies:
+        client.send_message(QueueUrl=QUEUE_URL, MessageBody=body)
+    return time.perf_counter() - started, client
+
+
+def run_batched(producer, bodies, latency):
+    """
+    Send the messages with send_messages_to_sqs of the Producer Lambda.
+    """
+    client = LocalSQS(latency)
+    started = time.perf_counter()
+    stats = producer.send_messages_to_sqs(client, QUEUE_URL, bodies)
+    elapsed = time.perf_counter() - started
+    assert stats['sent'] == len(bodies) and not stats['failed'], stats
+    return elapsed, client
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, nargs='+', default=[1000], help='Messages to send (default: 1000)')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Latency of each SQS call (default: 20)')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON lines')
+    args = parser.parse_args(argv)
+
+    producer = import_producer()
+    latency = args.latency_ms / 1000
+    for count in args.messages:
+        bodies = message_bodies(count)
+        single_seconds, single = run_single(bodies, latency)
+        batched_seconds, batched = run_batched(producer, bodies, latency)
+        result = {
+            'messages': count,
+            'single_seconds': round(single_seconds, 3),
+            'single_calls': single.calls,
+            'batched_seconds': round(batched_seconds, 3),
+            'batched_calls': batched.calls,
+            'speedup': round(single_seconds / batched_seconds, 1),
+        }
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f'{count} messages: send_message {single_seconds:.3f} s in {single.calls} calls, '
+                  f'send_messages_to_sqs {batched_seconds:.3f} s in {batched.calls} calls, {result["speedup"]}x faster')
+
+
+if __name__ == '__main__':
+    main()
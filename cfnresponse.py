@@ -2,13 +2,22 @@
 # SPDX-License-Identifier: MIT-0
  
 from __future__ import print_function
-import urllib3
 import json
 
 SUCCESS = "SUCCESS"
 FAILED = "FAILED"
 
-http = urllib3.PoolManager()
+# Created on the first response, so functions that are not always invoked by CloudFormation
+# do not import urllib3 and build a PoolManager on every cold start
+http = None
+
+
+def get_http():
+    global http
+    if http is None:
+        import urllib3
+        http = urllib3.PoolManager()
+    return http
 
 
 def send(event, context, responseStatus, responseData, physicalResourceId=None, noEcho=False, reason=None):
@@ -38,7 +47,7 @@ def send(event, context, responseStatus, responseData, physicalResourceId=None,
     }
 
     try:
-        response = http.request('PUT', responseUrl, headers=headers, body=json_responseBody)
+        response = get_http().request('PUT', responseUrl, headers=headers, body=json_responseBody)
         print("Status code:", response.status)
 
 
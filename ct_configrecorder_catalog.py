@@ -0,0 +1,180 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Catalog of the resource types AWS Config records in each region, shared by the Producer and Consumer Lambdas.
+
+The catalog is bundled with both functions as ct_configrecorder_resource_types.json:
+
+    {
+        "Source": "botocore 1.43.114",
+        "ResourceTypes": ["AWS::ACM::Certificate", ...],
+        "UnsupportedResourceTypes": {"eu-central-2": ["AWS::IAM::Group", ...]}
+    }
+
+ResourceTypes are the types AWS Config knows, from the ResourceType values of the AWS Config API
+model of botocore; UnsupportedResourceTypes are the types a region does not record. Regenerate the
+bundled types from the installed botocore, keeping the regions, with:
+
+    python ct_configrecorder_catalog.py --update
+
+A newer catalog can be given without redeploying the functions with RESOURCE_TYPE_CATALOG_DOCUMENT,
+an S3 object (s3://bucket/key) or a local file with the same keys, which replace the bundled ones.
+It is read again after RESOURCE_TYPE_CATALOG_REFRESH_SECONDS (default: 900).
+
+With RESOURCE_TYPE_VALIDATION=ENFORCE (default), the Producer Lambda rejects stack creation and
+updates with types the catalog does not know, and the Consumer Lambda leaves them out of the
+inclusion lists of the recorder. With WARN, they are logged and sent to AWS Config as configured,
+for types newer than the catalog. Types a region does not record are left out of the inclusion
+lists of that region in both modes; exclusion and daily lists keep them, with a warning.
+"""
+
+import argparse
+import json
+import logging
+import os
+
+from ct_configrecorder_documents import DocumentCache, read_document
+
+BUNDLED_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ct_configrecorder_resource_types.json')
+ENFORCE = 'ENFORCE'
+WARN = 'WARN'
+# A warm container reads the catalog document again after this long
+CATALOG_REFRESH_SECONDS = int(os.getenv('RESOURCE_TYPE_CATALOG_REFRESH_SECONDS', '900'))
+
+
+class ResourceTypeCatalog:
+    """
+    Resource types AWS Config knows, and the ones each region does not record.
+
+    Args:
+        resource_types (iterable): Every resource type AWS Config knows
+        unsupported (dict): Region -> resource types the region does not record
+        enforce (bool): Leave the types the catalog does not know out of recorders
+        source (str): Where the catalog comes from, for the logs
+    """
+
+    def __init__(self, resource_types=(), unsupported=None, enforce=True, source=''):
+        self.resource_types = frozenset(resource_types)
+        self.unsupported = {region: frozenset(types) for region, types in (unsupported or {}).items()}
+        self.enforce = enforce
+        self.source = source
+
+    def unknown(self, resource_types):
+        """
+        Return the resource types the catalog does not know, in their order.
+        """
+        return [resource_type for resource_type in resource_types if resource_type not in self.resource_types]
+
+    def unsupported_regions(self, resource_type):
+        """
+        Return the regions that do not record a resource type, sorted.
+        """
+        return sorted(region for region, types in self.unsupported.items() if resource_type in types)
+
+    def is_supported(self, resource_type, aws_region):
+        """
+        Return False for a resource type to leave out of the recorders of a region.
+        """
+        if resource_type in self.unsupported.get(aws_region, ()):
+            return False
+        return resource_type in self.resource_types or not self.enforce
+
+
+def load_catalog(location='', validation=ENFORCE):
+    """
+    Return the bundled catalog, with the keys of the catalog document at location, if any.
+
+    Raises:
+        ValueError: The catalog is not a JSON object with lists of resource types
+    """
+    with open(BUNDLED_CATALOG_PATH, 'rb') as f:
+        catalog = json.load(f)
+    catalog.update(read_document(location, 'resource type catalog document'))
+
+    resource_types = catalog.get('ResourceTypes', [])
+    unsupported = catalog.get('UnsupportedResourceTypes', {})
+    if not isinstance(resource_types, list) or not all(isinstance(item, str) for item in resource_types):
+        raise ValueError(f'ResourceTypes of resource type catalog {location or BUNDLED_CATALOG_PATH} is not a list of strings')
+    if not isinstance(unsupported, dict) or not all(
+            isinstance(types, list) and all(isinstance(item, str) for item in types) for types in unsupported.values()):
+        raise ValueError(f'UnsupportedResourceTypes of resource type catalog {location or BUNDLED_CATALOG_PATH} '
+                         'is not an object of lists of strings')
+    loaded = ResourceTypeCatalog(resource_types, unsupported, validation != WARN,
+                                 location or catalog.get('Source', BUNDLED_CATALOG_PATH))
+    logging.info('Resource type catalog %s: %d resource types, %d regions with unsupported types',
+                 loaded.source, len(loaded.resource_types), len(loaded.unsupported))
+    return loaded
+
+
+_CATALOG = DocumentCache('resource type catalog', load_catalog, (
+    ('RESOURCE_TYPE_CATALOG_DOCUMENT', ''), ('RESOURCE_TYPE_VALIDATION', ENFORCE)), CATALOG_REFRESH_SECONDS)
+
+
+def get_resource_type_catalog():
+    """
+    Return the resource type catalog of the container, loaded again when the environment changed
+    or after CATALOG_REFRESH_SECONDS. When loading again fails, the previous catalog is kept
+    until the next refresh.
+    """
+    return _CATALOG.get()
+
+
+def update_bundled_catalog(path=BUNDLED_CATALOG_PATH):
+    """
+    Write the resource types of the AWS Config API model of the installed botocore to the bundled
+    catalog, keeping its unsupported resource types per region. Return the number of types added and removed.
+    """
+    import botocore
+    import botocore.session
+    model = botocore.session.get_session().get_service_model('config')
+    resource_types = sorted(model.shape_for('ResourceType').enum)
+
+    with open(path) as f:
+        catalog = json.load(f)
+    previous = set(catalog.get('ResourceTypes', []))
+    catalog['Source'] = f'botocore {botocore.__version__}'
+    catalog['ResourceTypes'] = resource_types
+    with open(path, 'w') as f:
+        json.dump(catalog, f, indent=1)
+        f.write('\n')
+    return len(set(resource_types) - previous), len(previous - set(resource_types))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update', action='store_true', help='Regenerate the bundled resource types from the installed botocore')
+    parser.add_argument('resource_types', nargs='*', help='Resource types to look up in the catalog')
+    args = parser.parse_args(argv)
+
+    if args.update:
+        added, removed = update_bundled_catalog()
+        print(f'{BUNDLED_CATALOG_PATH}: {added} resource types added, {removed} removed')
+    catalog = get_resource_type_catalog()
+    for resource_type in args.resource_types:
+        if resource_type not in catalog.resource_types:
+            print(f'{resource_type}: unknown')
+        else:
+            regions = catalog.unsupported_regions(resource_type)
+            print(f'{resource_type}: ' + (f'not recorded in {", ".join(regions)}' if regions else 'recorded in every region'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+boto3 client pool shared by the Producer and Consumer Lambdas.
+
+boto3 is imported when the first client is created, and clients of the function's own role are
+created once per (service, region) and reused by every invocation of a warm container. Clients
+for assumed-role credentials are created from the same boto3 session, so service models and
+endpoint rules are loaded once per container instead of once per account.
+
+All clients use CLIENT_CONFIG: their calls go through call_with_retry.
+"""
+
+import os
+import threading
+
+from ct_configrecorder_throttling import CLIENT_CONFIG
+
+# boto3 sessions are not thread-safe, so clients are created one at a time
+_LOCK = threading.Lock()
+_SESSION = None
+_CLIENTS = {}  # (service, region) -> client
+
+
+def _get_session():
+    """
+    Return the boto3 session of the container; called with _LOCK held.
+    """
+    global _SESSION
+    if _SESSION is None:
+        import boto3
+        _SESSION = boto3.Session()
+    return _SESSION
+
+
+def get_client(service, region=None):
+    """
+    Return the pooled client of the function's own role for a service and region (default: AWS_REGION).
+    """
+    key = (service, region or os.getenv('AWS_REGION'))
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _CLIENTS[key] = _get_session().client(service, region_name=key[1], config=CLIENT_CONFIG)
+    return client
+
+
+def create_client(service, region, credentials):
+    """
+    Return a new client for temporary credentials, as returned by sts:AssumeRole. These clients
+    are not pooled: callers cache them with the credentials they were created for.
+    """
+    with _LOCK:
+        return _get_session().client(
+            service, region_name=region, config=CLIENT_CONFIG,
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'])
+
+
+def boto3_version():
+    """
+    Return the version of boto3, importing it if needed.
+    """
+    import boto3
+    return boto3.__version__
@@ -0,0 +1,186 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""
+JSON documents of the account selection, the recorder profiles and the resource type catalog,
+shared by the Producer and Consumer Lambdas.
+
+Each document is read from an S3 object (s3://bucket/key) or a local file and compiled once per
+container by a DocumentCache, which compiles it again when its environment variables change or
+after its own refresh interval, and keeps the previous compilation when that fails. The
+organizational unit rules of the account selection and the recorder profiles are resolved here
+with AWS Organizations, and accounts created or moved since are looked up with find_parent_unit.
+"""
+
+import fnmatch
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from ct_configrecorder_clients import get_client
+from ct_configrecorder_throttling import call_with_retry
+
+# Paths of organizational units start with the name of the root
+ROOT_PATH = 'Root'
+ORGANIZATIONAL_UNIT_ID = re.compile(r'^(r-[0-9a-z]{4,32}|ou-[0-9a-z]{4,32}-[a-z0-9]{8,32})$')
+
+
+class DocumentCache:
+    """
+    Compiled document of the container, compiled again when its environment changed or after
+    refresh_seconds. When compiling again fails, the previous compilation is kept until the
+    next refresh.
+
+    Args:
+        name (str): Name of the document, for the logs
+        compile (callable): Returns the compiled document from the values of the environment variables
+        environment (tuple): (environment variable, default) pairs the document is compiled from
+        refresh_seconds (int): Age after which a warm container compiles the document again
+    """
+
+    def __init__(self, name, compile, environment, refresh_seconds):
+        self.name = name
+        self.compile = compile
+        self.environment = tuple(environment)
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._cached = None  # (environment, monotonic time compiled, compiled document)
+
+    def get(self, max_age=None):
+        """
+        Return the compiled document, compiled again if it is older than max_age (default: refresh_seconds).
+        """
+        environment = tuple(os.getenv(name, default) for name, default in self.environment)
+        max_age = self.refresh_seconds if max_age is None else min(max_age, self.refresh_seconds)
+        cached = self._cached
+        if cached and cached[0] == environment and time.monotonic() - cached[1] < max_age:
+            return cached[2]
+        with self._lock:
+            now = time.monotonic()
+            cached = self._cached
+            if cached and cached[0] == environment and now - cached[1] < max_age:
+                return cached[2]
+            try:
+                compiled = self.compile(*environment)
+            except Exception as e:
+                if not cached or cached[0] != environment:
+                    raise
+                logging.error('Unable to compile the %s again, keeping the previous one: %s: %s',
+                              self.name, e.__class__.__name__, e)
+                compiled = cached[2]
+            self._cached = (environment, now, compiled)
+            return compiled
+
+
+def read_document(location, name='document'):
+    """
+    Return the JSON object at an s3://bucket/key location or a local path, or {} for no location.
+
+    Raises:
+        ValueError: The document is not a JSON object
+    """
+    if not location:
+        return {}
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        response = call_with_retry('s3', os.getenv('AWS_REGION'), get_client('s3').get_object, Bucket=bucket, Key=key)
+        body = response['Body'].read()
+    else:
+        with open(location[len('file://'):] if location.startswith('file://') else location, 'rb') as f:
+            body = f.read()
+
+    document = json.loads(body)
+    if not isinstance(document, dict):
+        raise ValueError(f'{name.capitalize()} {location} is not a JSON object')
+    return document
+
+
+def compile_patterns(patterns):
+    """
+    Return one regular expression matching any of the wildcard patterns, or None for no patterns.
+    """
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns)) if patterns else None
+
+
+def paginate(operation, key, **kwargs):
+    """
+    Yield the items of every page of an AWS Organizations list operation.
+    """
+    while True:
+        page = call_with_retry('organizations', os.getenv('AWS_REGION'), operation, **kwargs)
+        yield from page.get(key, [])
+        if not page.get('NextToken'):
+            return
+        kwargs['NextToken'] = page['NextToken']
+
+
+def resolve_organizational_units(rules, organizations_client=None):
+    """
+    Resolve organizational unit rules into the IDs of the matching OUs, with every OU below them,
+    and the IDs of their accounts. The whole OU tree is only walked for path rules.
+
+    Returns:
+        tuple: (organizational unit IDs (set), account IDs (set))
+    """
+    client = organizations_client or get_client('organizations')
+    unit_ids = {rule for rule in rules if ORGANIZATIONAL_UNIT_ID.match(rule)}
+    path_pattern = compile_patterns([rule.rstrip('/') for rule in rules if rule not in unit_ids])
+
+    if path_pattern is None:
+        stack = [(unit_id, None, True) for unit_id in unit_ids]
+    else:
+        stack = [(root['Id'], ROOT_PATH, False) for root in paginate(client.list_roots, 'Roots')]
+    selected_units = set()
+    while stack:
+        unit_id, path, selected = stack.pop()
+        selected = selected or unit_id in unit_ids or bool(path and path_pattern.match(path))
+        if selected:
+            selected_units.add(unit_id)
+        for child in paginate(client.list_organizational_units_for_parent, 'OrganizationalUnits', ParentId=unit_id):
+            stack.append((child['Id'], path and f'{path}/{child["Name"]}', selected))
+
+    accounts = set()
+    for unit_id in selected_units:
+        accounts.update(account['Id'] for account in paginate(client.list_accounts_for_parent, 'Accounts', ParentId=unit_id))
+    return selected_units, accounts
+
+
+def find_parent_unit(account_id, organizational_units, organizations_client=None):
+    """
+    Walk up the current parents of an account, for accounts created or moved since the rules were
+    compiled, and return the first of them in organizational_units, or None when none is.
+
+    Raises:
+        Exception: AWS Organizations cannot be reached
+    """
+    client = organizations_client or get_client('organizations')
+    child_id = account_id
+    while True:
+        parents = call_with_retry('organizations', os.getenv('AWS_REGION'), client.list_parents,
+                                  ChildId=child_id)['Parents']
+        if not parents:
+            return None
+        child_id = parents[0]['Id']
+        if child_id in organizational_units:
+            return child_id
+        if parents[0]['Type'] == 'ROOT':
+            return None
@@ -0,0 +1,285 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Metrics, trace and log helpers shared by the Producer and Consumer Lambdas.
+
+Metrics are written to stdout in CloudWatch Embedded Metric Format (EMF), so CloudWatch
+Logs extracts them without any PutMetricData calls or extra IAM permissions.
+
+Spans are written to stdout as JSON lines with a 'Span' name, the 'TraceId' of the event
+that caused them and their 'Start' and 'End' in epoch milliseconds; ct_configrecorder_traces.py
+rebuilds the critical path of each trace from them. Only a sample of the traces is written,
+chosen from the trace ID so that both Lambdas keep the same ones, and the traces with a failure.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ControlTowerConfigRecorderOverride')
+
+# EMF allows at most 100 values per metric in one document
+MAX_VALUES_PER_METRIC = 100
+
+# Set TRACE_SPANS=false to stop writing span records
+TRACE_SPANS = os.getenv('TRACE_SPANS', 'true').lower() != 'false'
+# Share of the traces whose spans are written, from 0 to 1; traces with a failure are always written
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+
+
+class Sanitized:
+    """
+    Log argument that removes line breaks from str(value), only when the record is formatted.
+
+    Example:
+        logging.info('Event: %s', Sanitized(event))
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value).replace(chr(10), '').replace(chr(13), '')
+
+
+class MetricsLogger:
+    """
+    Thread-safe collector of metric values, grouped by dimensions and written as EMF on flush().
+
+    Args:
+        function (str): Value of the 'Function' dimension added to every metric
+        stream: File the EMF documents are written to (default: stdout)
+    """
+
+    def __init__(self, function, namespace=NAMESPACE, stream=None):
+        self.function = function
+        self.namespace = namespace
+        self.stream = stream
+        self._metrics = {}
+        self._properties = {}
+        self._lock = threading.Lock()
+
+    def put(self, name, value, unit='Count', **dimensions):
+        """
+        Record one value of a metric for the given dimensions (in addition to 'Function').
+        """
+        key = tuple(sorted(dimensions.items()))
+        with self._lock:
+            metric = self._metrics.setdefault(key, {}).setdefault(name, (unit, []))
+            metric[1].append(value)
+
+    def count(self, name, value=1, **dimensions):
+        """
+        Add to a counter; all counts of a metric for the same dimensions are summed into one value.
+        """
+        key = tuple(sorted(dimensions.items()))
+        with self._lock:
+            metric = self._metrics.setdefault(key, {}).setdefault(name, ('Count', [0]))
+            metric[1][0] += value
+
+    def set_property(self, name, value):
+        """
+        Add a searchable, non-dimension field to every document of the next flush().
+        """
+        with self._lock:
+            self._properties[name] = value
+
+    @contextmanager
+    def timer(self, stage, **dimensions):
+        """
+        Record the duration of the block in milliseconds as the '<stage>Duration' metric.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put(f'{stage}Duration', (time.perf_counter() - start) * 1000, 'Milliseconds', **dimensions)
+
+    def clear(self):
+        """
+        Drop all recorded values and properties without writing them.
+        """
+        with self._lock:
+            self._metrics = {}
+            self._properties = {}
+
+    def flush(self):
+        """
+        Write all recorded values as EMF documents and reset the logger.
+        """
+        with self._lock:
+            metrics, self._metrics = self._metrics, {}
+            properties, self._properties = self._properties, {}
+
+        stream = self.stream or sys.stdout
+        timestamp = int(time.time() * 1000)
+        for key, values in metrics.items():
+            dimensions = dict(key, Function=self.function)
+            for offset in range(0, max(len(v[1]) for v in values.values()), MAX_VALUES_PER_METRIC):
+                document = dict(properties)
+                document.update(dimensions)
+                definitions = []
+                for name, (unit, points) in values.items():
+                    chunk = points[offset:offset + MAX_VALUES_PER_METRIC]
+                    if chunk:
+                        definitions.append({'Name': name, 'Unit': unit})
+                        document[name] = chunk if len(chunk) > 1 else chunk[0]
+                document['_aws'] = {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [sorted(dimensions)],
+                        'Metrics': definitions,
+                    }],
+                }
+                stream.write(json.dumps(document, default=str) + '\n')
+        stream.flush()
+
+
+class Tracer:
+    """
+    Thread-safe collector of span records, written as JSON lines on flush().
+
+    Spans take their attributes, including the 'TraceId', from the invocation (start())
+    and from the context() of the calling thread. Spans without a TraceId are not recorded.
+    Spans are only written for sampled traces and the traces passed to keep().
+
+    Args:
+        function (str): Value of the 'Function' attribute added to every span
+        stream: File the span records are written to (default: stdout)
+        sample_rate (float): Share of the traces written, from 0 to 1
+    """
+
+    def __init__(self, function, stream=None, enabled=TRACE_SPANS, sample_rate=TRACE_SAMPLE_RATE):
+        self.function = function
+        self.stream = stream
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.trace_id = None
+        self._spans = []
+        self._kept = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self, trace_id):
+        """
+        Set the TraceId of the spans of this invocation that have none in their context.
+        """
+        self.trace_id = trace_id
+
+    @contextmanager
+    def context(self, **attributes):
+        """
+        Add attributes to the spans recorded by the calling thread within the block.
+        """
+        previous = getattr(self._local, 'attributes', {})
+        self._local.attributes = dict(previous, **attributes)
+        try:
+            yield
+        finally:
+            self._local.attributes = previous
+
+    def bind(self, function, **attributes):
+        """
+        Return a callable running function within context(**attributes), for another thread.
+        """
+        def traced(*args, **kwargs):
+            with self.context(**attributes):
+                return function(*args, **kwargs)
+        return traced
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Record the block as a span.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time(), **attributes)
+
+    def sampled(self, trace_id):
+        """
+        Return True if the spans of the trace are written. The decision only depends on the trace ID,
+        so the Producer and Consumer Lambdas sample the same traces.
+        """
+        if self.sample_rate >= 1:
+            return True
+        if self.sample_rate <= 0 or not trace_id:
+            return False
+        digest = hashlib.sha256(str(trace_id).encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') < self.sample_rate * 2 ** 32
+
+    def keep(self, trace_id):
+        """
+        Write the spans of a trace on the next flush() even if it is not sampled, e.g. after a failure.
+        """
+        if trace_id:
+            with self._lock:
+                self._kept.add(trace_id)
+
+    def record(self, name, start, end, **attributes):
+        """
+        Record a span from start to end, in epoch seconds.
+        """
+        if not self.enabled:
+            return
+        span = {'TraceId': self.trace_id}
+        span.update(getattr(self._local, 'attributes', {}))
+        span.update(attributes)
+        if not span['TraceId']:
+            return
+        span.update(Span=name, Function=self.function, Start=round(start * 1000, 1), End=round(end * 1000, 1),
+                    DurationMs=round((end - start) * 1000, 1))
+        with self._lock:
+            self._spans.append(span)
+
+    def flush(self):
+        """
+        Write all recorded spans as JSON lines and reset the tracer.
+        """
+        with self._lock:
+            spans, self._spans = self._spans, []
+            kept, self._kept = self._kept, set()
+        written = {trace_id for trace_id in {span['TraceId'] for span in spans}
+                   if trace_id in kept or self.sampled(trace_id)}
+        spans = [span for span in spans if span['TraceId'] in written]
+        if not spans:
+            return
+        stream = self.stream or sys.stdout
+        for span in spans:
+            stream.write(json.dumps(span, default=str) + '\n')
+        stream.flush()
+
+
+def record_api_calls(metrics, rate_controller):
+    """
+    Move the API call counts of a RateController into the metrics logger, per service and result.
+    """
+    for (service, result), count in rate_controller.drain_call_counts().items():
+        metrics.count('ApiCalls', count, Service=service, Result=result)
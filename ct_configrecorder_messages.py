@@ -0,0 +1,183 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+SQS message schema shared by the Producer and Consumer Lambdas.
+
+Version 1 carries one account/region:
+    {"Account": "123456789012", "Region": "us-east-1", "Event": "controltower", "Operation": "..."}
+
+Version 2 carries an account with all of its regions, so the Consumer Lambda assumes the
+role once for all of them:
+    {"Version": 2, "Account": "123456789012", "Event": "controltower",
+     "Regions": [{"Region": "us-east-1", "Operation": "...", "Fingerprint": "..."}, ...]}
+
+Both versions may carry "Attempt" (retries of the Consumer Lambda), "TraceId" and "Profile",
+the ID of the recorder profile of the account, omitted for the default profile. Messages
+are decoded into the version 2 shape whatever their version, so the Consumer Lambda reads
+both during a rollout.
+
+The TraceId is also sent as the "TraceId" SQS message attribute, which the Consumer Lambda
+reads first.
+"""
+
+import json
+
+SCHEMA_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+
+# Optional message fields kept when a message is re-encoded for a subset of its regions
+MESSAGE_FIELDS = ('Attempt', 'TraceId', 'Profile')
+
+TRACE_ID_ATTRIBUTE = 'TraceId'
+
+
+class MessageFormatError(ValueError):
+    """
+    Raised for message bodies that are not a valid version 1 or version 2 message.
+    """
+
+
+def build_message(account, event, regions, operations=None, fingerprints=None, trace_id=None, profile=None):
+    """
+    Return a version 2 message for an account and its regions.
+
+    Args:
+        account (str): Account ID
+        event (str): Event type (e.g., 'Create', 'Update', 'Delete', 'controltower')
+        regions (list): Regions of the account
+        operations (dict): Optional region -> StackSet LastOperationId
+        fingerprints (dict): Optional region -> fingerprint of the desired recorder settings
+        trace_id (str): Optional ID correlating the message with the event that caused it
+        profile (str): Optional recorder profile ID of the account, None for the default profile
+
+    Returns:
+        dict: The message, to be sent with encode_message()
+    """
+    entries = []
+    for region in regions:
+        entry = {'Region': region}
+        if operations and operations.get(region):
+            entry['Operation'] = operations[region]
+        if fingerprints and fingerprints.get(region):
+            entry['Fingerprint'] = fingerprints[region]
+        entries.append(entry)
+    message = {'Version': SCHEMA_VERSION, 'Account': account, 'Event': event, 'Regions': entries}
+    if trace_id:
+        message['TraceId'] = trace_id
+    if profile:
+        message['Profile'] = profile
+    return message
+
+
+def with_regions(message, entries, **fields):
+    """
+    Return a copy of a message for a subset of its region entries, with fields added or replaced.
+    """
+    copy = {key: message[key] for key in ('Account', 'Event') + MESSAGE_FIELDS if key in message}
+    copy.update(Version=SCHEMA_VERSION, Regions=list(entries), **fields)
+    return copy
+
+
+def encode_message(message):
+    """
+    Return the SQS message body of a version 2 message.
+    """
+    return json.dumps(message, separators=(',', ':'))
+
+
+def encode_v1_messages(message):
+    """
+    Return one version 1 body per region of a version 2 message, for Consumer Lambdas
+    that only read version 1.
+    """
+    bodies = []
+    for entry in message['Regions']:
+        body = {'Account': message['Account'], 'Region': entry['Region'], 'Event': message['Event']}
+        if entry.get('Operation'):
+            body['Operation'] = entry['Operation']
+        body.update((key, message[key]) for key in MESSAGE_FIELDS if key in message)
+        bodies.append(json.dumps(body))
+    return bodies
+
+
+def decode_message(body):
+    """
+    Parse a version 1 or version 2 message body into the version 2 shape.
+
+    Raises:
+        MessageFormatError: The body is not valid JSON or misses required fields
+    """
+    try:
+        message = json.loads(body)
+        if not isinstance(message, dict):
+            raise MessageFormatError('message is not a JSON object')
+        version = message.get('Version', 1)
+        if version not in SUPPORTED_VERSIONS:
+            raise MessageFormatError(f'unsupported message version {version}')
+
+        decoded = {'Version': version, 'Account': str(message['Account']), 'Event': str(message['Event'])}
+        if version == 1:
+            entry = {'Region': str(message['Region'])}
+            if message.get('Operation'):
+                entry['Operation'] = message['Operation']
+            decoded['Regions'] = [entry]
+        else:
+            decoded['Regions'] = [dict(entry, Region=str(entry['Region'])) for entry in message['Regions']]
+            if not decoded['Regions']:
+                raise MessageFormatError('message has no regions')
+        decoded.update((key, message[key]) for key in MESSAGE_FIELDS if key in message)
+        decoded['Attempt'] = int(decoded.get('Attempt', 1))
+        return decoded
+    except MessageFormatError:
+        raise
+    except (ValueError, KeyError, TypeError) as e:
+        raise MessageFormatError(f'{e.__class__.__name__}: {e}') from e
+
+
+def message_attributes(trace_id):
+    """
+    Return the SQS MessageAttributes carrying a trace ID, or an empty dict without one.
+    """
+    if not trace_id:
+        return {}
+    return {TRACE_ID_ATTRIBUTE: {'DataType': 'String', 'StringValue': trace_id}}
+
+
+def record_trace_id(record, message=None):
+    """
+    Return the trace ID of an SQS record from its message attributes, or else from the decoded message.
+
+    Records of SQS events have 'messageAttributes' with 'stringValue'; messages of receive_message
+    have 'MessageAttributes' with 'StringValue'.
+    """
+    attributes = record.get('messageAttributes') or record.get('MessageAttributes') or {}
+    attribute = attributes.get(TRACE_ID_ATTRIBUTE) or {}
+    trace_id = attribute.get('stringValue') or attribute.get('StringValue')
+    if not trace_id and message:
+        trace_id = message.get('TraceId')
+    return trace_id
+
+
+def message_pairs(message):
+    """
+    Return the (account, region) pairs of a decoded message.
+    """
+    return [(message['Account'], entry['Region']) for entry in message['Regions']]
@@ -18,230 +18,619 @@
 # IN THE SOFTWARE.
 #
 
-import boto3
-import json
 import logging
 import botocore.exceptions
 import os
+import random
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+from datetime import datetime, timedelta, timezone
 
+from ct_configrecorder_clients import boto3_version, create_client, get_client
+from ct_configrecorder_instrumentation import MetricsLogger, Sanitized, Tracer, record_api_calls
+from ct_configrecorder_messages import (
+    MessageFormatError, decode_message, encode_message, message_attributes, record_trace_id, with_regions)
+from ct_configrecorder_profiles import get_recorder_profile
+from ct_configrecorder_recorder import (
+    DEFAULT_PROFILE, desired_fingerprint, recorder_matches, region_recorder_config, thaw)
+from ct_configrecorder_state import get_state_store
+from ct_configrecorder_throttling import RATE_CONTROLLER, call_with_retry, error_code, is_permanent_error
 
-def lambda_handler(event, context):
-    LOG_LEVEL = os.getenv('LOG_LEVEL')
-    logging.getLogger().setLevel(LOG_LEVEL)
+
+CONTROL_TOWER_EXECUTION_ROLE = 'AWSControlTowerExecution'
+# Assumed-role credentials are refreshed this long before their Expiration
+CREDENTIAL_REFRESH_MARGIN = timedelta(minutes=5)
+# Upper bounds for the warm-container caches, least recently used entries are evicted first.
+# Every client is created from the one boto3 session of ct_configrecorder_clients; sessions are
+# never cached per account. Accounts rarely come back before their credentials expire, so few
+# clients are kept, in proportion to the memory of the function: 64 at its default 128 MB, where
+# a batch of 10 accounts in 17 regions creates 170 of them
+CREDENTIALS_CACHE_MAX_SIZE = 128
+CLIENT_CACHE_MAX_SIZE = max(16, int(os.getenv('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '128')) // 2)
+# Account/region updates of one SQS batch are applied concurrently on this many threads
+MAX_REGION_WORKERS = 8
+
+# Single account events arrive on the priority lane, sweeps of all accounts on the sweep lane
+PRIORITY_LANE = 'priority'
+SWEEP_LANE = 'sweep'
+SQS_URL = os.getenv('SQS_URL')
+SQS_PRIORITY_URL = os.getenv('SQS_PRIORITY_URL')
+# Before its own batch, a sweep lane invocation processes up to this many batches of the priority lane
+PRIORITY_DRAIN_MAX_BATCHES = 3
+# Time kept for the sweep lane batch when draining the priority lane, on top of the estimated
+# time of its account/region updates, ACCOUNT_REGION_UPDATE_MILLIS each on MAX_REGION_WORKERS threads
+PRIORITY_DRAIN_RESERVE_MILLIS = 30000
+ACCOUNT_REGION_UPDATE_MILLIS = 2000
+# After finding the priority lane empty, a container does not poll it again for this long
+PRIORITY_POLL_INTERVAL_SECONDS = 5
+
+# Failed messages are sent again to their lane with an exponential delay, up to this many attempts in total;
+# permanent errors and messages out of attempts are quarantined in the failure ledger and the dead-letter queue
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '5'))
+RETRY_BASE_DELAY_SECONDS = int(os.getenv('RETRY_BASE_DELAY_SECONDS', '30'))
+# Longest DelaySeconds SQS accepts
+RETRY_MAX_DELAY_SECONDS = 900
+SQS_DEAD_LETTER_URL = os.getenv('SQS_DEAD_LETTER_URL')
+
+# Module-level state survives between invocations of a warm container; the clients of the
+# function's own role are pooled by ct_configrecorder_clients
+_CACHE_LOCK = threading.Lock()
+_CALLER_IDENTITY = None
+_PRIORITY_LANE_EMPTY_UNTIL = 0.0
+_CREDENTIALS_CACHE = OrderedDict()  # account_id -> (assumed-role credentials or None, expiration)
+_CLIENT_CACHE = OrderedDict()       # (account_id, region) -> (credentials, config client)
+_ASSUME_ROLE_LOCKS = {}             # account_id -> lock held while its role is assumed
+
+# Stage durations, queue lag and outcomes, written as Embedded Metric Format at the end of each invocation
+METRICS = MetricsLogger('Consumer')
+# Queue wait, assume role, describe and put spans, with the trace ID of the message that caused them
+TRACER = Tracer('Consumer')
+
+
+def get_caller_identity():
+    '''
+    Return the (account, partition) of the Lambda execution role, resolved once per container
+    '''
+    global _CALLER_IDENTITY
+    with _CACHE_LOCK:
+        if _CALLER_IDENTITY is None:
+            # Regional STS endpoint of the Lambda's own region (AWS_STS_REGIONAL_ENDPOINTS=regional)
+            # issues session tokens that are valid in every region, including opt-in regions
+            identity = call_with_retry('sts', os.getenv('AWS_REGION'), get_client('sts').get_caller_identity)
+            _CALLER_IDENTITY = (identity['Account'], identity['Arn'].split(':')[1])
+        return _CALLER_IDENTITY
+
+
+def assume_role(account_id, role=CONTROL_TOWER_EXECUTION_ROLE):
+    '''
+    Return the credentials of the Control Tower Role in the target account and the time they expire,
+    or (None, None) for the function's own account
+    '''
+    curr_account, part = get_caller_identity()
+    if curr_account == account_id:
+        return None, None
 
     try:
-        logging.info(f'Event: {str(event).replace(chr(10), "").replace(chr(13), "")}')
+        role_arn = 'arn:' + part + ':iam::' + account_id + ':role/' + role
+        ses_name = str(account_id + '-' + role)
+        response = call_with_retry('sts', os.getenv('AWS_REGION'), get_client('sts').assume_role,
+                                   RoleArn=role_arn, RoleSessionName=ses_name)
+    except botocore.exceptions.ClientError as exe:
+        logging.error('Unable to assume role')
+        raise exe
 
-        body = json.loads(event['Records'][0]['body'])
-        account_id = body['Account']
-        aws_region = body['Region']
-        event = body['Event']
+    return response['Credentials'], response['Credentials']['Expiration']
 
-        logging.info(f'Extracted Account: {str(account_id).replace(chr(10), "").replace(chr(13), "")}')
-        logging.info(f'Extracted Region: {str(aws_region).replace(chr(10), "").replace(chr(13), "")}')
-        logging.info(f'Extracted Event: {str(event).replace(chr(10), "").replace(chr(13), "")}')
 
-        bc = botocore.__version__
-        b3 = boto3.__version__
+def get_credentials(account_id):
+    '''
+    Return the cached credentials for the account, assuming the role again when they
+    are missing or about to expire
+    '''
+    credentials = cached_credentials(account_id)
+    if credentials is not False:
+        return credentials
+
+    # Threads of the same account wait for the one assuming the role instead of assuming it too
+    with _CACHE_LOCK:
+        account_lock = _ASSUME_ROLE_LOCKS.setdefault(account_id, threading.Lock())
+    try:
+        with account_lock:
+            credentials = cached_credentials(account_id)
+            if credentials is not False:
+                return credentials
+
+            with METRICS.timer('AssumeRole'), TRACER.span('assume_role'):
+                credentials, expiration = assume_role(account_id)
+            logging.info('Assumed role in account %s, credentials expire at %s', account_id, expiration)
+
+            with _CACHE_LOCK:
+                _CREDENTIALS_CACHE[account_id] = (credentials, expiration)
+                _CREDENTIALS_CACHE.move_to_end(account_id)
+                while len(_CREDENTIALS_CACHE) > CREDENTIALS_CACHE_MAX_SIZE:
+                    _CREDENTIALS_CACHE.popitem(last=False)
+            return credentials
+    finally:
+        with _CACHE_LOCK:
+            if _ASSUME_ROLE_LOCKS.get(account_id) is account_lock:
+                del _ASSUME_ROLE_LOCKS[account_id]
+
+
+def cached_credentials(account_id):
+    '''
+    Return the cached credentials for the account (None for the function's own account), or
+    False when they are missing or about to expire
+    '''
+    now = datetime.now(timezone.utc)
+    with _CACHE_LOCK:
+        cached = _CREDENTIALS_CACHE.get(account_id)
+        if cached and (cached[1] is None or cached[1] - CREDENTIAL_REFRESH_MARGIN > now):
+            _CREDENTIALS_CACHE.move_to_end(account_id)
+            return cached[0]
+    return False
 
-        logging.info(f'Botocore : {bc}')
-        logging.info(f'Boto3 : {b3}')
 
-        STS = boto3.client("sts", region_name=aws_region)
+def get_config_client(account_id, aws_region):
+    '''
+    Return a cached configservice client for the account and region, rebuilt
+    whenever the account's credentials have been refreshed
+    '''
+    credentials = get_credentials(account_id)
+    key = (account_id, aws_region)
+    with _CACHE_LOCK:
+        cached = _CLIENT_CACHE.get(key)
+        if cached and cached[0] is credentials:
+            _CLIENT_CACHE.move_to_end(key)
+            return cached[1]
 
-        def assume_role(account_id, role='AWSControlTowerExecution'):
-            '''
-            Return a session in the target account using Control Tower Role
-            '''
+    # Clients of the function's own account come from the pool
+    if credentials is None:
+        configservice = get_client('config', aws_region)
+    else:
+        configservice = create_client('config', aws_region, credentials)
+
+    with _CACHE_LOCK:
+        _CLIENT_CACHE[key] = (credentials, configservice)
+        _CLIENT_CACHE.move_to_end(key)
+        while len(_CLIENT_CACHE) > CLIENT_CACHE_MAX_SIZE:
+            _CLIENT_CACHE.popitem(last=False)
+    return configservice
+
+
+
+
+def lambda_handler(event, context):
+    LOG_LEVEL = os.getenv('LOG_LEVEL')
+    logging.getLogger().setLevel(LOG_LEVEL)
+
+    batch_item_failures = []
+    outcomes = Counter()
+
+    try:
+        logging.debug('Event: %s', Sanitized(event))
+        logging.info('Botocore : %s', botocore.__version__)
+        logging.info('Boto3 : %s', boto3_version())
+
+        records = event['Records']
+        lane = record_lane(records[0]) if records else SWEEP_LANE
+
+        # New accounts must not wait behind a sweep: serve the priority lane first. Its messages
+        # are deleted by the drain itself, so its errors never change the result of this batch
+        if lane == SWEEP_LANE and SQS_PRIORITY_URL:
             try:
-                curr_account = STS.get_caller_identity()['Account']
-                if curr_account != account_id:
-                    part = STS.get_caller_identity()['Arn'].split(":")[1]
-
-                    role_arn = 'arn:' + part + ':iam::' + account_id + ':role/' + role
-                    ses_name = str(account_id + '-' + role)
-                    response = STS.assume_role(RoleArn=role_arn, RoleSessionName=ses_name)
-                    sts_session = boto3.Session(
-                        aws_access_key_id=response['Credentials']['AccessKeyId'],
-                        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-                        aws_session_token=response['Credentials']['SessionToken'])
-
-                    return sts_session
-            except botocore.exceptions.ClientError as exe:
-                logging.error('Unable to assume role')
-                raise exe
-
-        sts_session = assume_role(account_id)
-        logging.info(f'Printing STS session: {sts_session}')
-
-        # Use the session and create a client for configservice
-        configservice = sts_session.client('config', region_name=aws_region)
-
-        # Describe configuration recorder
-        configrecorder = configservice.describe_configuration_recorders()
-        logging.info(f'Existing Configuration Recorder: {configrecorder}')
-
-        # Get the name of the existing recorder if it exists, otherwise use the default name
-        recorder_name = 'aws-controltower-BaselineConfigRecorder'
-        if configrecorder and 'ConfigurationRecorders' in configrecorder and len(configrecorder['ConfigurationRecorders']) > 0:
-            recorder_name = configrecorder['ConfigurationRecorders'][0]['name']
-            logging.info(f'Using existing recorder name: {recorder_name}')
-
-        # ControlTower created configuration recorder with name "aws-controltower-BaselineConfigRecorder" and we will update just that
-        try:
-            role_arn = 'arn:aws:iam::' + account_id + ':role/aws-service-role/config.amazonaws.com/AWSServiceRoleForConfig'
-
-            CONFIG_RECORDER_DAILY_RESOURCE_STRING = os.getenv('CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST', '')
-            CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST = CONFIG_RECORDER_DAILY_RESOURCE_STRING.split(
-                ',') if CONFIG_RECORDER_DAILY_RESOURCE_STRING != '' else []
-            
-            CONFIG_RECORDER_DAILY_GLOBAL_RESOURCE_STRING = os.getenv('CONFIG_RECORDER_OVERRIDE_DAILY_GLOBAL_RESOURCE_LIST', '')
-            CONFIG_RECORDER_DAILY_GLOBAL_RESOURCE_LIST = CONFIG_RECORDER_DAILY_GLOBAL_RESOURCE_STRING.split(
-                ',') if CONFIG_RECORDER_DAILY_GLOBAL_RESOURCE_STRING != '' else []
-            
-            # Get resource lists for both strategies
-            CONFIG_RECORDER_STRATEGY = os.getenv('CONFIG_RECORDER_STRATEGY', 'EXCLUSION')
-            
-            # Get exclusion list (original behavior)
-            CONFIG_RECORDER_EXCLUSION_RESOURCE_STRING = os.getenv('CONFIG_RECORDER_OVERRIDE_EXCLUDED_RESOURCE_LIST', '')
-            CONFIG_RECORDER_EXCLUSION_RESOURCE_LIST = CONFIG_RECORDER_EXCLUSION_RESOURCE_STRING.split(
-                ',') if CONFIG_RECORDER_EXCLUSION_RESOURCE_STRING != '' else []
-            
-            # Get inclusion list (new behavior)
-            CONFIG_RECORDER_INCLUSION_RESOURCE_STRING = os.getenv('CONFIG_RECORDER_OVERRIDE_INCLUDED_RESOURCE_LIST', '')
-            CONFIG_RECORDER_INCLUSION_RESOURCE_LIST = CONFIG_RECORDER_INCLUSION_RESOURCE_STRING.split(
-                ',') if CONFIG_RECORDER_INCLUSION_RESOURCE_STRING != '' else []
-            
-            CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY = os.getenv('CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY')
-
-            # For exclusion strategy, remove any resource type from daily list that are in exclusion list
-            if CONFIG_RECORDER_STRATEGY == 'EXCLUSION':
-                res = [x for x in CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST if x not in CONFIG_RECORDER_EXCLUSION_RESOURCE_LIST]
-                CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST[:] = res
-            else:  # For inclusion strategy, make sure all daily resources are in the inclusion list
-                for resource_type in CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST:
-                    if resource_type not in CONFIG_RECORDER_INCLUSION_RESOURCE_LIST:
-                        CONFIG_RECORDER_INCLUSION_RESOURCE_LIST.append(resource_type)
-
-            # Event = Delete is when stack is deleted, we rollback changed made and leave it as ControlTower Intended
-            home_region = os.getenv('CONTROL_TOWER_HOME_REGION') == aws_region
-            if home_region:
-                CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST += CONFIG_RECORDER_DAILY_GLOBAL_RESOURCE_LIST
-
-            if event == 'Delete':
-                response = configservice.put_configuration_recorder(
-                    ConfigurationRecorder={
-                        'name': recorder_name,
-                        'roleARN': role_arn,
-                        'recordingGroup': {
-                            'allSupported': True,
-                            'includeGlobalResourceTypes': home_region
-                        }
-                    })
-                logging.warning(
-                    f"Configuration Recorder reset to default. Response: {json.dumps(response, default=str)}"
-                )
-            else:
-                if CONFIG_RECORDER_STRATEGY == 'EXCLUSION':
-                    # Original exclusion-based code - EXACTLY as in the working version
-                    logging.info(f'Using EXCLUSION strategy')
-                    logging.info(f'Exclusion resource list: {CONFIG_RECORDER_EXCLUSION_RESOURCE_LIST}')
-                    logging.info(f'Daily override resource list: {CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST}')
-                    
-                    config_recorder = {
-                        'name': recorder_name,
-                        'roleARN': role_arn,
-                        'recordingGroup': {
-                            'allSupported': False,
-                            'includeGlobalResourceTypes': False,
-                            'exclusionByResourceTypes': {
-                                'resourceTypes': CONFIG_RECORDER_EXCLUSION_RESOURCE_LIST
-                            },
-                            'recordingStrategy': {
-                                'useOnly': 'EXCLUSION_BY_RESOURCE_TYPES'
-                            }
-                        },
-                        'recordingMode': {
-                            'recordingFrequency': CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY,
-                            'recordingModeOverrides': [
-                                {
-                                    'description': 'DAILY_OVERRIDE',
-                                    'resourceTypes': CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST,
-                                    'recordingFrequency': 'DAILY'
-                                }
-                            ] if CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST else []
-                        }
-                    }
-
-                    if not CONFIG_RECORDER_EXCLUSION_RESOURCE_LIST:
-                        config_recorder['recordingGroup'].pop('exclusionByResourceTypes')
-                        config_recorder['recordingGroup'].pop('recordingStrategy')
-                        config_recorder['recordingGroup']['allSupported'] = True
-                        config_recorder['recordingGroup']['includeGlobalResourceTypes'] = True
-                else:
-                    # New inclusion-based code
-                    logging.info(f'Using INCLUSION strategy')
-                    # Make sure all resources in daily overrides are also in the inclusion list
-                    for resource_type in CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST:
-                        if resource_type not in CONFIG_RECORDER_INCLUSION_RESOURCE_LIST:
-                            CONFIG_RECORDER_INCLUSION_RESOURCE_LIST.append(resource_type)
-   
-                    logging.info(f'Inclusion resource list: {CONFIG_RECORDER_INCLUSION_RESOURCE_LIST}')
-                    logging.info(f'Daily override resource list: {CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST}')
-                    
-                    config_recorder = {
-                        'name': recorder_name,
-                        'roleARN': role_arn
-                    }
-                    
-                    # Set up recording group
-                    if not CONFIG_RECORDER_INCLUSION_RESOURCE_LIST:
-                        config_recorder['recordingGroup'] = {
-                            'allSupported': False,
-                            'includeGlobalResourceTypes': False
-                        }
-                    else:
-                        config_recorder['recordingGroup'] = {
-                            'allSupported': False,
-                            'includeGlobalResourceTypes': False,
-                            'resourceTypes': CONFIG_RECORDER_INCLUSION_RESOURCE_LIST,
-                            'recordingStrategy': {
-                                'useOnly': 'INCLUSION_BY_RESOURCE_TYPES'
-                            }
-                        }
-                    
-                    # Set up recording mode only if we have daily overrides
-                    if CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST:
-                        config_recorder['recordingMode'] = {
-                            'recordingFrequency': CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY,
-                            'recordingModeOverrides': [
-                                {
-                                    'description': 'DAILY_OVERRIDE',
-                                    'resourceTypes': CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST,
-                                    'recordingFrequency': 'DAILY'
-                                }
-                            ]
-                        }
-
-                response = configservice.put_configuration_recorder(
-                    ConfigurationRecorder=config_recorder)
-                logging.info(f'Response for put_configuration_recorder :{response} ')
-
-            # lets describe for configuration recorder after the update
-            configrecorder = configservice.describe_configuration_recorders()
-            logging.info(f'Post Change Configuration recorder : {configrecorder}')
-
-        except botocore.exceptions.ClientError as exe:
-            logging.error('Unable to Update Config Recorder for Account and Region : ', account_id, aws_region)
-            configrecorder = configservice.describe_configuration_recorders()
-            logging.info(f'Exception : {configrecorder}')
-            raise exe
-
-        return {
-            'statusCode': 200
-        }
+                drain_priority_lane(context, outcomes, sweep_reserve_millis(records))
+            except Exception as e:
+                logging.exception(f'Unable to drain the priority lane: {e.__class__.__name__}: {e}')
+                METRICS.count('PriorityDrainErrors')
+
+        batch_item_failures = process_records(records, lane, outcomes)
 
     except Exception as e:
         exception_type = e.__class__.__name__
         exception_message = str(e)
         logging.exception(f'{exception_type}: {exception_message}')
+        # The outcome of the records is unknown, so all of them are returned to the queue;
+        # the updates of the records that did finish are applied again, as they are idempotent
+        batch_item_failures = [{'itemIdentifier': record['messageId']}
+                               for record in (event or {}).get('Records') or [] if record.get('messageId')]
+
+    logging.info('Processed %d records: %d unchanged, %d updated, %d reset, %d retried, %d quarantined, %d failed',
+                 sum(outcomes.values()), outcomes['unchanged'], outcomes['updated'], outcomes['reset'],
+                 outcomes['retried'], outcomes['quarantined'], outcomes['failed'])
+    record_api_calls(METRICS, RATE_CONTROLLER)
+    METRICS.flush()
+    TRACER.flush()
+
+    # Only the failed records are returned to the queue (ReportBatchItemFailures)
+    return {
+        'batchItemFailures': batch_item_failures
+    }
+
+
+def record_lane(record):
+    '''
+    Return the lane of an SQS record from the queue it was received from
+    '''
+    if SQS_PRIORITY_URL and record.get('eventSourceARN', '').rsplit(':', 1)[-1] == SQS_PRIORITY_URL.rsplit('/', 1)[-1]:
+        return PRIORITY_LANE
+    return SWEEP_LANE
+
+
+def sweep_reserve_millis(records):
+    '''
+    Return the time to keep for a sweep lane batch: PRIORITY_DRAIN_RESERVE_MILLIS and the
+    estimated time of its account/region updates
+    '''
+    account_regions = 0
+    for record in records:
+        try:
+            account_regions += len(decode_message(record['body'])['Regions'])
+        except (MessageFormatError, KeyError):
+            account_regions += 1
+    rounds = -(-account_regions // MAX_REGION_WORKERS)
+    return PRIORITY_DRAIN_RESERVE_MILLIS + rounds * ACCOUNT_REGION_UPDATE_MILLIS
+
+
+def drain_priority_lane(context, outcomes, reserve_millis=PRIORITY_DRAIN_RESERVE_MILLIS):
+    '''
+    Receive and process batches of the priority lane until it is empty, deleting the messages
+    that succeeded, as long as more than reserve_millis are left for the sweep lane batch.
+    Failed messages become visible again after the visibility timeout
+    '''
+    global _PRIORITY_LANE_EMPTY_UNTIL
+    if time.monotonic() < _PRIORITY_LANE_EMPTY_UNTIL:
+        return
+
+    sqs_client = get_client('sqs')
+    for _ in range(PRIORITY_DRAIN_MAX_BATCHES):
+        if context is not None and context.get_remaining_time_in_millis() < reserve_millis:
+            return
+        response = call_with_retry('sqs', os.getenv('AWS_REGION'), sqs_client.receive_message,
+                                   QueueUrl=SQS_PRIORITY_URL, MaxNumberOfMessages=10, WaitTimeSeconds=0,
+                                   AttributeNames=['SentTimestamp', 'ApproximateReceiveCount'],
+                                   MessageAttributeNames=['TraceId'])
+        messages = response.get('Messages', [])
+        if not messages:
+            # Skip the receive call in the next sweep batches of this container
+            _PRIORITY_LANE_EMPTY_UNTIL = time.monotonic() + PRIORITY_POLL_INTERVAL_SECONDS
+            return
+
+        # Same shape as the records of an SQS event
+        records = [{
+            'messageId': message['MessageId'],
+            'receiptHandle': message['ReceiptHandle'],
+            'body': message['Body'],
+            'attributes': message.get('Attributes', {}),
+            'messageAttributes': message.get('MessageAttributes', {}),
+        } for message in messages]
+        logging.info('Draining %d messages of the priority lane', len(records))
+        METRICS.count('PriorityMessagesDrained', len(records))
+
+        failed = {item['itemIdentifier'] for item in process_records(records, PRIORITY_LANE, outcomes)}
+        entries = [{'Id': str(index), 'ReceiptHandle': record['receiptHandle']}
+                   for index, record in enumerate(records) if record['messageId'] not in failed]
+        if entries:
+            response = call_with_retry('sqs', os.getenv('AWS_REGION'), sqs_client.delete_message_batch,
+                                       QueueUrl=SQS_PRIORITY_URL, Entries=entries)
+            for failure in response.get('Failed', []):
+                # The message is processed again once visible; the update is idempotent
+                logging.warning('Unable to delete priority message: %s', failure.get('Code'))
+
+
+def process_records(records, lane, outcomes):
+    '''
+    Apply the recorder settings for a batch of SQS records, counting the outcomes per account/region,
+    and return the batchItemFailures of the records that failed and could not be retried or quarantined.
+    The spans of each account/region carry the trace ID and the ID of its message
+    '''
+    batch_item_failures = []
+
+    # Group the messages by account so the role is assumed once for every region of the account
+    messages_by_account = OrderedDict()
+    received = time.time()
+    now_millis = int(received * 1000)
+    for record in records:
+        sent_timestamp = record.get('attributes', {}).get('SentTimestamp')
+        if sent_timestamp:
+            METRICS.put('QueueLag', max(0, now_millis - int(sent_timestamp)), 'Milliseconds', Lane=lane)
+        try:
+            message = decode_message(record['body'])
+        except (MessageFormatError, KeyError) as e:
+            # A malformed message will never succeed, so it is logged and not redelivered
+            logging.error('Discarding malformed message %s: %s: %s', record.get('messageId'), e.__class__.__name__, e)
+            METRICS.count('Records', Outcome='malformed')
+            continue
+        METRICS.count('Messages', Version=str(message['Version']))
+        trace_id = record_trace_id(record, message)
+        if trace_id:
+            message['TraceId'] = trace_id
+        if sent_timestamp:
+            TRACER.record('queue_wait', int(sent_timestamp) / 1000, received, TraceId=trace_id,
+                          MessageId=record.get('messageId'), Account=message['Account'], Attempt=message['Attempt'], Lane=lane)
+        messages_by_account.setdefault(message['Account'], []).append((record, message))
+
+    # Account/regions applied or quarantined, whose pending markers are released
+    finished = []
+    # Errors of the failed regions, per message ID
+    errors = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=MAX_REGION_WORKERS) as executor:
+        for account_id, account_messages in messages_by_account.items():
+            logging.info('Extracted Account: %s', Sanitized(account_id))
+            try:
+                # The role is assumed once for every message of the account; its span goes to the first one
+                first_record, first_message = account_messages[0]
+                with TRACER.context(TraceId=first_message.get('TraceId'), MessageId=first_record.get('messageId'), Account=account_id):
+                    get_credentials(account_id)
+            except Exception as e:
+                logging.exception(f'{e.__class__.__name__}: {e}')
+                for record, message in account_messages:
+                    errors[record['messageId']] = {entry['Region']: e for entry in message['Regions']}
+                continue
+
+            for record, message in account_messages:
+                try:
+                    # Parsed once per container; the payload of each profile is memoized
+                    profile = get_recorder_profile(message.get('Profile'))
+                except Exception as e:
+                    logging.error('Unable to read recorder profile %s of message %s: %s: %s', Sanitized(message.get('Profile')),
+                                  record.get('messageId'), e.__class__.__name__, e)
+                    errors[record['messageId']] = {entry['Region']: e for entry in message['Regions']}
+                    continue
+                for entry in message['Regions']:
+                    check_fingerprint(account_id, entry, message['Event'], profile)
+                    traced_update = TRACER.bind(update_config_recorder, TraceId=message.get('TraceId'), MessageId=record.get('messageId'),
+                                                Account=account_id, Region=entry['Region'])
+                    future = executor.submit(traced_update, account_id, entry['Region'], message['Event'], entry.get('Operation'), profile)
+                    futures[future] = (record, account_id, entry['Region'])
+
+        for future in as_completed(futures):
+            record, account_id, aws_region = futures[future]
+            try:
+                outcome = future.result()
+            except Exception as e:
+                exception_type = e.__class__.__name__
+                exception_message = str(e)
+                logging.exception(f'{exception_type}: {exception_message}')
+                errors.setdefault(record['messageId'], {})[aws_region] = e
+                continue
+            # Time from the Producer sending the message to the recorder being up to date
+            sent_timestamp = record.get('attributes', {}).get('SentTimestamp')
+            if sent_timestamp:
+                METRICS.put('TimeToApply', max(0, int(time.time() * 1000) - int(sent_timestamp)),
+                            'Milliseconds', Lane=lane)
+            outcomes[outcome] += 1
+            record_outcome(account_id, aws_region, outcome)
+            finished.append((account_id, aws_region))
+
+    # Only the failed regions of a message are retried or quarantined
+    for account_messages in messages_by_account.values():
+        for record, message in account_messages:
+            if record['messageId'] not in errors:
+                continue
+            # The spans of a trace with a failure are written even if the trace is not sampled
+            TRACER.keep(message.get('TraceId'))
+            region_outcomes = handle_failures(record, message, lane, errors[record['messageId']])
+            for aws_region, outcome in region_outcomes.items():
+                outcomes[outcome] += 1
+                record_outcome(message['Account'], aws_region, outcome)
+                if outcome == 'quarantined':
+                    finished.append((message['Account'], aws_region))
+            if 'failed' in region_outcomes.values():
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+
+    release_pending(finished)
+    return batch_item_failures
+
+
+def release_pending(pairs):
+    '''
+    Delete the pending markers of the account/regions this function is done with, applied or
+    quarantined, so the next event for them is enqueued again instead of coalesced with work
+    that is no longer in the queue. Retried and redelivered account/regions stay pending
+    '''
+    state_store = get_state_store()
+    if state_store is None or not pairs:
+        return
+    try:
+        state_store.delete_pending(pairs)
+    except Exception as e:
+        # The markers expire after the coalescing window of the Producer
+        logging.warning('Unable to release %d pending markers: %s: %s', len(pairs), e.__class__.__name__, e)
+
+
+def check_fingerprint(account_id, entry, event, profile=DEFAULT_PROFILE):
+    '''
+    Warn when the Producer fingerprinted other settings than the ones this function applies,
+    which happens when both functions are not deployed with the same recorder settings or profiles
+    '''
+    if entry.get('Fingerprint') and entry['Fingerprint'] != desired_fingerprint(entry['Region'], event, profile):
+        logging.warning('Producer and Consumer recorder settings differ for Account and Region : %s %s',
+                        account_id, entry['Region'])
+        METRICS.count('FingerprintMismatches')
+
+
+def record_outcome(account_id, aws_region, outcome):
+    '''
+    Count the outcome of one account/region per region. Failures are counted per region and logged
+    with their account, as a metric per account would create one custom metric per account/region
+    '''
+    METRICS.count('Records', Outcome=outcome)
+    METRICS.count('Records', Region=aws_region, Outcome=outcome)
+    if outcome in ('failed', 'quarantined'):
+        METRICS.count('FailedRecords', Region=aws_region)
+        logging.error('Record %s for Account and Region : %s %s', outcome, account_id, aws_region)
+
+
+def handle_failures(record, message, lane, errors):
+    '''
+    Send the failed regions of a message again with an exponential delay, and quarantine the
+    ones that failed with a permanent error or are out of attempts. Return the outcome of each
+    failed region: 'retried', 'quarantined', or 'failed' when neither was possible and SQS
+    must redeliver the whole message
+    '''
+    attempt = message['Attempt']
+    retry, quarantined = [], {}
+    for aws_region, error in errors.items():
+        METRICS.count('Errors', ErrorCode=error_code(error) or error.__class__.__name__)
+        if is_permanent_error(error) or attempt >= RETRY_MAX_ATTEMPTS:
+            quarantined[aws_region] = error
+        else:
+            retry.append(aws_region)
+
+    entries = {entry['Region']: entry for entry in message['Regions']}
+    try:
+        if retry and not schedule_retry(message, [entries[aws_region] for aws_region in retry], lane, attempt):
+            quarantined.update((aws_region, errors[aws_region]) for aws_region in retry)
+            retry = []
+        if quarantined and not quarantine(message, [entries[aws_region] for aws_region in quarantined], quarantined, attempt):
+            return dict.fromkeys(errors, 'failed')
+    except Exception as e:
+        logging.warning('Unable to retry or quarantine message %s, leaving it to SQS: %s: %s',
+                        record.get('messageId'), e.__class__.__name__, e)
+        return dict.fromkeys(errors, 'failed')
+
+    region_outcomes = dict.fromkeys(retry, 'retried')
+    region_outcomes.update(dict.fromkeys(quarantined, 'quarantined'))
+    return region_outcomes
+
+
+def retry_delay(attempt):
+    '''
+    Return the DelaySeconds before the next attempt: exponential backoff with equal jitter
+    '''
+    backoff = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)))
+    return int(backoff / 2 + random.uniform(0, backoff / 2))
+
+
+def schedule_retry(message, entries, lane, attempt):
+    '''
+    Send the region entries of a message again to its lane, delayed, with the next attempt number.
+    Return False when the queue URL of the lane is not configured
+    '''
+    queue_url = SQS_PRIORITY_URL if lane == PRIORITY_LANE else SQS_URL
+    if not queue_url:
+        return False
+    delay = retry_delay(attempt)
+    call_with_retry('sqs', os.getenv('AWS_REGION'), get_client('sqs').send_message, QueueUrl=queue_url,
+                    MessageBody=encode_message(with_regions(message, entries, Attempt=attempt + 1)), DelaySeconds=delay,
+                    MessageAttributes=message_attributes(message.get('TraceId')))
+    logging.warning('Attempt %d for Account %s failed in %d region(s), retrying in %d seconds',
+                    attempt, message['Account'], len(entries), delay)
+    return True
+
+
+def quarantine(message, entries, errors, attempts):
+    '''
+    Record region entries that are not retried in the failure ledger and send them to the dead-letter
+    queue, for inspection and re-drive by the Producer. Return False when neither is configured
+    '''
+    state_store = get_state_store()
+    if state_store is None and not SQS_DEAD_LETTER_URL:
+        return False
+    codes = {aws_region: error_code(error) or error.__class__.__name__ for aws_region, error in errors.items()}
+    if state_store is not None:
+        for entry in entries:
+            state_store.put_failure(message['Account'], entry['Region'], message['Event'], entry.get('Operation'),
+                                    codes[entry['Region']], str(errors[entry['Region']]), attempts)
+    if SQS_DEAD_LETTER_URL:
+        failed_entries = [dict(entry, ErrorCode=codes[entry['Region']], ErrorMessage=str(errors[entry['Region']])[:1024])
+                          for entry in entries]
+        call_with_retry('sqs', os.getenv('AWS_REGION'), get_client('sqs').send_message, QueueUrl=SQS_DEAD_LETTER_URL,
+                        MessageBody=encode_message(with_regions(message, failed_entries, Attempt=attempts)))
+    logging.error('Quarantined Account %s in %d region(s) after %d attempt(s): %s',
+                  message['Account'], len(entries), attempts, ', '.join(sorted(set(codes.values()))))
+    return True
+
+
+def record_applied_state(account_id, aws_region, event, operation, profile=DEFAULT_PROFILE):
+    '''
+    Save the fingerprint of the settings applied for the event, so the Producer can skip the
+    account and region until the settings or the StackSet operation change
+    '''
+    state_store = get_state_store()
+    if state_store is None:
+        return
+    try:
+        state_store.put(account_id, aws_region, desired_fingerprint(aws_region, event, profile), operation)
+    except Exception as e:
+        # The recorder is up to date; a missing record only means it is enqueued again next time
+        logging.warning('Unable to save the applied state for Account and Region : %s %s: %s: %s',
+                        account_id, aws_region, e.__class__.__name__, e)
+
+
+def describe_recorder(configservice, aws_region):
+    '''
+    Return the configuration recorder of the region, or None when there is none
+    '''
+    with METRICS.timer('Describe'), TRACER.span('describe'):
+        configrecorder = call_with_retry('config', aws_region, configservice.describe_configuration_recorders)
+    logging.debug('Existing Configuration Recorder: %s', configrecorder)
+    recorders = (configrecorder or {}).get('ConfigurationRecorders') or []
+    return recorders[0] if recorders else None
+
+
+def desired_recorder(account_id, aws_region, event, existing_recorder=None, profile=DEFAULT_PROFILE):
+    '''
+    Return the configuration recorder of a recorder profile to write for the event, keeping the name of the existing recorder.
+    Included resource types the region does not record are left out
+    '''
+    # ControlTower created configuration recorder with name "aws-controltower-BaselineConfigRecorder" and we will update just that
+    recorder_name = existing_recorder['name'] if existing_recorder else 'aws-controltower-BaselineConfigRecorder'
+    role_arn = 'arn:aws:iam::' + account_id + ':role/aws-service-role/config.amazonaws.com/AWSServiceRoleForConfig'
+    return {
+        'name': recorder_name,
+        'roleARN': role_arn,
+        **thaw(region_recorder_config(profile, aws_region, event))
+    }
+
+
+def update_config_recorder(account_id, aws_region, event, operation=None, profile=DEFAULT_PROFILE):
+    '''
+    Apply the configuration recorder settings of a recorder profile for the event to one account and region
+    and return the outcome: 'unchanged', 'updated' or 'reset'. The StackSet operation of
+    the message, if any, is saved with the applied state
+    '''
+    logging.info('Extracted Region: %s', Sanitized(aws_region))
+    logging.info('Extracted Event: %s', Sanitized(event))
+
+    # Use the cached credentials and configservice client for the account and region
+    configservice = get_config_client(account_id, aws_region)
+    existing_recorder = describe_recorder(configservice, aws_region)
+    if existing_recorder:
+        logging.info('Using existing recorder name: %s', existing_recorder['name'])
+
+    try:
+        outcome = 'reset' if event == 'Delete' else 'updated'
+        config_recorder = desired_recorder(account_id, aws_region, event, existing_recorder, profile)
+
+        # Skip the write and the post-change describe when the recorder already matches
+        if existing_recorder and recorder_matches(existing_recorder, config_recorder):
+            logging.info('Configuration Recorder already up to date for Account and Region : %s %s', account_id, aws_region)
+            record_applied_state(account_id, aws_region, event, operation, profile)
+            return 'unchanged'
+
+        with METRICS.timer('Put'), TRACER.span('put'):
+            response = call_with_retry('config', aws_region, configservice.put_configuration_recorder,
+                                       ConfigurationRecorder=config_recorder)
+        # Every outcome is logged at the same level, so the result of each message is visible
+        if outcome == 'reset':
+            logging.info('Configuration Recorder reset to default for Account and Region : %s %s', account_id, aws_region)
+        else:
+            logging.info('Configuration Recorder updated for Account and Region : %s %s', account_id, aws_region)
+        logging.debug('Response for put_configuration_recorder : %s', response)
+
+        # lets describe for configuration recorder after the update
+        with METRICS.timer('PostDescribe'), TRACER.span('describe'):
+            configrecorder = call_with_retry('config', aws_region, configservice.describe_configuration_recorders)
+        logging.debug('Post Change Configuration recorder : %s', configrecorder)
+
+    except botocore.exceptions.ClientError as exe:
+        # Retries already happened in call_with_retry, no further Config calls are made for this message
+        logging.error('Unable to Update Config Recorder for Account and Region : %s %s', account_id, aws_region)
+        raise exe
+
+    record_applied_state(account_id, aws_region, event, operation, profile)
+    return outcome
@@ -19,120 +19,151 @@
 # IN THE SOFTWARE.
 #
 
-import boto3
 import cfnresponse
 import os
 import logging
-import ast
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-def should_process_account(account_id, selection_mode, excluded_accounts, included_accounts):
-    """
-    Determine if an account should be processed based on selection mode.
-    
-    Args:
-        account_id (str): AWS account ID to check (e.g., '123456789012')
-        selection_mode (str): Either 'EXCLUSION' or 'INCLUSION'
-        excluded_accounts (list): List of account ID strings to exclude (used in EXCLUSION mode)
-        included_accounts (list): List of account ID strings to include (used in INCLUSION mode)
-    
-    Returns:
-        bool: True if account should be processed, False otherwise
-    
-    Example:
-        should_process_account('123456789012', 'INCLUSION', [], ['123456789012', '234567890123'])
-        # Returns True because account is in the inclusion list
-    """
-    if selection_mode == 'INCLUSION':
-        # In inclusion mode, only process accounts in the included list
-        should_process = account_id in included_accounts
-        if should_process:
-            logging.info(f'Account {account_id} included (in inclusion list)')
-        else:
-            logging.info(f'Account {account_id} excluded (not in inclusion list)')
-        return should_process
-    else:  # EXCLUSION mode (default)
-        # In exclusion mode, process all accounts except those in excluded list
-        should_process = account_id not in excluded_accounts
-        if should_process:
-            logging.info(f'Account {account_id} included (not in exclusion list)')
-        else:
-            logging.info(f'Account {account_id} excluded (in exclusion list)')
-        return should_process
+from ct_configrecorder_catalog import get_resource_type_catalog
+from ct_configrecorder_clients import get_client
+from ct_configrecorder_instrumentation import MetricsLogger, Sanitized, Tracer, record_api_calls
+from ct_configrecorder_messages import (
+    build_message, decode_message, encode_message, encode_v1_messages, message_attributes, message_pairs)
+from ct_configrecorder_profiles import get_recorder_profiles, validate_resource_types
+from ct_configrecorder_recorder import DEFAULT_PROFILE_ID, desired_fingerprint
+from ct_configrecorder_selection import AccountSelector, get_account_selector
+from ct_configrecorder_state import get_state_store
+from ct_configrecorder_throttling import RATE_CONTROLLER, call_with_retry
+
+# send_message_batch accepts at most 10 entries per call
+SQS_BATCH_SIZE = 10
+# Number of send_message_batch calls kept in flight at once
+SQS_MAX_INFLIGHT_BATCHES = 8
+# Attempts per batch, including the first one; only failed entries are retried
+SQS_MAX_SEND_ATTEMPTS = 3
+SQS_RETRY_BASE_DELAY_SECONDS = 0.2
+
+AWS_REGION = os.getenv('AWS_REGION')
+
+STACK_SET_NAME = 'AWSControlTowerBP-BASELINE-CONFIG'
+# Time kept in reserve to checkpoint a sweep and respond to CloudFormation before the Lambda timeout
+SWEEP_TIME_RESERVE_MILLIS = 30000
+# Fields of the stack instance summaries carried over to the next page
+STACK_INSTANCE_FIELDS = ('Account', 'Region', 'LastOperationId')
+
+# INCREMENTAL only enqueues the account/regions whose applied state is out of date, FULL enqueues all of them
+RECONCILIATION_MODE = os.getenv('RECONCILIATION_MODE', 'INCREMENTAL')
+# Sweeps that may skip up-to-date account/regions; first runs, deletions and single account events never do
+INCREMENTAL_EVENTS = ('controltower', 'Update')
+# Work identical to work enqueued less than this many seconds ago is not enqueued again (0 disables coalescing)
+COALESCING_WINDOW_SECONDS = int(os.getenv('COALESCING_WINDOW_SECONDS', '600'))
+# Version 2 sends one message per account with all of its regions; 1 sends one message per account/region
+MESSAGE_VERSION = int(os.getenv('MESSAGE_VERSION', '2'))
+
+# Stage durations and fan-out counts, written as Embedded Metric Format at the end of each invocation
+METRICS = MetricsLogger('Producer')
+# Spans of the invocation, correlated with the Consumer Lambda spans by the trace ID sent with every message
+TRACER = Tracer('Producer')
 
 def lambda_handler(event, context):
     
     LOG_LEVEL = os.getenv('LOG_LEVEL')
     logging.getLogger().setLevel(LOG_LEVEL)
+    invocation_start = time.time()
+    selector = None
 
     try:
-        logging.info('Event Data: ')
-        logging.info(event)
+        logging.info('Event Data: %s', Sanitized(event))
+        TRACER.start(get_trace_id(event, context))
+        logging.info('Trace ID: %s', Sanitized(TRACER.trace_id))
         sqs_url = os.getenv('SQS_URL')
+        # Single account events use the priority lane, which the Consumer Lambda drains first
+        priority_sqs_url = os.getenv('SQS_PRIORITY_URL') or sqs_url
         
-        # Read environment variables (UPPER_CASE) into local variables (lower_case)
-        selection_mode = os.getenv('ACCOUNT_SELECTION_MODE', 'EXCLUSION')
-        excluded_accounts_str = os.getenv('EXCLUDED_ACCOUNTS', '[]')
-        included_accounts_str = os.getenv('INCLUDED_ACCOUNTS', '[]')
-        
-        logging.info(f'Account Selection Mode: {selection_mode}')
-        logging.info(f'Excluded Accounts: {excluded_accounts_str}')
-        logging.info(f'Included Accounts: {included_accounts_str}')
-        
-        # Parse account lists from string format to Python lists
-        try:
-            excluded_accounts = ast.literal_eval(excluded_accounts_str)
-        except (ValueError, SyntaxError) as e:
-            logging.error(f'Failed to parse excluded accounts: {e}')
-            excluded_accounts = []
-        
+        # Account selection rules and recorder profile assignments, compiled once per container,
+        # and the resource types of the profiles checked against the resource type catalog
         try:
-            included_accounts = ast.literal_eval(included_accounts_str)
-        except (ValueError, SyntaxError) as e:
-            logging.error(f'Failed to parse included accounts: {e}')
-            included_accounts = []
+            selector = get_account_selector()
+            profiles = get_recorder_profiles()
+            resource_type_errors = check_resource_types(profiles) if event.get('RequestType') != 'Delete' else []
+        except Exception:
+            # CloudFormation would wait for a response until it times out; fail the stack operation
+            # instead, but let the stack be deleted
+            if 'LogicalResourceId' in event:
+                status = cfnresponse.SUCCESS if event['RequestType'] == 'Delete' else cfnresponse.FAILED
+                cfnresponse.send(event, context, status, {}, "CustomResourcePhysicalID",
+                                 reason='Invalid account selection, recorder profiles or resource type catalog, see the details in CloudWatch Logs')
+            raise
         
-        sqs_client = boto3.client('sqs')
+        # Pooled clients, created on first use and reused by the next invocations of the container
+        sqs_client = get_client('sqs')
+        cfn_client = get_client('cloudformation')
         
         # Check if the lambda was trigerred from EventBridge.
         # If so extract Account and Event info from the event data.
         
         is_eb_trigerred = 'source' in event
         
-        logging.info(f'Is EventBridge Trigerred: {str(is_eb_trigerred)}')
+        logging.info('Is EventBridge Trigerred: %s', is_eb_trigerred)
         event_source = ''
         
         if is_eb_trigerred:
             event_source = event['source']
-            logging.info(f'Control Tower Event Source: {event_source}')
+            logging.info('Control Tower Event Source: %s', event_source)
             event_name = event['detail']['eventName']
-            logging.info(f'Control Tower Event Name: {event_name}')
+            logging.info('Control Tower Event Name: %s', event_name)
         
-        if event_source == 'aws.controltower' and event_name == 'UpdateManagedAccount':    
+        sweep_args = (selector, cfn_client, sqs_client, sqs_url, context)
+        
+        if 'Continuation' in event:
+            checkpoint = event['Continuation']
+            logging.info('Resuming %s sweep of ALL accounts, invocation %s', checkpoint['Event'], checkpoint['Invocation'])
+            run_sweep(*sweep_args, checkpoint['Event'], checkpoint)
+        elif 'Redrive' in event:
+            logging.info('Re-driving the failure ledger: %s', Sanitized(event['Redrive']))
+            redrive_failures(selector, sqs_client, priority_sqs_url, event['Redrive'] or {})
+        elif event_source == 'aws.controltower' and event_name == 'UpdateManagedAccount':    
             account = event['detail']['serviceEventDetails']['updateManagedAccountStatus']['account']['accountId']
-            logging.info(f'overriding config recorder for SINGLE account: {account}')
-            override_config_recorder(selection_mode, excluded_accounts, included_accounts, sqs_url, account, 'controltower')
+            logging.info('overriding config recorder for SINGLE account: %s', account)
+            selector.resolve(account)
+            profiles.resolve(account)
+            operations = {}
+            stack_instance_index = build_stack_instance_index(cfn_client, account, operations)
+            override_config_recorder(selector, sqs_client, priority_sqs_url, stack_instance_index, account, 'controltower', operations)
         elif event_source == 'aws.controltower' and event_name == 'CreateManagedAccount':  
             account = event['detail']['serviceEventDetails']['createManagedAccountStatus']['account']['accountId']
-            logging.info(f'overriding config recorder for SINGLE account: {account}')
-            override_config_recorder(selection_mode, excluded_accounts, included_accounts, sqs_url, account, 'controltower')
+            logging.info('overriding config recorder for SINGLE account: %s', account)
+            selector.resolve(account)
+            profiles.resolve(account)
+            operations = {}
+            stack_instance_index = build_stack_instance_index(cfn_client, account, operations)
+            override_config_recorder(selector, sqs_client, priority_sqs_url, stack_instance_index, account, 'controltower', operations)
         elif event_source == 'aws.controltower' and event_name == 'UpdateLandingZone':
             logging.info('overriding config recorder for ALL accounts due to UpdateLandingZone event')
-            override_config_recorder(selection_mode, excluded_accounts, included_accounts, sqs_url, '', 'controltower')
+            run_sweep(*sweep_args, 'controltower')
+        elif ('LogicalResourceId' in event) and resource_type_errors:
+            # Every put_configuration_recorder call would fail: reject the stack operation before the sweep
+            logging.error('Rejecting %s request, no account is updated', event['RequestType'])
+            cfnresponse.send(event, context, cfnresponse.FAILED, {}, "CustomResourcePhysicalID",
+                             reason=('Unknown AWS Config resource types, ' + '; '.join(resource_type_errors))[:1024])
         elif ('LogicalResourceId' in event) and (event['RequestType'] == 'Create'):
             logging.info('CREATE CREATE')
             logging.info(
                 'overriding config recorder for ALL accounts because of first run after function deployment from CloudFormation')
-            override_config_recorder(selection_mode, excluded_accounts, included_accounts, sqs_url, '', 'Create')
+            run_sweep(*sweep_args, 'Create')
             response = {}
-            ## Send signal back to CloudFormation after the first run
+            ## Send signal back to CloudFormation after the first run, the sweep may still continue in a follow-up invocation
             cfnresponse.send(event, context, cfnresponse.SUCCESS, response, "CustomResourcePhysicalID")
         elif ('LogicalResourceId' in event) and (event['RequestType'] == 'Update'):
             logging.info('Update Update')
             logging.info(
                 'overriding config recorder for ALL accounts because of overriding config recorder for ALL accounts because of CloudFormation stack update')
-            override_config_recorder(selection_mode, excluded_accounts, included_accounts, sqs_url, '', 'Update')
+            # The Delete events of previously excluded accounts are sent with each page of the sweep
+            run_sweep(*sweep_args, 'Update')
             response = {}
-            update_excluded_accounts(selection_mode, excluded_accounts, included_accounts, sqs_url)
             
             ## Send signal back to CloudFormation after the first run
             cfnresponse.send(event, context, cfnresponse.SUCCESS, response, "CustomResourcePhysicalID")    
@@ -140,12 +171,17 @@ def lambda_handler(event, context):
             logging.info('DELETE DELETE')
             logging.warning(
                 'Initiating config recorder cleanup for ALL accounts due to CloudFormation stack deletion')
-            override_config_recorder(selection_mode, excluded_accounts, included_accounts, sqs_url, '', 'Delete')
+            run_sweep(*sweep_args, 'Delete')
             response = {}
             ## Send signal back to CloudFormation after the final run
             cfnresponse.send(event, context, cfnresponse.SUCCESS, response, "CustomResourcePhysicalID")
         else:
             logging.info("No matching event found")
+        
+        lanes = {'sweep': sqs_url}
+        if priority_sqs_url != sqs_url:
+            lanes['priority'] = priority_sqs_url
+        report_queue_depths(sqs_client, lanes)
 
         logging.info('Execution Successful')
         
@@ -158,70 +194,548 @@ def lambda_handler(event, context):
         exception_type = e.__class__.__name__
         exception_message = str(e)
         logging.exception(f'{exception_type}: {exception_message}')
+        TRACER.keep(TRACER.trace_id)
+    
+    finally:
+        if selector:
+            selector.log_summary()
+        TRACER.record('invoke', invocation_start, time.time())
+        record_api_calls(METRICS, RATE_CONTROLLER)
+        METRICS.flush()
+        TRACER.flush()
+
+
+def check_resource_types(profiles):
+    """
+    Check the resource type lists of the recorder profiles against the resource type catalog, and
+    log the resource types some regions do not record, which the Consumer Lambda leaves out of the
+    inclusion lists there.
+    
+    Args:
+        profiles (RecorderProfiles): Compiled recorder profiles
+    
+    Returns:
+        list: Errors for the resource types the catalog does not know, or an empty list when there are
+              none or RESOURCE_TYPE_VALIDATION is WARN
+    """
+    catalog = get_resource_type_catalog()
+    errors, warnings = validate_resource_types(profiles, catalog)
+    for warning in warnings:
+        logging.info('Resource type catalog: %s', warning)
+    if not errors:
+        return []
+    METRICS.count('UnknownResourceTypes', len(errors))
+    if catalog.enforce:
+        logging.error('Resource types unknown to the resource type catalog %s, left out of inclusion lists by the Consumer Lambda: %s',
+                      catalog.source, '; '.join(errors))
+        return errors
+    logging.warning('Resource types unknown to the resource type catalog %s, sent to AWS Config as configured: %s',
+                    catalog.source, '; '.join(errors))
+    return []
+
+def get_trace_id(event, context):
+    """
+    Return the trace ID of an invocation: the trace of the sweep it continues, the Control Tower
+    (EventBridge) event ID, the CloudFormation RequestId, or else the Lambda request ID.
+    """
+    continuation = event.get('Continuation') or {}
+    return (continuation.get('TraceId') or event.get('id') or event.get('RequestId')
+            or getattr(context, 'aws_request_id', None) or str(uuid.uuid4()))
+
+
+def list_stack_instances_page(cfn_client, next_token=None, account=''):
+    """
+    Return one page of list_stack_instances for the Control Tower baseline Config StackSet.
+    """
+    kwargs = {'StackSetName': STACK_SET_NAME}
+    if next_token:
+        kwargs['NextToken'] = next_token
+    if account:
+        kwargs['StackInstanceAccount'] = account
+    with METRICS.timer('ListStackInstances'):
+        page = call_with_retry('cloudformation', AWS_REGION, cfn_client.list_stack_instances, **kwargs)
+    logging.debug('list_stack_instances page: %s', page)
+    return page
+
+def index_stack_instances(summaries, index=None, operations=None):
+    """
+    Add list_stack_instances summaries to an account ID -> regions index and return it.
+    When an operations dict is given, the LastOperationId of each (account, region) is added to it.
+    """
+    index = {} if index is None else index
+    for item in summaries:
+        index.setdefault(item['Account'], []).append(item['Region'])
+        if operations is not None and item.get('LastOperationId'):
+            operations[(item['Account'], item['Region'])] = item['LastOperationId']
+    return index
 
+def build_stack_instance_index(cfn_client, account='', operations=None):
+    """
+    Paginate the Control Tower baseline Config StackSet once and index its stack instances.
+    
+    Args:
+        cfn_client: boto3 CloudFormation client
+        account (str): Specific account ID to list, or empty string for all accounts
+        operations (dict): Optional dict to fill with the LastOperationId of each (account, region)
+    
+    Returns:
+        dict: Account ID -> list of regions with a stack instance
+    """
+    index = {}
+    try:
+        next_token = None
+        while True:
+            page = list_stack_instances_page(cfn_client, next_token, account)
+            index_stack_instances(page['Summaries'], index, operations)
+            next_token = page.get('NextToken')
+            if not next_token:
+                break
+                
+    except Exception as e:
+        exception_type = e.__class__.__name__
+        exception_message = str(e)
+        logging.exception(f'{exception_type}: {exception_message}')
+    
+    logging.info('Indexed %d stack instances across %d accounts', sum(len(regions) for regions in index.values()), len(index))
+    return index
 
-def override_config_recorder(selection_mode, excluded_accounts, included_accounts, sqs_url, account, event):
+def override_config_recorder(selector, sqs_client, sqs_url, stack_instance_index, account, event, operations=None):
     """
-    Retrieve Control Tower managed accounts and send SQS messages for processing.
+    Send SQS messages for processing for the Control Tower managed accounts in the stack instance index.
+    
+    In INCREMENTAL reconciliation mode, sweeps of all accounts skip the account/regions whose
+    applied state already matches the desired settings and the current StackSet operation.
+    Single account events and INCREMENTAL sweeps also skip the account/regions with identical
+    work still pending from an earlier event.
     
     Args:
-        selection_mode (str): 'EXCLUSION' or 'INCLUSION'
-        excluded_accounts (list): Parsed list of excluded account IDs
-        included_accounts (list): Parsed list of included account IDs
+        selector (AccountSelector): Compiled account selection
+        sqs_client: boto3 SQS client
         sqs_url (str): SQS queue URL
+        stack_instance_index (dict): Account ID -> regions, from build_stack_instance_index
         account (str): Specific account ID to process, or empty string for all accounts
         event (str): Event type (e.g., 'Create', 'Update', 'Delete', 'controltower')
+        operations (dict): Optional (account, region) -> LastOperationId of the stack instances
+    
+    Returns:
+        dict: Number of SQS messages 'sent', 'retried' and 'failed', number of account/regions 'skipped',
+              'coalesced' and 'enqueued', the 'unsent' message bodies, and the 'accounts' messages were built for
     """
     try:
-        client = boto3.client('cloudformation')
-        # Create a reusable Paginator
-        paginator = client.get_paginator('list_stack_instances')
-        
-        # Create a PageIterator from the Paginator
         if account == '':
-            page_iterator = paginator.paginate(StackSetName='AWSControlTowerBP-BASELINE-CONFIG')
+            accounts = stack_instance_index.items()
         else:
-            page_iterator = paginator.paginate(StackSetName='AWSControlTowerBP-BASELINE-CONFIG', StackInstanceAccount=account)
-            
-        sqs_client = boto3.client('sqs')
+            accounts = [(account, stack_instance_index.get(account, []))]
         
-        # Process each account returned from Control Tower
-        for page in page_iterator:
-            logging.info(page)
-            
-            for item in page['Summaries']:
-                account_id = item['Account']
-                region = item['Region']
-                # Delegate filtering decision to send_message_to_sqs
-                send_message_to_sqs(
-                    event, account_id, region, selection_mode, 
-                    excluded_accounts, included_accounts, 
-                    sqs_client, sqs_url)
+        # Collect every eligible account/region returned from Control Tower
+        pairs = []
+        processed_accounts = []
+        for account_id, regions in accounts:
+            if selector.should_process(account_id):
+                processed_accounts.append(account_id)
+                pairs.extend((account_id, region) for region in regions)
+        
+        operations = operations or {}
+        skipped = 0
+        incremental = account == '' and is_incremental(event)
+        if incremental:
+            pairs, skipped = filter_out_of_date(pairs, event, operations)
+        # Sweeps that update every account/region still mark their work as pending for single account events
+        pairs, coalesced = coalesce_pending(pairs, event, operations, account != '' or incremental)
+        
+        stats = send_messages_to_sqs(sqs_client, sqs_url, build_messages(pairs, event, operations))
+        stats['skipped'] = skipped
+        stats['coalesced'] = coalesced
+        stats['enqueued'] = len(pairs)
+        if stats['unsent']:
+            release_pending(stats['unsent'])
+        logging.info('SQS fan-out complete: %d sent (%d account/regions), %d retried, %d failed, '
+                     '%d skipped as up to date, %d coalesced', stats['sent'], stats['enqueued'],
+                     stats['retried'], stats['failed'], stats['skipped'], stats['coalesced'])
+        METRICS.count('AccountsEnqueued', len(processed_accounts), Event=event)
+        METRICS.count('AccountRegionsEnqueued', stats['enqueued'], Event=event)
+        METRICS.count('MessagesSent', stats['sent'], Event=event)
+        METRICS.count('MessagesRetried', stats['retried'], Event=event)
+        METRICS.count('MessagesFailed', stats['failed'], Event=event)
+        METRICS.count('MessagesSkipped', stats['skipped'], Event=event)
+        METRICS.count('MessagesCoalesced', stats['coalesced'], Event=event)
+        stats['accounts'] = processed_accounts
+        return stats
                     
     except Exception as e:
         exception_type = e.__class__.__name__
         exception_message = str(e)
         logging.exception(f'{exception_type}: {exception_message}')
 
-def send_message_to_sqs(event, account, region, selection_mode, excluded_accounts, included_accounts, sqs_client, sqs_url):
+def build_messages(pairs, event, operations):
+    """
+    Encode the SQS message bodies for (account, region) pairs: one message per account with its
+    regions, its recorder profile ID, the StackSet operation the Consumer saves with the applied
+    state and the fingerprint of the desired settings, or one message per pair when MESSAGE_VERSION is 1.
+    """
+    regions_by_account = {}
+    for account_id, region in pairs:
+        regions_by_account.setdefault(account_id, []).append(region)
     
+    profiles = get_recorder_profiles()
+    bodies = []
+    for account_id, regions in regions_by_account.items():
+        profile_id = profiles.profile_id(account_id)
+        profile = profiles.get(profile_id)
+        message = build_message(
+            account_id, event, regions,
+            operations={region: operations.get((account_id, region)) for region in regions},
+            fingerprints={region: desired_fingerprint(region, event, profile) for region in regions},
+            trace_id=TRACER.trace_id,
+            profile=profile_id if profile_id != DEFAULT_PROFILE_ID else None)
+        if MESSAGE_VERSION == 1:
+            bodies.extend(encode_v1_messages(message))
+        else:
+            bodies.append(encode_message(message))
+    return bodies
+
+def is_incremental(event):
+    """
+    Return True if a sweep of all accounts for the event only enqueues out-of-date account/regions.
+    """
+    return RECONCILIATION_MODE == 'INCREMENTAL' and event in INCREMENTAL_EVENTS and get_state_store() is not None
+
+def filter_out_of_date(pairs, event, operations):
+    """
+    Look the account/regions up in the state store and drop the ones already up to date.
+    
+    An account/region is up to date when its applied fingerprint equals the fingerprint of the
+    desired settings of its recorder profile for the event, and it was applied after the current StackSet operation
+    (a Control Tower baseline redeployment resets the recorder).
+    
+    Returns:
+        tuple: (out-of-date pairs (list), number of pairs skipped (int))
+    """
     try:
-        # Use the new filtering function to determine if account should be processed
-        if should_process_account(account, selection_mode, excluded_accounts, included_accounts):
-            # Construct and send SQS message
-            sqs_msg = f'{{"Account": "{account}", "Region": "{region}", "Event": "{event}"}}'
-            response = sqs_client.send_message(
-                QueueUrl=sqs_url,
-                MessageBody=sqs_msg)
-            logging.info(f'Message sent to SQS: {sqs_msg}')
-        # Logging for inclusion/exclusion decisions is handled within should_process_account
-                
+        applied = get_state_store().get_many(pairs)
+    except Exception as e:
+        logging.warning('Unable to read the applied state, enqueuing all %d account/regions: %s: %s',
+                        len(pairs), e.__class__.__name__, e)
+        return pairs, 0
+    
+    profiles = get_recorder_profiles()
+    out_of_date = []
+    for key in pairs:
+        record = applied.get(key)
+        if (record and record['Fingerprint'] == desired_fingerprint(key[1], event, profiles.profile(key[0]))
+                and record['Operation'] == operations.get(key)):
+            continue
+        out_of_date.append(key)
+    return out_of_date, len(pairs) - len(out_of_date)
+
+def is_coalescing():
+    return COALESCING_WINDOW_SECONDS > 0 and get_state_store() is not None
+
+def coalesce_pending(pairs, event, operations, absorb=True):
+    """
+    Drop the account/regions whose identical work was enqueued less than COALESCING_WINDOW_SECONDS
+    ago, and mark the others as pending. With absorb=False, every account/region is kept and marked.
+    
+    Work is identical when it applies the same settings (fingerprint) over the same StackSet
+    operation. Repeated UpdateManagedAccount events, and single account events for accounts a
+    running sweep already enqueued (or the other way around), are enqueued once; work for a
+    redeployed Control Tower baseline is not coalesced with work from before the redeployment.
+    
+    Returns:
+        tuple: (pairs to enqueue (list), number of pairs coalesced (int))
+    """
+    if not pairs or not is_coalescing():
+        return pairs, 0
+    state_store = get_state_store()
+    profiles = get_recorder_profiles()
+    tokens = {key: f'{desired_fingerprint(key[1], event, profiles.profile(key[0]))}:{operations.get(key, "")}'
+              for key in pairs}
+    try:
+        pending = state_store.get_pending(pairs) if absorb else {}
+        fresh = [key for key in pairs if pending.get(key) != tokens[key]]
+        state_store.put_pending([(account_id, region, tokens[(account_id, region)]) for account_id, region in fresh],
+                                time.time() + COALESCING_WINDOW_SECONDS)
+    except Exception as e:
+        logging.warning('Unable to coalesce pending work, enqueuing all %d account/regions: %s: %s',
+                        len(pairs), e.__class__.__name__, e)
+        return pairs, 0
+    return fresh, len(pairs) - len(fresh)
+
+def release_pending(bodies):
+    """
+    Delete the pending markers of messages that could not be sent, so the next event enqueues them again.
+    """
+    if not is_coalescing():
+        return
+    keys = [pair for body in bodies for pair in message_pairs(decode_message(body))]
+    try:
+        get_state_store().delete_pending(keys)
+    except Exception as e:
+        logging.warning('Unable to release %d pending markers, they expire in %d seconds: %s: %s',
+                        len(keys), COALESCING_WINDOW_SECONDS, e.__class__.__name__, e)
+
+def run_sweep(selector, cfn_client, sqs_client, sqs_url, context, event, checkpoint=None):
+    """
+    Run (or resume) a sweep of ALL accounts and hand it off to a follow-up invocation
+    if it cannot finish before the Lambda deadline.
+    
+    An 'Update' sweep also sends the Delete events for the excluded accounts of every page.
+    
+    Returns:
+        bool: True if the sweep completed in this invocation
+    """
+    checkpoint = checkpoint or new_checkpoint(event)
+    try:
+        complete, checkpoint = sweep_all_accounts(
+            selector, cfn_client, sqs_client, sqs_url, context, event, checkpoint)
+        
+        if not complete:
+            continue_sweep(context, checkpoint)
+            return False
+        
+        logging.info('%s sweep complete: %d accounts enqueued in %d invocation(s)', event, checkpoint['Enqueued'], checkpoint['Invocation'])
+        return True
+        
     except Exception as e:
         exception_type = e.__class__.__name__
         exception_message = str(e)
-        logging.exception(f'{exception_type}: {exception_message}') 
+        logging.exception(f'{exception_type}: {exception_message}')
+        # Nothing resumes the sweep: the stack instances after this token are not enqueued
+        logging.error('%s sweep stopped in invocation %d after %d accounts, the stack instances from NextToken %s are not enqueued',
+                      event, checkpoint['Invocation'], checkpoint['Enqueued'], checkpoint['NextToken'])
+        METRICS.count('SweepFailures', Event=event)
+        TRACER.keep(TRACER.trace_id)
+        return False
+
+def new_checkpoint(event):
+    """
+    Return the checkpoint of a sweep starting from the first page.
+    """
+    return {'Event': event, 'NextToken': None, 'Enqueued': 0, 'Invocation': 1, 'TraceId': TRACER.trace_id,
+            'Carry': []}
+
+def sweep_all_accounts(selector, cfn_client, sqs_client, sqs_url, context, event, checkpoint=None):
+    """
+    Fan out the StackSet instances page by page, stopping between pages when less than
+    SWEEP_TIME_RESERVE_MILLIS of the invocation is left.
+    
+    The checkpoint holds everything needed to resume the sweep in another invocation, and
+    does not grow with the number of accounts swept: the pagination 'NextToken', the number of
+    accounts 'Enqueued' so far, the stack instances of the last account listed ('Carry'), sent
+    with the next page, and the 'TraceId' the follow-up invocations keep. On 'Update'
+    sweeps, the Delete events for the excluded accounts of each page are sent with the page.
+    
+    Returns:
+        tuple: (complete (bool), checkpoint (dict))
+    """
+    if checkpoint is None:
+        checkpoint = new_checkpoint(event)
+    next_token = checkpoint['NextToken']
+    # Excluded from the Delete events of the excluded accounts, looked up once per invocation
+    current_account = None
+    
+    while True:
+        page = list_stack_instances_page(cfn_client, next_token)
+        next_token = page.get('NextToken')
+        
+        # The stack instances of the last account of a page may continue on the next page: they
+        # are sent with the next page, so that every account gets a single message
+        summaries = checkpoint.get('Carry', []) + page['Summaries']
+        split = len(summaries)
+        if next_token:
+            while split and summaries[split - 1]['Account'] == summaries[-1]['Account']:
+                split -= 1
+        checkpoint['Carry'] = [{key: item[key] for key in STACK_INSTANCE_FIELDS if key in item} for item in summaries[split:]]
+        
+        operations = {}
+        page_index = index_stack_instances(summaries[:split], operations=operations)
+        stats = override_config_recorder(
+            selector, sqs_client, sqs_url, page_index, '', event, operations)
+        if stats:
+            checkpoint['Enqueued'] += len(stats['accounts'])
+        if event == 'Update' and selector.mode == 'EXCLUSION':
+            excluded_index = {account_id: regions for account_id, regions in page_index.items()
+                              if selector.is_excluded(account_id)}
+            if excluded_index:
+                current_account = current_account or get_current_account()
+                update_excluded_accounts(selector, sqs_client, sqs_url, excluded_index, current_account)
+        
+        checkpoint['NextToken'] = next_token
+        if not next_token:
+            return True, checkpoint
+        if context.get_remaining_time_in_millis() < SWEEP_TIME_RESERVE_MILLIS:
+            logging.warning('Checkpointing %s sweep after %d accounts, less than %d ms left in invocation %d',
+                            event, checkpoint['Enqueued'], SWEEP_TIME_RESERVE_MILLIS, checkpoint['Invocation'])
+            METRICS.count('SweepCheckpoints', Event=event)
+            return False, checkpoint
+
+def continue_sweep(context, checkpoint):
+    """
+    Asynchronously invoke this function again with the checkpoint as a continuation event.
+    """
+    continuation = dict(checkpoint, Invocation=checkpoint['Invocation'] + 1)
+    call_with_retry(
+        'lambda', AWS_REGION, get_client('lambda').invoke,
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps({'Continuation': continuation}))
+    logging.info('%s sweep continues in invocation %d', checkpoint['Event'], continuation['Invocation'])
+
+def redrive_failures(selector, sqs_client, sqs_url, options):
+    """
+    Enqueue the account/regions of the failure ledger again, without a sweep, and remove
+    the ledger entries of the messages sent. Entries that fail again are recorded again
+    by the Consumer Lambda. Entries of accounts the account selection no longer processes
+    are skipped and kept, except the Delete events that reset excluded accounts.
+    
+    Invoke the function with {"Redrive": {}} to re-drive every entry, or limit the re-drive
+    with 'Accounts', 'Regions' or 'ErrorCodes' lists, e.g.
+    {"Redrive": {"Accounts": ["123456789012"], "ErrorCodes": ["ThrottlingException"]}}
+    
+    Args:
+        selector (AccountSelector): Compiled account selection
+        sqs_client: boto3 SQS client
+        sqs_url (str): SQS queue URL
+        options (dict): Optional filters of the ledger entries to re-drive
+    
+    Returns:
+        dict: Number of SQS messages 'sent', 'retried' and 'failed', and the 'unsent' message bodies
+    """
+    state_store = get_state_store()
+    if state_store is None:
+        logging.warning('No state store configured, there is no failure ledger to re-drive')
+        return None
+    
+    filters = {key: set(options.get(name) or []) for key, name in
+               (('Account', 'Accounts'), ('Region', 'Regions'), ('ErrorCode', 'ErrorCodes'))}
+    failures = [failure for failure in state_store.list_failures()
+                if all(not values or failure[key] in values for key, values in filters.items())]
+    selected = [failure for failure in failures
+                if failure['Event'] == 'Delete' or selector.should_process(failure['Account'])]
+    if len(selected) < len(failures):
+        logging.info('Skipping %d failure ledger entries of accounts the account selection does not process',
+                     len(failures) - len(selected))
+    failures = selected
+    
+    # Entries of the same account and event share a message
+    pairs_by_event = {}
+    operations = {}
+    for failure in failures:
+        key = (failure['Account'], failure['Region'])
+        pairs_by_event.setdefault(failure['Event'], []).append(key)
+        operations[key] = failure['Operation']
+    messages = [body for event, pairs in pairs_by_event.items() for body in build_messages(pairs, event, operations)]
+    
+    stats = send_messages_to_sqs(sqs_client, sqs_url, messages)
+    unsent = {pair for body in stats['unsent'] for pair in message_pairs(decode_message(body))}
+    state_store.delete_failures([(failure['Account'], failure['Region']) for failure in failures
+                                 if (failure['Account'], failure['Region']) not in unsent])
+    logging.info('Re-drive complete: %d of %d failure ledger entries sent in %d messages, %d messages failed',
+                 len(failures) - len(unsent), len(failures), stats['sent'], stats['failed'])
+    METRICS.count('MessagesRedriven', len(failures) - len(unsent))
+    return stats
+
+def report_queue_depths(sqs_client, lanes):
+    """
+    Record the number of visible and in-flight messages of each lane (name -> queue URL) as metrics.
+    """
+    for lane, url in lanes.items():
+        try:
+            attributes = call_with_retry(
+                'sqs', AWS_REGION, sqs_client.get_queue_attributes, QueueUrl=url,
+                AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+        except Exception as e:
+            logging.warning('Unable to read the depth of the %s lane: %s: %s', lane, e.__class__.__name__, e)
+            continue
+        METRICS.put('QueueDepth', int(attributes.get('ApproximateNumberOfMessages', 0)), Lane=lane)
+        METRICS.put('QueueInFlight', int(attributes.get('ApproximateNumberOfMessagesNotVisible', 0)), Lane=lane)
+
+def send_messages_to_sqs(sqs_client, sqs_url, messages):
+    """
+    Send messages to SQS in batches of SQS_BATCH_SIZE, keeping up to
+    SQS_MAX_INFLIGHT_BATCHES send_message_batch calls in flight at once.
+    The fan-out is recorded as an 'enqueue' span.
+    
+    Args:
+        sqs_client: boto3 SQS client (clients are thread-safe)
+        sqs_url (str): SQS queue URL
+        messages (list): Message bodies to send
+    
+    Returns:
+        dict: Number of messages 'sent', 'retried' and 'failed', and the 'unsent' message bodies
+    """
+    stats = {'sent': 0, 'retried': 0, 'failed': 0, 'unsent': []}
+    batches = [messages[i:i + SQS_BATCH_SIZE] for i in range(0, len(messages), SQS_BATCH_SIZE)]
+    if not batches:
+        return stats
+    
+    with TRACER.span('enqueue', Queue=sqs_url.rsplit('/', 1)[-1], Messages=len(messages)), \
+            ThreadPoolExecutor(max_workers=min(SQS_MAX_INFLIGHT_BATCHES, len(batches))) as executor:
+        for batch_stats in executor.map(lambda batch: send_message_batch(sqs_client, sqs_url, batch), batches):
+            for key in stats:
+                stats[key] += batch_stats[key]
+    return stats
+
+def send_message_batch(sqs_client, sqs_url, messages):
+    """
+    Send up to SQS_BATCH_SIZE messages with a single send_message_batch call.
+    
+    Entries reported back as failed are retried on their own with a growing
+    delay, up to SQS_MAX_SEND_ATTEMPTS attempts. Entries failed because of the
+    request itself (SenderFault) are not retried. Every message carries the
+    trace ID of the invocation as a message attribute.
+    
+    Returns:
+        dict: Number of messages 'sent', 'retried' and 'failed', and the 'unsent' message bodies for this batch
+    """
+    stats = {'sent': 0, 'retried': 0, 'failed': 0, 'unsent': []}
+    pending = {str(index): body for index, body in enumerate(messages)}
+    attributes = message_attributes(TRACER.trace_id)
+    
+    for attempt in range(SQS_MAX_SEND_ATTEMPTS):
+        if attempt > 0:
+            stats['retried'] += len(pending)
+            time.sleep(SQS_RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1)))
+        
+        try:
+            with METRICS.timer('SqsSend'):
+                response = call_with_retry(
+                    'sqs', AWS_REGION, sqs_client.send_message_batch,
+                    QueueUrl=sqs_url,
+                    Entries=[{'Id': entry_id, 'MessageBody': body, 'MessageAttributes': attributes}
+                             for entry_id, body in pending.items()])
+        except Exception as e:
+            # Throttling and transient errors were already retried by call_with_retry
+            logging.error('send_message_batch failed: %s: %s', e.__class__.__name__, e)
+            break
+        
+        stats['sent'] += len(response.get('Successful', []))
+        retry = {}
+        for failure in response.get('Failed', []):
+            body = pending[failure['Id']]
+            if failure.get('SenderFault'):
+                stats['failed'] += 1
+                stats['unsent'].append(body)
+                logging.error('Message rejected by SQS (%s): %s', failure.get('Code'), body)
+            else:
+                retry[failure['Id']] = body
+        pending = retry
+        if not pending:
+            break
+    
+    for body in pending.values():
+        stats['failed'] += 1
+        stats['unsent'].append(body)
+        logging.error('Message not sent to SQS after %d attempts: %s', SQS_MAX_SEND_ATTEMPTS, body)
+    return stats
                    
-def update_excluded_accounts(selection_mode, excluded_accounts, included_accounts, sqs_url):
+def get_current_account():
+    """
+    Return the ID of the account this function runs in, the Control Tower management account.
+    """
+    return call_with_retry('sts', AWS_REGION, get_client('sts').get_caller_identity).get('Account')
+
+def update_excluded_accounts(selector, sqs_client, sqs_url, stack_instance_index, current_account=None):
     """
     Handle cleanup for accounts when the exclusion list is updated during stack updates.
     
@@ -233,29 +747,28 @@ def update_excluded_accounts(selection_mode, excluded_accounts, included_account
     simply don't receive messages.
     
     Args:
-        selection_mode (str): 'EXCLUSION' or 'INCLUSION'
-        excluded_accounts (list): Parsed list of excluded account IDs
-        included_accounts (list): Parsed list of included account IDs (unused in current logic)
+        selector (AccountSelector): Compiled account selection
+        sqs_client: boto3 SQS client
         sqs_url (str): SQS queue URL
+        stack_instance_index (dict): Account ID -> regions of the excluded accounts of a sweep page
+        current_account (str): ID of the management account, looked up when not given
     """
     try:
-        sts_client = boto3.client('sts')
-        current_account = sts_client.get_caller_identity().get('Account')
+        current_account = current_account or get_current_account()
         
         # Create a temporary exclusion list containing only the current account
-        temp_excluded = [current_account]
+        temp_selector = AccountSelector('EXCLUSION', [current_account])
         
-        logging.info(f'Current account for cleanup: {current_account}')
+        logging.info('Current account for cleanup: %s', current_account)
         
-        if selection_mode == 'EXCLUSION':
+        if selector.mode == 'EXCLUSION':
             # In exclusion mode, send Delete events to accounts that were previously excluded
             # but are no longer in the exclusion list (to restore their Config Recorder settings)
-            for acct in excluded_accounts:
-                if acct != current_account:
-                    logging.info(f'Delete request sent for previously excluded account: {acct}')
-                    override_config_recorder(
-                        'EXCLUSION', temp_excluded, [], 
-                        sqs_url, acct, 'Delete')
+            # The excluded accounts of the sweep page are used instead of listing them again
+            delete_index = {acct: regions for acct, regions in stack_instance_index.items() if acct != current_account}
+            logging.info('Delete requests sent for %d previously excluded accounts', len(delete_index))
+            override_config_recorder(
+                temp_selector, sqs_client, sqs_url, delete_index, '', 'Delete')
         else:  # INCLUSION mode
             # In inclusion mode, no cleanup is needed during stack updates
             # Accounts not in the inclusion list simply don't receive messages
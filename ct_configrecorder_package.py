@@ -0,0 +1,111 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""
+Deployment packages of the Producer and Consumer Lambda functions.
+
+Each zip holds the handler module of its function and every shared module it imports, at the
+root of the archive. The archives are reproducible: files are added in a fixed order with a
+fixed timestamp and permissions, so building twice from the same sources gives the same bytes
+and the committed zips can be checked against the sources:
+
+    python ct_configrecorder_package.py            # build both zips in the repository root
+    python ct_configrecorder_package.py --check    # exit with status 1 if a zip is out of date
+"""
+
+import argparse
+import io
+import os
+import sys
+import zipfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SHARED_MODULES = [
+    'ct_configrecorder_throttling.py',
+    'ct_configrecorder_instrumentation.py',
+    'ct_configrecorder_clients.py',
+    'ct_configrecorder_documents.py',
+    'ct_configrecorder_catalog.py',
+    'ct_configrecorder_resource_types.json',
+    'ct_configrecorder_recorder.py',
+    'ct_configrecorder_messages.py',
+    'ct_configrecorder_state.py',
+    'ct_configrecorder_profiles.py',
+]
+# Zip name -> files of the package
+PACKAGES = {
+    'ct_configrecorder_override_producer.zip': [
+        'ct_configrecorder_override_producer.py', 'cfnresponse.py', 'ct_configrecorder_selection.py'] + SHARED_MODULES,
+    'ct_configrecorder_override_consumer.zip': ['ct_configrecorder_override_consumer.py'] + SHARED_MODULES,
+}
+# Timestamp of every file, the earliest a zip holds
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def build_package(files, root=ROOT):
+    """
+    Return the bytes of a zip of files, relative to root.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in files:
+            info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o100644 << 16
+            with open(os.path.join(root, name), 'rb') as f:
+                archive.writestr(info, f.read(), compresslevel=9)
+    return buffer.getvalue()
+
+
+def stale_packages(root=ROOT):
+    """
+    Return the names of the zips in root that differ from the ones built from the sources.
+    """
+    stale = []
+    for name, files in PACKAGES.items():
+        try:
+            with open(os.path.join(root, name), 'rb') as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        if current != build_package(files, root):
+            stale.append(name)
+    return stale
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='Only check that the zips are up to date')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        stale = stale_packages()
+        for name in stale:
+            print(f'{name} is out of date, run python ct_configrecorder_package.py', file=sys.stderr)
+        return 1 if stale else 0
+
+    for name, files in PACKAGES.items():
+        with open(os.path.join(ROOT, name), 'wb') as f:
+            f.write(build_package(files))
+        print(f'{name}: {", ".join(files)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
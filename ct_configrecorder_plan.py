@@ -0,0 +1,185 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Read-only plan of the configuration recorder changes across the fleet.
+
+Lists the stack instances of the Control Tower baseline Config StackSet like the Producer Lambda,
+describes the recorder of every selected account/region like the Consumer Lambda, and writes one
+JSON line per account/region comparing it with the desired settings, as soon as it is known.
+Nothing is written to the accounts, the queues or the state store.
+
+The desired settings and the account selection, including the ACCOUNT_SELECTION_DOCUMENT and the
+RECORDER_PROFILES_DOCUMENT, are read from the same environment variables as the Lambda functions,
+so a change can be planned before updating the stack. Run it with credentials of the Control Tower
+management account:
+
+    CONTROL_TOWER_HOME_REGION=us-east-1 CONFIG_RECORDER_STRATEGY=EXCLUSION \
+    CONFIG_RECORDER_OVERRIDE_EXCLUDED_RESOURCE_LIST=AWS::EC2::NetworkInterface \
+    CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY=CONTINUOUS \
+        python ct_configrecorder_plan.py --output plan.jsonl
+
+Each line has the 'Account', 'Region', 'Event' and recorder 'Profile', the 'Drift' category ('in_sync', 'drifted',
+'missing' or 'error'), the 'Outcome' the Consumer Lambda would report ('unchanged', 'updated' or
+'reset') and the 'Changes' per recorder field, with the 'Current' and 'Desired' values.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from ct_configrecorder_clients import get_client
+from ct_configrecorder_override_consumer import METRICS as CONSUMER_METRICS
+from ct_configrecorder_override_consumer import describe_recorder, desired_recorder, get_config_client
+from ct_configrecorder_override_producer import METRICS as PRODUCER_METRICS
+from ct_configrecorder_override_producer import index_stack_instances, list_stack_instances_page
+from ct_configrecorder_profiles import get_recorder_profiles
+from ct_configrecorder_recorder import DEFAULT_PROFILE, recorder_diff
+from ct_configrecorder_selection import get_account_selector
+from ct_configrecorder_throttling import error_code
+
+# Account/regions described concurrently
+PLAN_MAX_WORKERS = 16
+# Account/regions submitted ahead of the workers; results are written as they complete, so
+# memory does not grow with the number of account/regions
+MAX_PENDING_PER_WORKER = 4
+# The Lambda modules record metrics for every call; the plan drops them after this many records
+METRICS_CLEAR_INTERVAL = 1000
+
+
+def iter_account_regions(cfn_client, selector, accounts=None):
+    """
+    Yield the selected (account, region) pairs of the baseline Config StackSet, one
+    list_stack_instances page at a time.
+
+    Args:
+        cfn_client: boto3 CloudFormation client
+        selector (AccountSelector): Compiled account selection
+        accounts (set): Optional account IDs the plan is limited to
+    """
+    next_token = None
+    while True:
+        page = list_stack_instances_page(cfn_client, next_token)
+        for account_id, regions in index_stack_instances(page['Summaries']).items():
+            if accounts and account_id not in accounts:
+                continue
+            if selector.should_process(account_id):
+                for region in regions:
+                    yield account_id, region
+        next_token = page.get('NextToken')
+        if not next_token:
+            return
+
+
+def plan_account_region(account_id, aws_region, event, profile=DEFAULT_PROFILE):
+    """
+    Describe the recorder of one account/region and return its plan record for a recorder profile.
+    """
+    record = {'Account': account_id, 'Region': aws_region, 'Event': event, 'Profile': profile.name}
+    try:
+        existing_recorder = describe_recorder(get_config_client(account_id, aws_region), aws_region)
+        config_recorder = desired_recorder(account_id, aws_region, event, existing_recorder, profile)
+    except Exception as e:
+        record.update(Drift='error', ErrorCode=error_code(e) or e.__class__.__name__, ErrorMessage=str(e))
+        return record
+
+    changes = recorder_diff(existing_recorder or {}, config_recorder)
+    if existing_recorder is None:
+        record['Drift'] = 'missing'
+    else:
+        record['Drift'] = 'drifted' if changes else 'in_sync'
+        record['Recorder'] = existing_recorder['name']
+    if existing_recorder is not None and not changes:
+        record['Outcome'] = 'unchanged'
+    else:
+        record['Outcome'] = 'reset' if event == 'Delete' else 'updated'
+    record['Changes'] = changes
+    return record
+
+
+def write_plan(pairs, event, stream, max_workers=PLAN_MAX_WORKERS, profiles=None):
+    """
+    Plan (account, region) pairs on a bounded thread pool, writing one JSON line per pair
+    to the stream as soon as it is planned, in completion order. Accounts get the profile
+    assigned by the compiled RecorderProfiles, or the default profile without them.
+
+    Returns:
+        Counter: Number of records per drift category
+    """
+    summary = Counter()
+
+    def write(futures):
+        for future in futures:
+            record = future.result()
+            summary[record['Drift']] += 1
+            stream.write(json.dumps(record, sort_keys=True) + '\n')
+            if sum(summary.values()) % METRICS_CLEAR_INTERVAL == 0:
+                CONSUMER_METRICS.clear()
+                PRODUCER_METRICS.clear()
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for account_id, aws_region in pairs:
+            if len(pending) >= max_workers * MAX_PENDING_PER_WORKER:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(done)
+            profile = profiles.profile(account_id) if profiles else DEFAULT_PROFILE
+            pending.add(executor.submit(plan_account_region, account_id, aws_region, event, profile))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            write(done)
+    stream.flush()
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='-', help='JSON lines file to write, - for stdout (default: -)')
+    parser.add_argument('--event', default='Update', choices=['Update', 'Delete'],
+                        help='Plan a stack update, or the reset of a stack deletion (default: Update)')
+    parser.add_argument('--accounts', nargs='+', help='Only plan these account IDs')
+    parser.add_argument('--max-workers', type=int, default=PLAN_MAX_WORKERS,
+                        help=f'Account/regions described concurrently (default: {PLAN_MAX_WORKERS})')
+    parser.add_argument('--log-level', default='WARNING', help='Log level (default: WARNING)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level, stream=sys.stderr)
+    # The Lambda metrics are not published by the plan
+    CONSUMER_METRICS.stream = PRODUCER_METRICS.stream = open(os.devnull, 'w')
+
+    selector = get_account_selector()
+    profiles = get_recorder_profiles()
+    pairs = iter_account_regions(get_client('cloudformation'), selector, set(args.accounts or []))
+
+    if args.output == '-':
+        summary = write_plan(pairs, args.event, sys.stdout, args.max_workers, profiles)
+    else:
+        with open(args.output, 'w') as stream:
+            summary = write_plan(pairs, args.event, stream, args.max_workers, profiles)
+    selector.log_summary()
+    print(json.dumps(dict(sorted(summary.items()))), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
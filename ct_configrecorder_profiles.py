@@ -0,0 +1,302 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Recorder profiles: named recorder settings for groups of accounts, shared by the Producer and Consumer Lambdas.
+
+The profiles come from the JSON document at RECORDER_PROFILES_DOCUMENT, an S3 object (s3://bucket/key)
+or a local file:
+
+    {
+        "Profiles": {
+            "sandbox": {
+                "ExcludedResourceTypes": ["AWS::EC2::NetworkInterface", "AWS::EC2::Volume"],
+                "DailyResourceTypes": ["AWS::EC2::Instance", "AWS::EC2::SecurityGroup"],
+                "RecordingFrequency": "DAILY",
+                "OrganizationalUnits": ["Root/Sandbox"]
+            },
+            "prod": {
+                "Strategy": "EXCLUSION",
+                "ExcludedResourceTypes": [],
+                "DailyResourceTypes": [],
+                "RecordingFrequency": "CONTINUOUS",
+                "Accounts": ["111111111111"],
+                "OrganizationalUnits": ["ou-ab12-34cd56ef", "Root/Workloads/Prod*"]
+            }
+        }
+    }
+
+Settings a profile omits are the ones of the "default" profile, the CONFIG_RECORDER_* environment
+variables, which applies to every account no profile is assigned to. Accounts lists account IDs and
+OrganizationalUnits OU or root IDs, or paths of OU names as in the account selection document. An
+account listed by ID gets that profile, any other account the first profile of the document with
+one of its organizational units.
+
+The Producer Lambda compiles the assignments into an account ID -> profile ID table, and sends the
+profile ID of the account in its message. Both functions parse the profiles once per container, and
+ct_configrecorder_recorder memoizes the payload of each (profile, home region, event), so the number
+of profiles adds no work per message.
+"""
+
+import logging
+import os
+import re
+import time
+from functools import partial
+
+from ct_configrecorder_documents import DocumentCache, find_parent_unit, read_document, resolve_organizational_units
+from ct_configrecorder_recorder import DEFAULT_PROFILE, DEFAULT_PROFILE_ID, recorded_resource_type_fields
+
+PROFILE_ID = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+# Document keys of the profile settings -> RecorderProfile fields
+PROFILE_SETTINGS = {
+    'Strategy': 'strategy',
+    'ExcludedResourceTypes': 'excluded_resource_types',
+    'IncludedResourceTypes': 'included_resource_types',
+    'DailyResourceTypes': 'daily_resource_types',
+    'DailyGlobalResourceTypes': 'daily_global_resource_types',
+    'RecordingFrequency': 'recording_frequency',
+}
+# Stack parameters of the resource type lists of the default profile
+PARAMETER_NAMES = {
+    'excluded_resource_types': 'ConfigRecorderExcludedResourceTypes',
+    'included_resource_types': 'ConfigRecorderIncludedResourceTypes',
+    'daily_resource_types': 'ConfigRecorderDailyResourceTypes',
+    'daily_global_resource_types': 'ConfigRecorderDailyGlobalResourceTypes',
+}
+ASSIGNMENT_KEYS = ('Accounts', 'OrganizationalUnits')
+ALLOWED_VALUES = {
+    'Strategy': ('EXCLUSION', 'INCLUSION'),
+    'RecordingFrequency': ('CONTINUOUS', 'DAILY'),
+}
+# A warm container compiles the profiles again after this long, to pick up changes to the document and the organization
+PROFILES_REFRESH_SECONDS = int(os.getenv('RECORDER_PROFILES_REFRESH_SECONDS', '900'))
+# A profile ID the Consumer Lambda does not know reads the document again, at most this often
+UNKNOWN_PROFILE_REFRESH_SECONDS = 60
+
+
+class UnknownProfileError(ValueError):
+    """
+    Raised for a profile ID that the recorder profiles document does not define.
+    """
+
+
+class RecorderProfiles:
+    """
+    Compiled recorder profiles and their assignments: deciding the profile of an account is a dict lookup.
+
+    Args:
+        profiles (dict): Profile ID -> RecorderProfile, besides the default profile
+        accounts (dict): Account ID -> profile ID, of the accounts assigned by ID
+        organizational_units (dict): Organizational unit ID -> profile ID, of the assigned OUs and every OU below them
+        organizational_unit_accounts (dict): Account ID -> profile ID, of the accounts in those organizational units
+    """
+
+    def __init__(self, profiles=None, accounts=None, organizational_units=None, organizational_unit_accounts=None):
+        self.profiles = dict(profiles or {})
+        self.profiles[DEFAULT_PROFILE_ID] = DEFAULT_PROFILE
+        self.accounts = dict(accounts or {})
+        self.organizational_units = dict(organizational_units or {})
+        # Accounts assigned by ID take precedence over their organizational units
+        self._assignments = dict(organizational_unit_accounts or {})
+        self._assignments.update(self.accounts)
+
+    def get(self, profile_id=None):
+        """
+        Return the RecorderProfile of a profile ID, or the default profile for no ID.
+
+        Raises:
+            UnknownProfileError: The profile is not defined
+        """
+        profile = self.profiles.get(profile_id or DEFAULT_PROFILE_ID)
+        if profile is None:
+            raise UnknownProfileError(f'Recorder profile {profile_id} is not defined')
+        return profile
+
+    def profile_id(self, account_id):
+        """
+        Return the ID of the profile assigned to an account.
+        """
+        return self._assignments.get(account_id, DEFAULT_PROFILE_ID)
+
+    def profile(self, account_id):
+        """
+        Return the RecorderProfile assigned to an account.
+        """
+        return self.profiles[self._assignments.get(account_id, DEFAULT_PROFILE_ID)]
+
+    def resolve(self, account_id, organizations_client=None):
+        """
+        Assign a profile to one account with its current organizational units, for accounts created
+        or moved since the assignments were compiled. AWS Organizations is only called when profiles
+        are assigned to organizational units; the compiled assignment is kept when it cannot be reached.
+
+        Returns:
+            str: The profile ID of the account
+        """
+        if not self.organizational_units or account_id in self.accounts:
+            return self.profile_id(account_id)
+        try:
+            unit_id = find_parent_unit(account_id, self.organizational_units, organizations_client)
+        except Exception as e:
+            logging.warning('Unable to look up the organizational units of account %s, using the compiled profile: %s: %s',
+                            account_id, e.__class__.__name__, e)
+            return self.profile_id(account_id)
+        profile_id = self.organizational_units.get(unit_id, DEFAULT_PROFILE_ID)
+        if profile_id == DEFAULT_PROFILE_ID:
+            self._assignments.pop(account_id, None)
+        else:
+            self._assignments[account_id] = profile_id
+        return profile_id
+
+
+def parse_profile(profile_id, settings, location):
+    """
+    Return the RecorderProfile of one profile of the document; omitted settings are the ones of the default profile.
+
+    Raises:
+        ValueError: The profile ID or one of its settings is not valid
+    """
+    if not PROFILE_ID.match(profile_id) or profile_id == DEFAULT_PROFILE_ID:
+        raise ValueError(f'Invalid recorder profile ID {profile_id!r} in {location}')
+    if not isinstance(settings, dict):
+        raise ValueError(f'Recorder profile {profile_id} of {location} is not a JSON object')
+
+    fields = {'name': profile_id}
+    for key, value in settings.items():
+        if key in ASSIGNMENT_KEYS:
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise ValueError(f'{key} of recorder profile {profile_id} of {location} is not a list of strings')
+        elif key in ALLOWED_VALUES:
+            if value not in ALLOWED_VALUES[key]:
+                raise ValueError(f'{key} of recorder profile {profile_id} of {location} is not one of '
+                                 f'{", ".join(ALLOWED_VALUES[key])}')
+            fields[PROFILE_SETTINGS[key]] = value
+        elif key in PROFILE_SETTINGS:
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise ValueError(f'{key} of recorder profile {profile_id} of {location} is not a list of resource types')
+            fields[PROFILE_SETTINGS[key]] = tuple(dict.fromkeys(item.strip() for item in value if item.strip()))
+        else:
+            logging.warning('Ignoring unknown key %s of recorder profile %s of %s', key, profile_id, location)
+    return DEFAULT_PROFILE._replace(**fields)
+
+
+def compile_profiles(location='', resolve_assignments=True):
+    """
+    Parse the recorder profiles document and, with resolve_assignments, compile the assignments of its
+    profiles. The Consumer Lambda only needs the settings of the profile IDs it receives.
+
+    Returns:
+        RecorderProfiles: The compiled profiles
+    """
+    started = time.perf_counter()
+    document = read_document(location, 'recorder profiles document')
+    definitions = document.get('Profiles', {})
+    if not isinstance(definitions, dict):
+        raise ValueError(f'Profiles of recorder profiles document {location} is not a JSON object')
+    for key in document:
+        if key != 'Profiles':
+            logging.warning('Ignoring unknown key %s of recorder profiles document %s', key, location)
+
+    profiles = {profile_id: parse_profile(profile_id, settings, location) for profile_id, settings in definitions.items()}
+    accounts, units, unit_accounts = {}, {}, {}
+    if resolve_assignments:
+        # The first profile of the document wins for accounts and organizational units assigned twice
+        for profile_id, settings in definitions.items():
+            for account_id in (account_id.strip() for account_id in settings.get('Accounts', [])):
+                if accounts.setdefault(account_id, profile_id) != profile_id:
+                    logging.warning('Account %s is assigned to recorder profiles %s and %s, using %s',
+                                    account_id, accounts[account_id], profile_id, accounts[account_id])
+            if settings.get('OrganizationalUnits'):
+                profile_units, profile_accounts = resolve_organizational_units(settings['OrganizationalUnits'])
+                for unit_id in profile_units:
+                    units.setdefault(unit_id, profile_id)
+                for account_id in profile_accounts:
+                    unit_accounts.setdefault(account_id, profile_id)
+
+    compiled = RecorderProfiles(profiles, accounts, units, unit_accounts)
+    if profiles:
+        logging.info('Recorder profiles compiled in %.1f ms: %s, %d accounts assigned by ID, %d organizational units '
+                     'with %d accounts', (time.perf_counter() - started) * 1000, ', '.join(profiles), len(accounts),
+                     len(units), len(unit_accounts))
+    return compiled
+
+
+# The Producer Lambda compiles the assignments of the profiles; the Consumer Lambda only parses them
+_PROFILES = {
+    resolve_assignments: DocumentCache(
+        'recorder profiles', partial(compile_profiles, resolve_assignments=resolve_assignments),
+        (('RECORDER_PROFILES_DOCUMENT', ''),), PROFILES_REFRESH_SECONDS)
+    for resolve_assignments in (True, False)
+}
+
+
+def get_recorder_profiles(resolve_assignments=True, refresh=False):
+    """
+    Return the compiled recorder profiles of the container, compiled again when RECORDER_PROFILES_DOCUMENT
+    changed, after PROFILES_REFRESH_SECONDS, or with refresh when they were compiled more than
+    UNKNOWN_PROFILE_REFRESH_SECONDS ago. When compiling again fails, the previous profiles are kept
+    until the next refresh.
+    """
+    return _PROFILES[resolve_assignments].get(UNKNOWN_PROFILE_REFRESH_SECONDS if refresh else None)
+
+
+def get_recorder_profile(profile_id):
+    """
+    Return the RecorderProfile of a profile ID received in a message, reading the document again
+    for an ID it did not define, which the Producer Lambda may have read from a newer document.
+
+    Raises:
+        UnknownProfileError: The profile is not defined
+    """
+    profiles = get_recorder_profiles(resolve_assignments=False)
+    if profile_id and profile_id not in profiles.profiles:
+        profiles = get_recorder_profiles(resolve_assignments=False, refresh=True)
+    return profiles.get(profile_id)
+
+
+def validate_resource_types(profiles, catalog):
+    """
+    Check the resource type lists the recorders of every profile use against the resource type catalog.
+
+    Args:
+        profiles (RecorderProfiles): Compiled recorder profiles
+        catalog (ResourceTypeCatalog): Resource type catalog
+
+    Returns:
+        tuple: (errors (list), warnings (list)), messages for the types the catalog does not know,
+               and for the types some regions do not record
+    """
+    document_keys = {field: key for key, field in PROFILE_SETTINGS.items()}
+    errors, warnings = [], []
+    for profile in profiles.profiles.values():
+        for field in recorded_resource_type_fields(profile):
+            if profile.name == DEFAULT_PROFILE_ID:
+                name = PARAMETER_NAMES[field]
+            else:
+                name = f'{document_keys[field]} of recorder profile {profile.name}'
+            unknown = catalog.unknown(getattr(profile, field))
+            if unknown:
+                errors.append(f'{name}: {", ".join(unknown)}')
+            for resource_type in getattr(profile, field):
+                regions = catalog.unsupported_regions(resource_type)
+                if regions:
+                    warnings.append(f'{resource_type} of {name} is not recorded in {", ".join(regions)}')
+    return errors, warnings
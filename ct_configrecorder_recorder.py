@@ -0,0 +1,351 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Desired configuration recorder settings shared by the Producer and Consumer Lambdas.
+
+The settings are read from the environment once per container, so both functions must be
+deployed with the same CONFIG_RECORDER_* and CONTROL_TOWER_HOME_REGION variables for their
+fingerprints to agree. They are the "default" recorder profile; the other profiles are read
+by ct_configrecorder_profiles. Resource types that the resource type catalog leaves out of a
+region (ct_configrecorder_catalog) are removed from the inclusion lists of that region; the
+other lists keep them, since a catalog older than AWS Config would otherwise record or record
+continuously the types they name.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from collections import namedtuple
+from functools import lru_cache
+from types import MappingProxyType
+
+from ct_configrecorder_catalog import get_resource_type_catalog
+
+
+def parse_resource_list(value):
+    '''
+    Split a comma separated list of resource types, dropping blanks and duplicates but keeping order
+    '''
+    return tuple(dict.fromkeys(item.strip() for item in value.split(',') if item.strip()))
+
+
+# Recorder settings are read and parsed once per container (cold start)
+CONFIG_RECORDER_STRATEGY = os.getenv('CONFIG_RECORDER_STRATEGY', 'EXCLUSION')
+CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST = parse_resource_list(os.getenv('CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST', ''))
+CONFIG_RECORDER_DAILY_GLOBAL_RESOURCE_LIST = parse_resource_list(os.getenv('CONFIG_RECORDER_OVERRIDE_DAILY_GLOBAL_RESOURCE_LIST', ''))
+CONFIG_RECORDER_EXCLUSION_RESOURCE_LIST = parse_resource_list(os.getenv('CONFIG_RECORDER_OVERRIDE_EXCLUDED_RESOURCE_LIST', ''))
+CONFIG_RECORDER_INCLUSION_RESOURCE_LIST = parse_resource_list(os.getenv('CONFIG_RECORDER_OVERRIDE_INCLUDED_RESOURCE_LIST', ''))
+CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY = os.getenv('CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY')
+CONTROL_TOWER_HOME_REGION = os.getenv('CONTROL_TOWER_HOME_REGION')
+
+# Named recorder settings; resource type lists are tuples so that profiles are hashable memoization keys
+RecorderProfile = namedtuple('RecorderProfile', (
+    'name', 'strategy', 'excluded_resource_types', 'included_resource_types', 'daily_resource_types',
+    'daily_global_resource_types', 'recording_frequency'))
+
+# Resource type lists of a profile that the recorder uses, per strategy; the daily global list only in the home region
+STRATEGY_RESOURCE_TYPE_FIELDS = {
+    'EXCLUSION': ('excluded_resource_types', 'daily_resource_types', 'daily_global_resource_types'),
+    'INCLUSION': ('included_resource_types', 'daily_resource_types', 'daily_global_resource_types'),
+}
+
+DEFAULT_PROFILE_ID = 'default'
+DEFAULT_PROFILE = RecorderProfile(
+    DEFAULT_PROFILE_ID, CONFIG_RECORDER_STRATEGY, CONFIG_RECORDER_EXCLUSION_RESOURCE_LIST,
+    CONFIG_RECORDER_INCLUSION_RESOURCE_LIST, CONFIG_RECORDER_OVERRIDE_DAILY_RESOURCE_LIST,
+    CONFIG_RECORDER_DAILY_GLOBAL_RESOURCE_LIST, CONFIG_RECORDER_DEFAULT_RECORDING_FREQUENCY)
+
+
+def freeze(value):
+    '''
+    Return a read-only copy of a payload: dicts become mapping proxies and lists become tuples
+    '''
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    '''
+    Return a mutable copy of a frozen payload that boto3 accepts as request parameters
+    '''
+    if isinstance(value, MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+@lru_cache(maxsize=None)
+def build_recorder_config(profile, is_home_region, event):
+    '''
+    Return the recordingGroup and recordingMode settings of a recorder profile for the region and event.
+
+    Profiles are immutable, so the result only depends on the arguments and is memoized per
+    (profile, home region, event). It is read-only; use thaw() for a copy to send to AWS Config.
+    '''
+    # Event = Delete is when stack is deleted, we rollback changed made and leave it as ControlTower Intended
+    if event == 'Delete':
+        return freeze({
+            'recordingGroup': {
+                'allSupported': True,
+                'includeGlobalResourceTypes': is_home_region
+            }
+        })
+
+    daily_resources = profile.daily_resource_types
+    if profile.strategy == 'EXCLUSION':
+        # For exclusion strategy, remove any resource type from daily list that are in exclusion list
+        excluded = set(profile.excluded_resource_types)
+        daily_resources = tuple(x for x in daily_resources if x not in excluded)
+
+    # Global resource types are recorded daily in the Control Tower home region only
+    if is_home_region:
+        daily_resources = tuple(dict.fromkeys(daily_resources + profile.daily_global_resource_types))
+
+    if profile.strategy == 'EXCLUSION':
+        logging.info('Using EXCLUSION strategy of profile %s', profile.name)
+        logging.info('Exclusion resource list: %s', profile.excluded_resource_types)
+        logging.info('Daily override resource list: %s', daily_resources)
+
+        config_recorder = {
+            'recordingGroup': {
+                'allSupported': False,
+                'includeGlobalResourceTypes': False,
+                'exclusionByResourceTypes': {
+                    'resourceTypes': list(profile.excluded_resource_types)
+                },
+                'recordingStrategy': {
+                    'useOnly': 'EXCLUSION_BY_RESOURCE_TYPES'
+                }
+            },
+            'recordingMode': {
+                'recordingFrequency': profile.recording_frequency,
+                'recordingModeOverrides': [
+                    {
+                        'description': 'DAILY_OVERRIDE',
+                        'resourceTypes': list(daily_resources),
+                        'recordingFrequency': 'DAILY'
+                    }
+                ] if daily_resources else []
+            }
+        }
+
+        if not profile.excluded_resource_types:
+            config_recorder['recordingGroup'].pop('exclusionByResourceTypes')
+            config_recorder['recordingGroup'].pop('recordingStrategy')
+            config_recorder['recordingGroup']['allSupported'] = True
+            config_recorder['recordingGroup']['includeGlobalResourceTypes'] = True
+    else:
+        logging.info('Using INCLUSION strategy of profile %s', profile.name)
+        # Make sure all resources in daily overrides are also in the inclusion list
+        included_resources = tuple(dict.fromkeys(profile.included_resource_types + daily_resources))
+
+        logging.info('Inclusion resource list: %s', included_resources)
+        logging.info('Daily override resource list: %s', daily_resources)
+
+        if not included_resources:
+            config_recorder = {
+                'recordingGroup': {
+                    'allSupported': False,
+                    'includeGlobalResourceTypes': False
+                }
+            }
+        else:
+            config_recorder = {
+                'recordingGroup': {
+                    'allSupported': False,
+                    'includeGlobalResourceTypes': False,
+                    'resourceTypes': list(included_resources),
+                    'recordingStrategy': {
+                        'useOnly': 'INCLUSION_BY_RESOURCE_TYPES'
+                    }
+                }
+            }
+
+        # Set up recording mode only if we have daily overrides
+        if daily_resources:
+            config_recorder['recordingMode'] = {
+                'recordingFrequency': profile.recording_frequency,
+                'recordingModeOverrides': [
+                    {
+                        'description': 'DAILY_OVERRIDE',
+                        'resourceTypes': list(daily_resources),
+                        'recordingFrequency': 'DAILY'
+                    }
+                ]
+            }
+
+    return freeze(config_recorder)
+
+
+def recorded_resource_type_fields(profile, is_home_region=True):
+    '''
+    Return the names of the resource type lists of a profile that its recorders use
+    '''
+    fields = STRATEGY_RESOURCE_TYPE_FIELDS['EXCLUSION' if profile.strategy == 'EXCLUSION' else 'INCLUSION']
+    return fields if is_home_region else fields[:-1]
+
+
+@lru_cache(maxsize=4096)
+def supported_profile(profile, aws_region, catalog):
+    '''
+    Return the profile without the included resource types the catalog leaves out of the region,
+    or the profile itself when it has none. Excluded and daily resource types the catalog leaves
+    out are kept, with a warning. Memoized, so the types are logged once per container
+    '''
+    fields = {}
+    removed = {}
+    unchecked = {}
+    for field in recorded_resource_type_fields(profile, aws_region == CONTROL_TOWER_HOME_REGION):
+        resource_types = getattr(profile, field)
+        kept = tuple(resource_type for resource_type in resource_types if catalog.is_supported(resource_type, aws_region))
+        if len(kept) == len(resource_types):
+            continue
+        left_out = dict.fromkeys(resource_type for resource_type in resource_types if resource_type not in kept)
+        # Only an inclusion list is safe to shorten: leaving a type out of an exclusion or daily list
+        # would record it, or record it continuously, if AWS Config knows it after all
+        if field == 'included_resource_types':
+            fields[field] = kept
+            removed.update(left_out)
+        else:
+            unchecked.update(left_out)
+    if unchecked:
+        logging.warning('Keeping resource types in the exclusion and daily lists of profile %s in %s, unknown or not recorded '
+                        'there according to the resource type catalog %s: %s', profile.name, aws_region, catalog.source, ', '.join(unchecked))
+    if not fields:
+        return profile
+    logging.warning('Leaving resource types out of the recorders of profile %s in %s, unknown or not recorded there '
+                    'according to the resource type catalog %s: %s', profile.name, aws_region, catalog.source, ', '.join(removed))
+    return profile._replace(**fields)
+
+
+def region_recorder_config(profile, aws_region, event):
+    '''
+    Return the memoized settings of a profile for a region and event, without the resource types
+    the region does not record. It is read-only; use thaw() for a copy to send to AWS Config
+    '''
+    # The settings of a stack deletion have no resource type lists
+    if event != 'Delete':
+        profile = supported_profile(profile, aws_region, get_resource_type_catalog())
+    return build_recorder_config(profile, aws_region == CONTROL_TOWER_HOME_REGION, event)
+
+
+def normalize_recorder(recorder):
+    '''
+    Return a comparable form of a configuration recorder: resource type lists become
+    sets and omitted fields get the defaults AWS Config applies
+    '''
+    group = recorder.get('recordingGroup') or {'allSupported': True}
+    all_supported = group.get('allSupported', False)
+    included = frozenset(group.get('resourceTypes') or [])
+    excluded = frozenset((group.get('exclusionByResourceTypes') or {}).get('resourceTypes') or [])
+
+    use_only = (group.get('recordingStrategy') or {}).get('useOnly')
+    if not use_only:
+        if all_supported:
+            use_only = 'ALL_SUPPORTED_RESOURCE_TYPES'
+        elif excluded:
+            use_only = 'EXCLUSION_BY_RESOURCE_TYPES'
+        else:
+            use_only = 'INCLUSION_BY_RESOURCE_TYPES'
+
+    mode = recorder.get('recordingMode') or {}
+    overrides = frozenset(
+        (override.get('description', ''),
+         frozenset(override.get('resourceTypes') or []),
+         override.get('recordingFrequency'))
+        for override in mode.get('recordingModeOverrides') or [])
+
+    return {
+        'roleARN': recorder.get('roleARN'),
+        'allSupported': all_supported,
+        'includeGlobalResourceTypes': group.get('includeGlobalResourceTypes', False),
+        'useOnly': use_only,
+        'resourceTypes': included if use_only == 'INCLUSION_BY_RESOURCE_TYPES' else frozenset(),
+        'exclusionResourceTypes': excluded if use_only == 'EXCLUSION_BY_RESOURCE_TYPES' else frozenset(),
+        'recordingFrequency': mode.get('recordingFrequency') or 'CONTINUOUS',
+        'recordingModeOverrides': overrides
+    }
+
+
+def recorder_matches(existing_recorder, config_recorder):
+    '''
+    Return True when the described recorder already has the settings about to be written
+    '''
+    return normalize_recorder(existing_recorder) == normalize_recorder(config_recorder)
+
+
+def _plain(value):
+    '''
+    Return a JSON serializable form of a normalized recorder field, with sets as sorted lists
+    '''
+    if isinstance(value, frozenset):
+        return sorted((_plain(item) for item in value), key=json.dumps)
+    if isinstance(value, tuple):
+        return [_plain(item) for item in value]
+    return value
+
+
+def recorder_diff(existing_recorder, config_recorder):
+    '''
+    Return the fields of the normalized recorders that differ, as field -> {'Current', 'Desired'},
+    with the resource types 'Added' and 'Removed' for resource type lists
+    '''
+    current = normalize_recorder(existing_recorder)
+    desired = normalize_recorder(config_recorder)
+    changes = {}
+    for field, desired_value in desired.items():
+        current_value = current[field]
+        if current_value == desired_value:
+            continue
+        change = {'Current': _plain(current_value), 'Desired': _plain(desired_value)}
+        if field in ('resourceTypes', 'exclusionResourceTypes'):
+            change['Added'] = sorted(desired_value - current_value)
+            change['Removed'] = sorted(current_value - desired_value)
+        changes[field] = change
+    return changes
+
+
+def fingerprint(payload):
+    '''
+    Return a stable hash of a recorder payload, independent of key order
+    '''
+    canonical = json.dumps(thaw(payload), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def desired_fingerprint(aws_region, event, profile=DEFAULT_PROFILE):
+    '''
+    Return the fingerprint of the settings the Consumer applies for the event in a region with a recorder profile
+    '''
+    return _catalog_fingerprint(aws_region, event, profile, get_resource_type_catalog() if event != 'Delete' else None)
+
+
+@lru_cache(maxsize=4096)
+def _catalog_fingerprint(aws_region, event, profile, catalog):
+    '''
+    Memoized desired_fingerprint for one version of the resource type catalog
+    '''
+    return fingerprint(region_recorder_config(profile, aws_region, event))
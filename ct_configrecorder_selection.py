@@ -0,0 +1,218 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Account selection of the Producer Lambda, compiled once per container.
+
+The rules come from the ACCOUNT_SELECTION_MODE, EXCLUDED_ACCOUNTS and INCLUDED_ACCOUNTS environment
+variables and, for more accounts than an environment variable holds, from the JSON document at
+ACCOUNT_SELECTION_DOCUMENT, an S3 object (s3://bucket/key) or a local file:
+
+    {
+        "ExcludedAccounts": ["111111111111", "2222222222*"],
+        "ExcludedOrganizationalUnits": ["ou-ab12-34cd56ef", "Root/Sandbox"],
+        "IncludedAccounts": [],
+        "IncludedOrganizationalUnits": ["Root/Workloads/*"]
+    }
+
+Account rules are account IDs or wildcard patterns. Organizational unit rules are OU or root IDs,
+or paths of OU names starting with "Root", also with wildcards; they select the accounts of the
+matching OUs and of every OU below them. Only the rules of the current mode are compiled.
+
+Compiling resolves the organizational unit rules into account IDs with AWS Organizations, so
+deciding for an account is a set lookup, or one match of the wildcard patterns memoized per
+account. Decisions are counted and logged once per invocation instead of once per account.
+"""
+
+import ast
+import logging
+import os
+import time
+from collections import Counter
+
+from ct_configrecorder_documents import (
+    DocumentCache, compile_patterns, find_parent_unit, read_document, resolve_organizational_units)
+
+EXCLUSION = 'EXCLUSION'
+INCLUSION = 'INCLUSION'
+DOCUMENT_KEYS = ('ExcludedAccounts', 'ExcludedOrganizationalUnits', 'IncludedAccounts', 'IncludedOrganizationalUnits')
+WILDCARD_CHARACTERS = frozenset('*?[')
+# A warm container compiles the rules again after this long, to pick up changes to the document and the organization
+SELECTION_REFRESH_SECONDS = int(os.getenv('ACCOUNT_SELECTION_REFRESH_SECONDS', '900'))
+
+
+def has_wildcard(rule):
+    return not WILDCARD_CHARACTERS.isdisjoint(rule)
+
+
+class AccountSelector:
+    """
+    Compiled account selection: the accounts selected by the rules are excluded in EXCLUSION
+    mode and are the only ones processed in INCLUSION mode.
+
+    Args:
+        mode (str): 'EXCLUSION' or 'INCLUSION'
+        accounts (iterable): Account IDs of the account rules
+        patterns (iterable): Wildcard patterns of account IDs
+        organizational_units (iterable): IDs of the organizational units the rules select, with every OU below them
+        organizational_unit_accounts (iterable): IDs of the accounts in those organizational units
+    """
+
+    def __init__(self, mode=EXCLUSION, accounts=(), patterns=(), organizational_units=(), organizational_unit_accounts=()):
+        self.mode = INCLUSION if mode == INCLUSION else EXCLUSION
+        self.accounts = frozenset(accounts)
+        self.patterns = tuple(patterns)
+        self.organizational_units = frozenset(organizational_units)
+        self.organizational_unit_accounts = frozenset(organizational_unit_accounts)
+        self.counts = Counter()
+        self._pattern = compile_patterns(self.patterns)
+        self._matches = {}  # account_id -> selected, for patterns and resolved accounts
+
+    def matches(self, account_id):
+        """
+        Return True if the rules select the account.
+        """
+        selected = self._matches.get(account_id)
+        if selected is not None:
+            return selected
+        if account_id in self.accounts or account_id in self.organizational_unit_accounts:
+            return True
+        if self._pattern is None:
+            return False
+        selected = self._matches[account_id] = self._pattern.match(account_id) is not None
+        return selected
+
+    def should_process(self, account_id):
+        """
+        Return True if the account is processed in the selection mode, and count the decision.
+        """
+        selected = self.matches(account_id)
+        process = selected if self.mode == INCLUSION else not selected
+        self.counts['included' if process else 'excluded'] += 1
+        return process
+
+    def is_excluded(self, account_id):
+        """
+        Return True if the account is excluded by the rules of EXCLUSION mode.
+        """
+        return self.mode == EXCLUSION and self.matches(account_id)
+
+    def resolve(self, account_id, organizations_client=None):
+        """
+        Decide for one account with its current organizational units, for accounts created or
+        moved since the rules were compiled. AWS Organizations is only called when there are
+        organizational unit rules; the compiled decision is kept when it cannot be reached.
+
+        Returns:
+            bool: True if the rules select the account
+        """
+        if not self.organizational_units:
+            return self.matches(account_id)
+        selected = account_id in self.accounts or bool(self._pattern and self._pattern.match(account_id))
+        try:
+            if not selected:
+                selected = find_parent_unit(account_id, self.organizational_units, organizations_client) is not None
+        except Exception as e:
+            logging.warning('Unable to look up the organizational units of account %s, using the compiled selection: %s: %s',
+                            account_id, e.__class__.__name__, e)
+            return self.matches(account_id)
+        self._matches[account_id] = selected
+        return selected
+
+    def log_summary(self):
+        """
+        Log the number of accounts included and excluded since the last summary.
+        """
+        if self.counts:
+            logging.info('Account selection (%s mode): %d accounts included, %d excluded',
+                         self.mode, self.counts['included'], self.counts['excluded'])
+        self.counts.clear()
+
+
+def parse_account_list(value, name):
+    """
+    Parse an account list environment variable, a Python list literal such as "['111111111111']".
+    """
+    try:
+        accounts = ast.literal_eval(value or '[]')
+    except (ValueError, SyntaxError) as e:
+        logging.error('Failed to parse %s: %s', name, e)
+        return []
+    if not isinstance(accounts, (list, tuple, set)):
+        logging.error('Failed to parse %s: not a list', name)
+        return []
+    return [str(account).strip() for account in accounts]
+
+
+def load_selection_document(location):
+    """
+    Return the selection document at an s3://bucket/key location or a local path, or {} for no location.
+
+    Raises:
+        ValueError: The document is not a JSON object of rule lists
+    """
+    document = read_document(location, 'account selection document')
+    for key, rules in document.items():
+        if key not in DOCUMENT_KEYS:
+            logging.warning('Ignoring unknown key %s of account selection document %s', key, location)
+        elif not isinstance(rules, list) or not all(isinstance(rule, str) for rule in rules):
+            raise ValueError(f'{key} of account selection document {location} is not a list of strings')
+    return document
+
+
+def compile_selector(mode=EXCLUSION, excluded_accounts='[]', included_accounts='[]', document_location=''):
+    """
+    Compile the rules of the selection mode from the environment variable values and the selection document.
+
+    Returns:
+        AccountSelector: The compiled selection
+    """
+    started = time.perf_counter()
+    mode = INCLUSION if mode == INCLUSION else EXCLUSION
+    document = load_selection_document(document_location)
+    if mode == INCLUSION:
+        account_rules = parse_account_list(included_accounts, 'INCLUDED_ACCOUNTS') + document.get('IncludedAccounts', [])
+        unit_rules = document.get('IncludedOrganizationalUnits', [])
+    else:
+        account_rules = parse_account_list(excluded_accounts, 'EXCLUDED_ACCOUNTS') + document.get('ExcludedAccounts', [])
+        unit_rules = document.get('ExcludedOrganizationalUnits', [])
+
+    units, unit_accounts = resolve_organizational_units(unit_rules) if unit_rules else (set(), set())
+    selector = AccountSelector(
+        mode, [rule for rule in account_rules if not has_wildcard(rule)], [rule for rule in account_rules if has_wildcard(rule)],
+        units, unit_accounts)
+    logging.info('Account selection compiled in %.1f ms: %s mode, %d accounts, %d patterns, '
+                 '%d organizational units with %d accounts', (time.perf_counter() - started) * 1000, mode,
+                 len(selector.accounts), len(selector.patterns), len(units), len(unit_accounts))
+    return selector
+
+
+_SELECTOR = DocumentCache('account selection', compile_selector, (
+    ('ACCOUNT_SELECTION_MODE', EXCLUSION), ('EXCLUDED_ACCOUNTS', '[]'), ('INCLUDED_ACCOUNTS', '[]'),
+    ('ACCOUNT_SELECTION_DOCUMENT', '')), SELECTION_REFRESH_SECONDS)
+
+
+def get_account_selector():
+    """
+    Return the compiled account selection of the container, compiled again when the environment
+    changed or after SELECTION_REFRESH_SECONDS. When compiling again fails, the previous selection
+    is kept until the next refresh.
+    """
+    return _SELECTOR.get()
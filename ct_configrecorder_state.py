@@ -0,0 +1,379 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Store of the configuration recorder settings last applied to each account and region.
+
+The Consumer Lambda records the fingerprint of the settings it applied, together with the
+StackSet operation that last deployed the Control Tower baseline to the stack instance. The
+Producer Lambda compares them with the desired fingerprint and the current operation to only
+enqueue the account/regions that are out of date.
+
+The Producer Lambda also keeps short-lived pending markers of the work it enqueued, so the same
+work requested again by a burst of events is only enqueued once. The Consumer Lambda deletes them
+once the work is applied or quarantined.
+
+Account/regions the Consumer Lambda could not update are recorded in a failure ledger, from
+which the Producer Lambda re-drives them. Recording the settings applied to an account/region
+deletes its ledger entry in the same write.
+
+Backends:
+    DynamoDBStateStore: production, selected by the STATE_TABLE_NAME environment variable
+    SQLiteStateStore: local runs and benchmarks, selected by the STATE_STORE_PATH environment variable
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+
+from ct_configrecorder_clients import get_client
+from ct_configrecorder_throttling import call_with_retry
+
+# batch_get_item accepts at most 100 keys per call
+DYNAMODB_BATCH_SIZE = 100
+# batch_write_item accepts at most 25 requests per call
+DYNAMODB_WRITE_BATCH_SIZE = 25
+# Attempts to read or write keys DynamoDB returned as unprocessed, on top of call_with_retry
+DYNAMODB_MAX_UNPROCESSED_ATTEMPTS = 5
+# Pending markers and failure ledger entries share the table with the applied state, under these prefixes of the sort key
+PENDING_PREFIX = 'pending#'
+FAILURE_PREFIX = 'failure#'
+# Sparse index of the failure ledger entries, which all have Ledger = FAILURE_LEDGER_PARTITION
+FAILURE_LEDGER_INDEX = 'FailureLedger'
+FAILURE_LEDGER_PARTITION = 'failed'
+# Longest error message kept in the failure ledger
+MAX_ERROR_MESSAGE_LENGTH = 1024
+
+
+class StateStore:
+    """
+    Interface of the state stores. Records are dicts with 'Fingerprint' and 'Operation' keys.
+
+    Pending markers hold an opaque token identifying the work enqueued for an account/region,
+    and expire after a given time.
+
+    Failure ledger entries are dicts with 'Account', 'Region', 'Event', 'Operation', 'ErrorCode',
+    'ErrorMessage', 'Attempts' and 'FailedAt' keys.
+    """
+
+    def get_many(self, keys):
+        """
+        Return the records of the given (account, region) keys that exist, by key.
+        """
+        raise NotImplementedError
+
+    def put(self, account, region, fingerprint, operation=None):
+        """
+        Record the settings applied to an account/region and delete its failure ledger entry.
+        """
+        raise NotImplementedError
+
+    def get_pending(self, keys):
+        """
+        Return the token of the unexpired pending markers of the given (account, region) keys, by key.
+        """
+        raise NotImplementedError
+
+    def put_pending(self, entries, expires_at):
+        """
+        Mark (account, region, token) entries as pending until expires_at (epoch seconds).
+        """
+        raise NotImplementedError
+
+    def delete_pending(self, keys):
+        raise NotImplementedError
+
+    def put_failure(self, account, region, event, operation, error_code, error_message, attempts):
+        """
+        Record the last failure of an account/region in the failure ledger.
+        """
+        raise NotImplementedError
+
+    def list_failures(self):
+        """
+        Return every entry of the failure ledger, oldest failure first.
+        """
+        raise NotImplementedError
+
+    def delete_failures(self, keys):
+        raise NotImplementedError
+
+
+class SQLiteStateStore(StateStore):
+    """
+    State store in a local SQLite database file, shared by every thread of the process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Imported here: the Lambdas only use DynamoDB
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS applied_state ('
+            'account TEXT NOT NULL, region TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+            'operation TEXT, updated_at TEXT NOT NULL, PRIMARY KEY (account, region))')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS pending_dispatch ('
+            'account TEXT NOT NULL, region TEXT NOT NULL, token TEXT NOT NULL, '
+            'expires_at REAL NOT NULL, PRIMARY KEY (account, region))')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS failure_ledger ('
+            'account TEXT NOT NULL, region TEXT NOT NULL, event TEXT NOT NULL, operation TEXT, '
+            'error_code TEXT NOT NULL, error_message TEXT NOT NULL, attempts INTEGER NOT NULL, '
+            'failed_at TEXT NOT NULL, PRIMARY KEY (account, region))')
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    def _select(self, columns, table, keys):
+        """
+        Yield the rows of the table matching the (account, region) keys.
+        """
+        keys = list(keys)
+        # SQLite limits the number of bound parameters per statement
+        for start in range(0, len(keys), 400):
+            chunk = keys[start:start + 400]
+            where = ' OR '.join(['(account = ? AND region = ?)'] * len(chunk))
+            yield from self._connection.execute(
+                f'SELECT {columns} FROM {table} WHERE {where}',
+                [value for key in chunk for value in key])
+
+    def get_many(self, keys):
+        records = {}
+        with self._lock:
+            for account, region, fingerprint, operation in self._select(
+                    'account, region, fingerprint, operation', 'applied_state', keys):
+                records[(account, region)] = {'Fingerprint': fingerprint, 'Operation': operation}
+        return records
+
+    def put(self, account, region, fingerprint, operation=None):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO applied_state VALUES (?, ?, ?, ?, ?)',
+                (account, region, fingerprint, operation, datetime.now(timezone.utc).isoformat()))
+            self._connection.execute(
+                'DELETE FROM failure_ledger WHERE account = ? AND region = ?', (account, region))
+            self._connection.commit()
+
+    def get_pending(self, keys):
+        now = time.time()
+        with self._lock:
+            return {(account, region): token for account, region, token, expires_at in self._select(
+                'account, region, token, expires_at', 'pending_dispatch', keys) if expires_at > now}
+
+    def put_pending(self, entries, expires_at):
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO pending_dispatch VALUES (?, ?, ?, ?)',
+                [(account, region, token, expires_at) for account, region, token in entries])
+            self._connection.commit()
+
+    def delete_pending(self, keys):
+        with self._lock:
+            self._connection.executemany(
+                'DELETE FROM pending_dispatch WHERE account = ? AND region = ?', list(keys))
+            self._connection.commit()
+
+    def put_failure(self, account, region, event, operation, error_code, error_message, attempts):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO failure_ledger VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (account, region, event, operation, error_code, error_message[:MAX_ERROR_MESSAGE_LENGTH],
+                 attempts, datetime.now(timezone.utc).isoformat()))
+            self._connection.commit()
+
+    def list_failures(self):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT account, region, event, operation, error_code, error_message, attempts, failed_at '
+                'FROM failure_ledger ORDER BY failed_at').fetchall()
+        columns = ('Account', 'Region', 'Event', 'Operation', 'ErrorCode', 'ErrorMessage', 'Attempts', 'FailedAt')
+        return [dict(zip(columns, row)) for row in rows]
+
+    def delete_failures(self, keys):
+        with self._lock:
+            self._connection.executemany(
+                'DELETE FROM failure_ledger WHERE account = ? AND region = ?', list(keys))
+            self._connection.commit()
+
+
+class DynamoDBStateStore(StateStore):
+    """
+    State store in a DynamoDB table with partition key 'Account' and sort key 'Region'.
+    """
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client or get_client('dynamodb')
+        self.region = os.getenv('AWS_REGION')
+
+    def _batch_get(self, keys, projection):
+        """
+        Yield the items of the (account, sort key) keys that exist, with the projected attributes.
+        """
+        keys = list(keys)
+        for start in range(0, len(keys), DYNAMODB_BATCH_SIZE):
+            request = {self.table_name: {
+                'Keys': [{'Account': {'S': account}, 'Region': {'S': region}}
+                         for account, region in keys[start:start + DYNAMODB_BATCH_SIZE]],
+                'ProjectionExpression': projection,
+                'ExpressionAttributeNames': {'#region': 'Region'},
+            }}
+            for _ in range(DYNAMODB_MAX_UNPROCESSED_ATTEMPTS):
+                response = call_with_retry('dynamodb', self.region, self.client.batch_get_item, RequestItems=request)
+                yield from response.get('Responses', {}).get(self.table_name, [])
+                request = response.get('UnprocessedKeys')
+                if not request:
+                    break
+
+    def _batch_write(self, requests):
+        """
+        Send put/delete requests with batch_write_item and return the number left unprocessed.
+        """
+        unprocessed = 0
+        for start in range(0, len(requests), DYNAMODB_WRITE_BATCH_SIZE):
+            request = {self.table_name: requests[start:start + DYNAMODB_WRITE_BATCH_SIZE]}
+            for _ in range(DYNAMODB_MAX_UNPROCESSED_ATTEMPTS):
+                response = call_with_retry('dynamodb', self.region, self.client.batch_write_item, RequestItems=request)
+                request = response.get('UnprocessedItems')
+                if not request:
+                    break
+            if request:
+                unprocessed += len(request.get(self.table_name, []))
+        return unprocessed
+
+    def get_many(self, keys):
+        records = {}
+        for item in self._batch_get(keys, 'Account, #region, Fingerprint, Operation'):
+            records[(item['Account']['S'], item['Region']['S'])] = {
+                'Fingerprint': item['Fingerprint']['S'],
+                'Operation': item.get('Operation', {}).get('S'),
+            }
+        # Keys still unprocessed are missing from the result, so they are treated as out of date
+        return records
+
+    def put(self, account, region, fingerprint, operation=None):
+        item = {
+            'Account': {'S': account},
+            'Region': {'S': region},
+            'Fingerprint': {'S': fingerprint},
+            'UpdatedAt': {'S': datetime.now(timezone.utc).isoformat()},
+        }
+        if operation:
+            item['Operation'] = {'S': operation}
+        # One batch_write_item call saves the applied state and deletes the failure ledger entry
+        unprocessed = self._batch_write([
+            {'PutRequest': {'Item': item}},
+            {'DeleteRequest': {'Key': {'Account': {'S': account}, 'Region': {'S': FAILURE_PREFIX + region}}}},
+        ])
+        if unprocessed:
+            raise RuntimeError(f'Applied state of {account} {region} not saved')
+
+    def get_pending(self, keys):
+        now = time.time()
+        pending = {}
+        # Expired items are deleted by the table TTL, but not necessarily yet
+        for item in self._batch_get([(account, PENDING_PREFIX + region) for account, region in keys],
+                                    'Account, #region, PendingToken, ExpiresAt'):
+            if float(item['ExpiresAt']['N']) > now:
+                pending[(item['Account']['S'], item['Region']['S'][len(PENDING_PREFIX):])] = item['PendingToken']['S']
+        return pending
+
+    def put_pending(self, entries, expires_at):
+        # Markers not written only mean the work may be enqueued twice
+        self._batch_write([{'PutRequest': {'Item': {
+            'Account': {'S': account},
+            'Region': {'S': PENDING_PREFIX + region},
+            'PendingToken': {'S': token},
+            'ExpiresAt': {'N': str(int(expires_at))},
+        }}} for account, region, token in entries])
+
+    def delete_pending(self, keys):
+        unprocessed = self._batch_write([{'DeleteRequest': {'Key': {
+            'Account': {'S': account},
+            'Region': {'S': PENDING_PREFIX + region},
+        }}} for account, region in keys])
+        if unprocessed:
+            raise RuntimeError(f'{unprocessed} pending markers not deleted')
+
+    def put_failure(self, account, region, event, operation, error_code, error_message, attempts):
+        item = {
+            'Account': {'S': account},
+            'Region': {'S': FAILURE_PREFIX + region},
+            'Ledger': {'S': FAILURE_LEDGER_PARTITION},
+            'FailedAt': {'S': datetime.now(timezone.utc).isoformat()},
+            'Event': {'S': event},
+            'ErrorCode': {'S': error_code},
+            'ErrorMessage': {'S': error_message[:MAX_ERROR_MESSAGE_LENGTH]},
+            'Attempts': {'N': str(attempts)},
+        }
+        if operation:
+            item['Operation'] = {'S': operation}
+        call_with_retry('dynamodb', self.region, self.client.put_item, TableName=self.table_name, Item=item)
+
+    def list_failures(self):
+        failures = []
+        kwargs = {
+            'TableName': self.table_name,
+            'IndexName': FAILURE_LEDGER_INDEX,
+            'KeyConditionExpression': 'Ledger = :failed',
+            'ExpressionAttributeValues': {':failed': {'S': FAILURE_LEDGER_PARTITION}},
+        }
+        while True:
+            response = call_with_retry('dynamodb', self.region, self.client.query, **kwargs)
+            for item in response.get('Items', []):
+                failures.append({
+                    'Account': item['Account']['S'],
+                    'Region': item['Region']['S'][len(FAILURE_PREFIX):],
+                    'Event': item['Event']['S'],
+                    'Operation': item.get('Operation', {}).get('S'),
+                    'ErrorCode': item['ErrorCode']['S'],
+                    'ErrorMessage': item['ErrorMessage']['S'],
+                    'Attempts': int(item['Attempts']['N']),
+                    'FailedAt': item['FailedAt']['S'],
+                })
+            if not response.get('LastEvaluatedKey'):
+                return failures
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def delete_failures(self, keys):
+        unprocessed = self._batch_write([{'DeleteRequest': {'Key': {
+            'Account': {'S': account},
+            'Region': {'S': FAILURE_PREFIX + region},
+        }}} for account, region in keys])
+        if unprocessed:
+            raise RuntimeError(f'{unprocessed} failure ledger entries not deleted')
+
+
+@lru_cache(maxsize=None)
+def get_state_store():
+    """
+    Return the state store configured by the environment, created once per container,
+    or None when neither STATE_TABLE_NAME nor STATE_STORE_PATH is set.
+    """
+    table_name = os.getenv('STATE_TABLE_NAME')
+    if table_name:
+        return DynamoDBStateStore(table_name)
+    path = os.getenv('STATE_STORE_PATH')
+    if path:
+        return SQLiteStateStore(path)
+    return None
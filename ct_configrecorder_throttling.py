@@ -0,0 +1,298 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Retry and rate control shared by the Producer and Consumer Lambdas.
+
+Every AWS call made through call_with_retry goes through a token bucket and an
+adaptive concurrency limit for its (service, region), and is retried with jittered
+exponential backoff when it fails with a throttling or transient error. Clients
+created with CLIENT_CONFIG leave retries to this module instead of botocore.
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+import botocore.config
+import botocore.exceptions
+
+# Error codes AWS services use to signal throttling
+THROTTLING_ERROR_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'SlowDown',
+    'PriorRequestNotComplete',
+])
+
+# Error codes for failures that are expected to succeed when retried
+TRANSIENT_ERROR_CODES = frozenset([
+    'RequestTimeout',
+    'RequestTimeoutException',
+    'InternalError',
+    'InternalFailure',
+    'InternalServerError',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+])
+
+# Error codes for failures that retrying the same request will not fix, such as a missing
+# AWSControlTowerExecution role or a region that is not enabled in the account
+PERMANENT_ERROR_CODES = frozenset([
+    'AccessDenied',
+    'AccessDeniedException',
+    'AuthFailure',
+    'InvalidClientTokenId',
+    'UnrecognizedClientException',
+    'OptInRequired',
+    'InvalidRoleException',
+    'InvalidRecordingGroupException',
+    'ValidationException',
+])
+
+# Sustained requests per second allowed per (service, region) in one container
+DEFAULT_RATES = {
+    'cloudformation': 5.0,
+    'config': 10.0,
+    'dynamodb': 50.0,
+    'sqs': 50.0,
+    'sts': 20.0,
+}
+DEFAULT_RATE = 10.0
+
+# Attempts per call, including the first one
+MAX_ATTEMPTS = 6
+BASE_DELAY_SECONDS = 0.25
+MAX_DELAY_SECONDS = 10.0
+
+# Concurrent calls per (service, region): halved on throttling, raised by one after a run of successes
+INITIAL_CONCURRENCY = 4
+MAX_CONCURRENCY = 16
+SUCCESSES_BEFORE_INCREASE = 10
+
+# botocore retries are disabled for clients whose calls go through call_with_retry
+CLIENT_CONFIG = botocore.config.Config(retries={'total_max_attempts': 1})
+
+
+def error_code(exception):
+    """
+    Return the AWS error code of a ClientError, or None for any other exception.
+    """
+    if isinstance(exception, botocore.exceptions.ClientError):
+        return exception.response.get('Error', {}).get('Code')
+    return None
+
+
+def is_throttling_error(exception):
+    return error_code(exception) in THROTTLING_ERROR_CODES
+
+
+def is_permanent_error(exception):
+    return error_code(exception) in PERMANENT_ERROR_CODES
+
+
+def is_retryable_error(exception):
+    """
+    Return True for throttling, transient service and connection errors.
+    """
+    if isinstance(exception, (botocore.exceptions.ConnectionError, botocore.exceptions.ReadTimeoutError)):
+        return True
+    code = error_code(exception)
+    return code in THROTTLING_ERROR_CODES or code in TRANSIENT_ERROR_CODES
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` calls per second with bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+        """
+        while True:
+            with self._lock:
+                now = self._clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self._sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit that is halved when calls are throttled and grows by one
+    after SUCCESSES_BEFORE_INCREASE consecutive successful calls.
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = initial
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.throttles = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self.successes += 1
+            if self.successes >= SUCCESSES_BEFORE_INCREASE and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self._condition.notify()
+
+    def on_throttle(self):
+        with self._condition:
+            self.throttles += 1
+            self.successes = 0
+            self.limit = max(1, self.limit // 2)
+
+
+class RateController:
+    """
+    Per (service, region) token buckets and concurrency limits, with retries.
+
+    The clock, sleep and random functions can be replaced to drive the controller
+    against local stubs without waiting.
+    """
+
+    def __init__(self, rates=None, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY_SECONDS,
+                 max_delay=MAX_DELAY_SECONDS, clock=time.monotonic, sleep=time.sleep, uniform=random.uniform):
+        self.rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._sleep = sleep
+        self._uniform = uniform
+        self._buckets = {}
+        self._limits = {}
+        self._calls = Counter()
+        self._lock = threading.Lock()
+
+    def bucket(self, service, region):
+        key = (service, region)
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rates.get(service, DEFAULT_RATE), clock=self._clock, sleep=self._sleep)
+            return self._buckets[key]
+
+    def concurrency(self, service, region):
+        key = (service, region)
+        with self._lock:
+            if key not in self._limits:
+                self._limits[key] = AdaptiveConcurrency()
+            return self._limits[key]
+
+    def backoff(self, attempt):
+        """
+        Full jitter: a random delay between 0 and the exponential backoff for the attempt.
+        """
+        return self._uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def count_call(self, service, result):
+        with self._lock:
+            self._calls[(service, result)] += 1
+
+    def drain_call_counts(self):
+        """
+        Return the number of attempts per (service, result) since the last drain, and reset them.
+        The result is 'Success', 'Throttled' or 'Error'.
+        """
+        with self._lock:
+            calls, self._calls = self._calls, Counter()
+        return calls
+
+    def call(self, service, region, operation, *args, **kwargs):
+        """
+        Call operation(*args, **kwargs) under the rate limits of (service, region),
+        retrying throttling and transient errors. Other errors are raised immediately.
+        """
+        bucket = self.bucket(service, region)
+        limit = self.concurrency(service, region)
+
+        for attempt in range(self.max_attempts):
+            bucket.acquire()
+            limit.acquire()
+            try:
+                result = operation(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                if throttled:
+                    limit.on_throttle()
+                self.count_call(service, 'Throttled' if throttled else 'Error')
+                if not is_retryable_error(e) or attempt == self.max_attempts - 1:
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning('%s call in %s failed with %s, retrying in %.2fs (attempt %d of %d)',
+                                service, region, error_code(e) or e.__class__.__name__, delay,
+                                attempt + 1, self.max_attempts)
+            else:
+                limit.on_success()
+                self.count_call(service, 'Success')
+                return result
+            finally:
+                limit.release()
+            self._sleep(delay)
+
+
+# Shared by every call in the container, so limits hold across threads and warm invocations
+RATE_CONTROLLER = RateController()
+
+
+def call_with_retry(service, region, operation, *args, **kwargs):
+    """
+    Call an AWS operation through the container-wide RATE_CONTROLLER.
+
+    Example:
+        call_with_retry('config', 'us-east-1', configservice.describe_configuration_recorders)
+    """
+    return RATE_CONTROLLER.call(service, region, operation, *args, **kwargs)
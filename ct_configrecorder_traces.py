@@ -0,0 +1,239 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+"""
+Critical paths and tail latencies of traces, from the span records of both Lambda functions.
+
+A trace starts with the Control Tower event or CloudFormation request the Producer Lambda
+received, and ends when the last of its account/regions is applied by the Consumer Lambda.
+For each trace, the critical path is the account/region applied last, split into:
+
+    enqueue      from the start of the trace until SQS accepted the message
+    retry        the same, for a message the Consumer Lambda sent again after a failure
+    queue_wait   from SQS accepting the message until the Consumer Lambda received it
+    assume_role  assuming AWSControlTowerExecution in the account
+    describe     describe_configuration_recorders calls
+    put          put_configuration_recorder call
+    other        the rest, such as waiting for a thread of the Consumer Lambda
+
+Span records are the log lines with a "Span" field; anything before the JSON object on a
+line, such as the timestamp of `aws logs tail`, is ignored:
+
+    aws logs tail /aws/lambda/<ProducerLambda> --since 3h --format short --filter-pattern '{ $.Span = * }' > spans.log
+    aws logs tail /aws/lambda/<ConsumerLambda> --since 3h --format short --filter-pattern '{ $.Span = * }' >> spans.log
+    python ct_configrecorder_traces.py spans.log
+"""
+
+import argparse
+import fileinput
+import json
+import sys
+from collections import Counter
+
+STAGES = ('enqueue', 'retry', 'queue_wait', 'assume_role', 'describe', 'put', 'other')
+PERCENTILES = (50, 95, 99)
+
+
+def read_spans(lines):
+    """
+    Yield the span records found in log lines.
+    """
+    for line in lines:
+        start = line.find('{')
+        if start < 0:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        if isinstance(record, dict) and record.get('Span') and record.get('TraceId'):
+            yield record
+
+
+def group_traces(spans):
+    """
+    Return the spans per trace ID.
+    """
+    traces = {}
+    for span in spans:
+        traces.setdefault(span['TraceId'], []).append(span)
+    return traces
+
+
+def percentile(values, percent):
+    """
+    Return the nearest-rank percentile of values, or 0.0 for no values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def distribution(values):
+    """
+    Return the count, percentiles and maximum of durations in milliseconds.
+    """
+    result = {'count': len(values)}
+    result.update((f'p{percent}', round(percentile(values, percent), 1)) for percent in PERCENTILES)
+    result['max'] = round(max(values), 1) if values else 0.0
+    return result
+
+
+def analyze_trace(trace_id, spans):
+    """
+    Rebuild the critical path of one trace and the time to apply of each of its account/regions.
+
+    Returns:
+        dict: 'TraceId', 'Start' (epoch milliseconds), 'DurationMs', 'ProducerInvocations', 'Messages',
+              'AccountRegions', 'TimeToApplyMs' per account/region, and the 'CriticalPath' with its
+              'Stages' in milliseconds and its 'Bottleneck', or None when no account/region was applied
+    """
+    producer_spans = [span for span in spans if span.get('Function') == 'Producer']
+    start = min(span['Start'] for span in (producer_spans or spans))
+
+    waits = {}
+    assume_roles = {}
+    paths = {}
+    for span in spans:
+        message_id = span.get('MessageId')
+        if span['Span'] == 'queue_wait':
+            waits[message_id] = span
+        elif span['Span'] == 'assume_role' and message_id:
+            assume_roles.setdefault(message_id, []).append(span)
+        elif span['Span'] in ('describe', 'put') and message_id:
+            paths.setdefault((message_id, span.get('Account'), span.get('Region')), []).append(span)
+
+    path_ends = {key: max(span['End'] for span in path) for key, path in paths.items()}
+    end = max([span['End'] for span in spans])
+    result = {
+        'TraceId': trace_id,
+        'Start': start,
+        'DurationMs': round(end - start, 1),
+        'ProducerInvocations': sum(1 for span in producer_spans if span['Span'] == 'invoke'),
+        'Messages': len(waits),
+        'AccountRegions': len({(account, region) for _, account, region in paths}),
+        'TimeToApplyMs': [round(path_end - start, 1) for path_end in path_ends.values()],
+        'CriticalPath': None,
+    }
+    if not paths:
+        return result
+
+    key = max(path_ends, key=path_ends.get)
+    message_id, account, region = key
+    stages = Counter()
+    wait = waits.get(message_id)
+    attempt = 1
+    if wait:
+        attempt = wait.get('Attempt', 1)
+        stages['enqueue' if attempt == 1 else 'retry'] += max(0.0, wait['Start'] - start)
+        stages['queue_wait'] += wait['DurationMs']
+    for span in assume_roles.get(message_id, []) + paths[key]:
+        stages[span['Span']] += span['DurationMs']
+    stages['other'] = max(0.0, path_ends[key] - start - sum(stages.values()))
+
+    result['CriticalPath'] = {
+        'Account': account,
+        'Region': region,
+        'MessageId': message_id,
+        'Attempt': attempt,
+        'DurationMs': round(path_ends[key] - start, 1),
+        'Stages': {stage: round(stages[stage], 1) for stage in STAGES if stages[stage]},
+        'Bottleneck': max(stages, key=stages.get),
+    }
+    return result
+
+
+def summarize(results, spans):
+    """
+    Return the tail latencies of every span name and of the time to apply over all traces,
+    and the share of each stage in the critical paths.
+    """
+    durations = {}
+    for span in spans:
+        durations.setdefault(span['Span'], []).append(span['DurationMs'])
+    critical_stages = Counter()
+    for result in results:
+        if result['CriticalPath']:
+            critical_stages.update(result['CriticalPath']['Stages'])
+    total = sum(critical_stages.values())
+    return {
+        'Traces': len(results),
+        'Spans': {name: distribution(values) for name, values in sorted(durations.items())},
+        'TimeToApplyMs': distribution([value for result in results for value in result['TimeToApplyMs']]),
+        'CriticalPathShare': {stage: round(critical_stages[stage] / total, 3)
+                              for stage in STAGES if critical_stages[stage]} if total else {},
+    }
+
+
+def format_distribution(values):
+    return (f'{values["count"]:>7}  p50 {values["p50"]:>9.1f}  p95 {values["p95"]:>9.1f}  '
+            f'p99 {values["p99"]:>9.1f}  max {values["max"]:>9.1f} ms')
+
+
+def format_report(results, summary):
+    lines = []
+    for result in results:
+        path = result['CriticalPath']
+        lines.append(f'trace {result["TraceId"]}: {result["DurationMs"]:.1f} ms, {result["ProducerInvocations"]} producer '
+                     f'invocation(s), {result["Messages"]} messages, {result["AccountRegions"]} account/regions')
+        if not path:
+            lines.append('  no account/region applied')
+            continue
+        lines.append(f'  critical path  {path["Account"]} {path["Region"]} (attempt {path["Attempt"]}), '
+                     f'{path["DurationMs"]:.1f} ms, bottleneck {path["Bottleneck"]}')
+        lines.append('  stages         ' + ', '.join(f'{stage} {value:.1f} ms' for stage, value in path['Stages'].items()))
+        if result['TimeToApplyMs']:
+            apply = distribution(result['TimeToApplyMs'])
+            lines.append(f'  time to apply  p50 {apply["p50"]:.1f} ms, p95 {apply["p95"]:.1f} ms, p99 {apply["p99"]:.1f} ms')
+    lines.append(f'{summary["Traces"]} traces')
+    for name, values in summary['Spans'].items():
+        lines.append(f'  {name:<14} {format_distribution(values)}')
+    lines.append(f'  {"time to apply":<14} {format_distribution(summary["TimeToApplyMs"])}')
+    if summary['CriticalPathShare']:
+        lines.append('  critical path  ' + ', '.join(f'{stage} {share:.0%}' for stage, share in summary['CriticalPathShare'].items()))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='Log files with span records (default: stdin)')
+    parser.add_argument('--trace', action='append', help='Only report this trace ID (repeatable)')
+    parser.add_argument('--json', action='store_true', help='Print one JSON line per trace and the summary')
+    args = parser.parse_args(argv)
+
+    with fileinput.input(args.files or ['-']) as lines:
+        spans = [span for span in read_spans(lines) if not args.trace or span['TraceId'] in args.trace]
+    traces = group_traces(spans)
+    results = sorted((analyze_trace(trace_id, trace_spans) for trace_id, trace_spans in traces.items()),
+                     key=lambda result: result['Start'])
+    summary = summarize(results, spans)
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result, sort_keys=True))
+        print(json.dumps({'Summary': summary}, sort_keys=True))
+    else:
+        print(format_report(results, summary))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
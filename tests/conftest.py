@@ -0,0 +1,77 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+"""
+Shared setup of the unit tests: the Lambda modules are imported against the in-process fakes of
+benchmarks/fakes.py, so the tests run offline without boto3.
+"""
+
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'benchmarks'))
+
+# The Lambda modules read their environment when they are imported
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('LOG_LEVEL', 'INFO')
+
+import fakes  # noqa: E402
+import pytest  # noqa: E402
+from fleet_simulator import LAMBDA_ENVIRONMENT, LAMBDA_MODULES, load_lambdas  # noqa: E402
+
+# Accounts of the fake organization, spread over Root/Sandbox, Root/Workloads/Prod and Root/Workloads/Dev
+FAKE_AWS = fakes.FakeAWS(accounts=9, regions=2)
+fakes.install(FAKE_AWS)
+
+
+@pytest.fixture
+def aws():
+    return FAKE_AWS
+
+
+@pytest.fixture
+def landing_zone():
+    """
+    A fake landing zone of its own for one test, like FAKE_AWS: 9 accounts in 2 regions.
+    """
+    aws = fakes.FakeAWS(accounts=9, regions=2)
+    fakes.install(aws)
+    yield aws
+    fakes.install(FAKE_AWS)
+
+
+@pytest.fixture
+def lambdas(landing_zone, tmp_path, monkeypatch):
+    """
+    The Lambda modules imported again against landing_zone, with the environment template.yaml
+    gives them and a SQLite state store, returned by name. The modules the other tests imported
+    are put back afterwards, so no warm state leaks from one test to another.
+    """
+    for name, value in LAMBDA_ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setenv('STATE_STORE_PATH', str(tmp_path / 'state.db'))
+    imported = {name: sys.modules.pop(name) for name in LAMBDA_MODULES if name in sys.modules}
+    try:
+        yield load_lambdas()
+    finally:
+        for name in LAMBDA_MODULES:
+            sys.modules.pop(name, None)
+        sys.modules.update(imported)
@@ -0,0 +1,66 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+import json
+import logging
+
+from ct_configrecorder_catalog import ResourceTypeCatalog, load_catalog
+from ct_configrecorder_profiles import compile_profiles, validate_resource_types
+from ct_configrecorder_recorder import DEFAULT_PROFILE, supported_profile
+
+CATALOG = ResourceTypeCatalog(
+    ['AWS::S3::Bucket', 'AWS::EC2::Instance', 'AWS::IAM::Role', 'AWS::IAM::User'],
+    {'il-central-1': ['AWS::IAM::Role', 'AWS::IAM::User']}, source='test catalog')
+
+
+def test_unknown_resource_types_are_reported_with_their_list(tmp_path):
+    path = tmp_path / 'profiles.json'
+    path.write_text(json.dumps({'Profiles': {'prod': {
+        'Strategy': 'INCLUSION', 'IncludedResourceTypes': ['AWS::S3::Bucket', 'AWS::S3::Buckets', 'AWS::IAM::Role']}}}))
+
+    errors, warnings = validate_resource_types(compile_profiles(str(path), resolve_assignments=False), load_catalog())
+
+    assert errors == ['IncludedResourceTypes of recorder profile prod: AWS::S3::Buckets']
+    assert [warning for warning in warnings if warning.startswith('AWS::IAM::Role of IncludedResourceTypes of recorder profile prod')]
+
+
+def test_inclusion_lists_leave_out_the_types_a_region_does_not_record(caplog):
+    caplog.set_level(logging.WARNING)
+    profile = DEFAULT_PROFILE._replace(
+        name='inclusion-catalog', strategy='INCLUSION', included_resource_types=('AWS::S3::Bucket', 'AWS::IAM::Role'),
+        daily_resource_types=('AWS::IAM::User',))
+
+    supported = supported_profile(profile, 'il-central-1', CATALOG)
+
+    assert supported.included_resource_types == ('AWS::S3::Bucket',)
+    assert supported.daily_resource_types == ('AWS::IAM::User',)
+    assert supported_profile(profile, 'us-east-2', CATALOG) is profile
+    assert 'Leaving resource types out' in caplog.text and 'AWS::IAM::Role' in caplog.text
+    assert 'Keeping resource types' in caplog.text and 'AWS::IAM::User' in caplog.text
+
+
+def test_exclusion_and_daily_lists_keep_the_types_the_catalog_leaves_out(caplog):
+    caplog.set_level(logging.WARNING)
+    profile = DEFAULT_PROFILE._replace(
+        name='exclusion-catalog', strategy='EXCLUSION', excluded_resource_types=('AWS::IAM::Role', 'AWS::EC2::Volume'),
+        daily_resource_types=('AWS::EC2::Instance',))
+
+    assert supported_profile(profile, 'il-central-1', CATALOG) is profile
+    assert 'Keeping resource types' in caplog.text and 'AWS::IAM::Role, AWS::EC2::Volume' in caplog.text
+    assert 'Leaving resource types out' not in caplog.text
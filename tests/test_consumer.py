@@ -0,0 +1,326 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import fakes
+import pytest
+from fleet_simulator import DEAD_LETTER_QUEUE_URL, PRIORITY_QUEUE_URL, QUEUE_URL, queue_arn
+
+ORIGINAL_PUT = fakes.FakeClient.put_configuration_recorder
+ORIGINAL_ASSUME_ROLE = fakes.FakeClient.assume_role
+
+
+@pytest.fixture
+def consumer(lambdas):
+    return lambdas['ct_configrecorder_override_consumer']
+
+
+@pytest.fixture
+def messages(lambdas):
+    return lambdas['ct_configrecorder_messages']
+
+
+def sqs_record(message_id, account, region, event='Update', queue_url=QUEUE_URL):
+    """
+    Return the SQS event record of a version 1 message, which the Consumer Lambda still reads.
+    """
+    return {'messageId': message_id, 'body': json.dumps({'Account': account, 'Region': region, 'Event': event}),
+            'eventSourceARN': queue_arn(queue_url)}
+
+
+def send_priority_message(aws, account, region):
+    sqs_client = fakes.FakeClient(aws, 'sqs', 'us-east-1', fakes.MANAGEMENT_ACCOUNT)
+    sqs_client.send_message(QueueUrl=PRIORITY_QUEUE_URL, MessageBody=json.dumps(
+        {'Account': account, 'Region': region, 'Event': 'controltower'}))
+
+
+def fail_puts(monkeypatch, code, account, region=None):
+    """
+    Make put_configuration_recorder fail with an error code in an account, or in one of its regions.
+    """
+    def put_configuration_recorder(self, ConfigurationRecorder, **kwargs):
+        if self.account == account and region in (None, self.region):
+            self.aws.api_call('config', 'PutConfigurationRecorder')
+            raise fakes.client_error(code, 'PutConfigurationRecorder', 'Injected failure')
+        return ORIGINAL_PUT(self, ConfigurationRecorder, **kwargs)
+
+    monkeypatch.setattr(fakes.FakeClient, 'put_configuration_recorder', put_configuration_recorder)
+
+
+def disable_retries(consumer, monkeypatch):
+    """
+    Remove the retry queue, dead-letter queue and failure ledger, so SQS must redeliver the failed records.
+    """
+    monkeypatch.setattr(consumer, 'SQS_URL', None)
+    monkeypatch.setattr(consumer, 'SQS_DEAD_LETTER_URL', None)
+    monkeypatch.setattr(consumer, 'get_state_store', lambda: None)
+
+
+def queued_messages(aws, messages, queue_url):
+    return [messages.decode_message(message['body']) for message in aws.queue(queue_url)]
+
+
+def test_every_record_of_a_batch_is_applied(landing_zone, consumer):
+    first, second = landing_zone.account_ids[:2]
+    records = [sqs_record('1', first, 'us-east-1'), sqs_record('2', first, 'us-west-2'),
+               sqs_record('3', second, 'us-east-1')]
+
+    response = consumer.lambda_handler({'Records': records}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': []}
+    assert set(landing_zone.recorders) == {(first, 'us-east-1'), (first, 'us-west-2'), (second, 'us-east-1')}
+    # The role of each account is assumed once for all of its regions
+    assert landing_zone.calls[('sts', 'AssumeRole')] == 2
+
+
+def test_only_the_failed_records_are_returned_to_the_queue(landing_zone, consumer, monkeypatch):
+    disable_retries(consumer, monkeypatch)
+    first, second = landing_zone.account_ids[:2]
+    fail_puts(monkeypatch, 'NoSuchConfigurationRecorderException', first, 'us-west-2')
+    records = [sqs_record('1', first, 'us-east-1'), sqs_record('2', first, 'us-west-2'),
+               sqs_record('3', second, 'us-west-2')]
+
+    response = consumer.lambda_handler({'Records': records}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': '2'}]}
+    assert set(landing_zone.recorders) == {(first, 'us-east-1'), (second, 'us-west-2')}
+
+
+def test_failures_are_counted_per_region_and_logged_with_their_account(landing_zone, consumer, monkeypatch, caplog):
+    disable_retries(consumer, monkeypatch)
+    account = landing_zone.account_ids[0]
+    fail_puts(monkeypatch, 'NoSuchConfigurationRecorderException', account)
+    metrics = io.StringIO()
+    monkeypatch.setattr(consumer, 'METRICS', consumer.MetricsLogger('Consumer', stream=metrics))
+    monkeypatch.setenv('LOG_LEVEL', 'INFO')
+
+    consumer.lambda_handler({'Records': [sqs_record('1', account, 'us-east-1')]}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    [failed] = [document for document in map(json.loads, metrics.getvalue().splitlines()) if 'FailedRecords' in document]
+    assert failed['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Function', 'Region']]
+    assert f'Record failed for Account and Region : {account} us-east-1' in caplog.text
+
+
+def test_records_of_an_account_whose_role_cannot_be_assumed_are_quarantined(lambdas, landing_zone, consumer, messages,
+                                                                            monkeypatch):
+    first, second = landing_zone.account_ids[:2]
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        if RoleArn.split(':')[4] == second:
+            self.aws.api_call('sts', 'AssumeRole')
+            raise fakes.client_error('AccessDenied', 'AssumeRole', 'Injected failure')
+        return ORIGINAL_ASSUME_ROLE(self, RoleArn, RoleSessionName, **kwargs)
+
+    monkeypatch.setattr(fakes.FakeClient, 'assume_role', assume_role)
+    records = [sqs_record('1', first, 'us-east-1'), sqs_record('2', second, 'us-east-1'),
+               sqs_record('3', second, 'us-west-2')]
+
+    response = consumer.lambda_handler({'Records': records}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': []}
+    assert set(landing_zone.recorders) == {(first, 'us-east-1')}
+    # AccessDenied is permanent, so the records are not retried
+    assert not landing_zone.queue(QUEUE_URL)
+    assert sorted((message['Account'], entry['Region']) for message in queued_messages(
+        landing_zone, messages, DEAD_LETTER_QUEUE_URL) for entry in message['Regions']) == [
+        (second, 'us-east-1'), (second, 'us-west-2')]
+    failures = lambdas['ct_configrecorder_state'].get_state_store().list_failures()
+    assert sorted((failure['Account'], failure['Region']) for failure in failures) == [
+        (second, 'us-east-1'), (second, 'us-west-2')]
+
+
+def test_failed_regions_are_retried_with_the_next_attempt(landing_zone, consumer, messages, monkeypatch):
+    account = landing_zone.account_ids[0]
+    fail_puts(monkeypatch, 'NoSuchConfigurationRecorderException', account, 'us-west-2')
+    record = {'messageId': '1', 'body': messages.encode_message(
+        messages.build_message(account, 'Update', ['us-east-1', 'us-west-2']))}
+
+    response = consumer.lambda_handler({'Records': [record]}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': []}
+    # Only the failed region of the message is sent again
+    [retry] = queued_messages(landing_zone, messages, QUEUE_URL)
+    assert (retry['Account'], retry['Attempt']) == (account, 2)
+    assert [entry['Region'] for entry in retry['Regions']] == ['us-west-2']
+    assert set(landing_zone.recorders) == {(account, 'us-east-1')}
+
+
+def test_records_out_of_attempts_are_quarantined(lambdas, landing_zone, consumer, messages, monkeypatch):
+    account = landing_zone.account_ids[0]
+    fail_puts(monkeypatch, 'NoSuchConfigurationRecorderException', account)
+    record = sqs_record('1', account, 'us-east-1')
+    record['body'] = json.dumps(dict(json.loads(record['body']), Attempt=consumer.RETRY_MAX_ATTEMPTS))
+
+    response = consumer.lambda_handler({'Records': [record]}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': []}
+    assert not landing_zone.queue(QUEUE_URL)
+    [dead_letter] = queued_messages(landing_zone, messages, DEAD_LETTER_QUEUE_URL)
+    assert dead_letter['Attempt'] == consumer.RETRY_MAX_ATTEMPTS
+    assert [entry['ErrorCode'] for entry in dead_letter['Regions']] == ['NoSuchConfigurationRecorderException']
+    [failure] = lambdas['ct_configrecorder_state'].get_state_store().list_failures()
+    assert (failure['Account'], failure['Region'], failure['Attempts']) == (
+        account, 'us-east-1', consumer.RETRY_MAX_ATTEMPTS)
+
+
+def test_applying_a_region_deletes_its_failure_ledger_entry(lambdas, landing_zone, consumer):
+    account = landing_zone.account_ids[0]
+    state_store = lambdas['ct_configrecorder_state'].get_state_store()
+    for region in landing_zone.regions:
+        state_store.put_failure(account, region, 'Update', None, 'AccessDeniedException', 'Denied', 1)
+
+    consumer.lambda_handler({'Records': [sqs_record('1', account, landing_zone.regions[0])]},
+                            fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert [(failure['Account'], failure['Region']) for failure in state_store.list_failures()] == [
+        (account, landing_zone.regions[1])]
+
+def test_concurrent_regions_of_an_account_assume_its_role_once(landing_zone, consumer, monkeypatch):
+    account = landing_zone.account_ids[0]
+    # Every thread asks for the credentials while the first AssumeRole is in flight
+    monkeypatch.setattr(landing_zone, 'latency', {'sts': 0.05})
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        credentials = list(executor.map(lambda _: consumer.get_credentials(account), range(16)))
+
+    assert all(item is credentials[0] for item in credentials)
+    assert landing_zone.calls[('sts', 'AssumeRole')] == 1
+
+def test_only_sampled_traces_and_traces_with_a_failure_are_written(landing_zone, consumer, messages, monkeypatch):
+    spans = io.StringIO()
+    monkeypatch.setattr(consumer.TRACER, 'stream', spans)
+    monkeypatch.setattr(consumer.TRACER, 'sample_rate', 0)
+    failing, applied = landing_zone.account_ids[:2]
+    fail_puts(monkeypatch, 'NoSuchConfigurationRecorderException', failing)
+    records = [{'messageId': account, 'body': messages.encode_message(
+        messages.build_message(account, 'Update', ['us-east-1'], trace_id=f'trace-{account}'))}
+        for account in (failing, applied)]
+
+    consumer.lambda_handler({'Records': records}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert {json.loads(line)['TraceId'] for line in spans.getvalue().splitlines()} == {f'trace-{failing}'}
+
+def test_malformed_messages_are_dropped(landing_zone, consumer):
+    account = landing_zone.account_ids[0]
+    records = [{'messageId': '1', 'body': 'not json'}, sqs_record('2', account, 'us-east-1')]
+
+    response = consumer.lambda_handler({'Records': records}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': []}
+    assert set(landing_zone.recorders) == {(account, 'us-east-1')}
+
+
+def test_unexpected_errors_return_every_record_to_the_queue(landing_zone, consumer, monkeypatch):
+    monkeypatch.setattr(consumer, 'ThreadPoolExecutor', None)
+    records = [sqs_record(str(index), account, 'us-east-1')
+               for index, account in enumerate(landing_zone.account_ids[:2], 1)]
+
+    response = consumer.lambda_handler({'Records': records}, fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': '1'}, {'itemIdentifier': '2'}]}
+    assert landing_zone.recorders == {}
+
+
+
+def test_sweep_batches_drain_the_priority_lane_first(landing_zone, consumer):
+    new_account, swept = landing_zone.account_ids[:2]
+    send_priority_message(landing_zone, new_account, 'us-east-1')
+
+    response = consumer.lambda_handler({'Records': [sqs_record('1', swept, 'us-east-1')]},
+                                       fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': []}
+    assert not landing_zone.queue(PRIORITY_QUEUE_URL)
+    assert set(landing_zone.recorders) == {(new_account, 'us-east-1'), (swept, 'us-east-1')}
+
+
+def test_priority_lane_waits_when_the_sweep_batch_needs_the_time_left(landing_zone, consumer):
+    new_account = landing_zone.account_ids[0]
+    send_priority_message(landing_zone, new_account, 'us-east-1')
+    records = [sqs_record(f'{account}-{region}', account, region)
+               for account in landing_zone.account_ids[1:] for region in landing_zone.regions]
+    reserve_millis = consumer.sweep_reserve_millis(records)
+
+    # The reserve grows with the account/regions of the sweep batch
+    assert reserve_millis > consumer.sweep_reserve_millis(records[:1]) > consumer.PRIORITY_DRAIN_RESERVE_MILLIS
+    consumer.lambda_handler({'Records': records}, fakes.FakeContext(reserve_millis / 1000 - 1, 'ConsumerLambda'))
+
+    assert len(landing_zone.queue(PRIORITY_QUEUE_URL)) == 1
+    assert new_account not in {account for account, _ in landing_zone.recorders}
+
+
+def test_priority_lane_errors_do_not_fail_the_sweep_batch(landing_zone, consumer, monkeypatch):
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        raise fakes.client_error('AccessDenied', 'ReceiveMessage', 'Injected failure')
+
+    monkeypatch.setattr(fakes.FakeClient, 'receive_message', receive_message)
+    swept = landing_zone.account_ids[0]
+
+    response = consumer.lambda_handler({'Records': [sqs_record('1', swept, 'us-east-1')]},
+                                       fakes.FakeContext(180, 'ConsumerLambda'))
+
+    assert response == {'batchItemFailures': []}
+    assert set(landing_zone.recorders) == {(swept, 'us-east-1')}
+
+ROLE_ARN = 'arn:aws:iam::111111111111:role/aws-service-role/config.amazonaws.com/AWSServiceRoleForConfig'
+CONTROL_TOWER_RECORDER = {
+    'name': 'aws-controltower-BaselineConfigRecorder',
+    'roleARN': ROLE_ARN,
+    'recordingGroup': {'allSupported': True, 'includeGlobalResourceTypes': False},
+}
+
+
+class RecordingConfigService:
+    """
+    configservice client stub with one configuration recorder, recording the recorders written.
+    """
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.written = []
+
+    def describe_configuration_recorders(self):
+        return {'ConfigurationRecorders': [self.recorder]}
+
+    def put_configuration_recorder(self, ConfigurationRecorder):
+        self.written.append(ConfigurationRecorder)
+        self.recorder = ConfigurationRecorder
+        return {}
+
+
+def test_matching_recorders_are_not_written(consumer, monkeypatch):
+    configservice = RecordingConfigService(CONTROL_TOWER_RECORDER)
+    monkeypatch.setattr(consumer, 'get_config_client', lambda account_id, aws_region: configservice)
+    monkeypatch.setenv('CONTROL_TOWER_HOME_REGION', 'us-east-1')
+
+    assert consumer.update_config_recorder('111111111111', 'eu-west-1', 'Delete') == 'unchanged'
+    assert configservice.written == []
+
+
+def test_changed_recorders_are_written(consumer, monkeypatch):
+    configservice = RecordingConfigService(dict(CONTROL_TOWER_RECORDER, recordingGroup={
+        'allSupported': False, 'includeGlobalResourceTypes': False, 'resourceTypes': ['AWS::S3::Bucket']}))
+    monkeypatch.setattr(consumer, 'get_config_client', lambda account_id, aws_region: configservice)
+    monkeypatch.setenv('CONTROL_TOWER_HOME_REGION', 'us-east-1')
+
+    assert consumer.update_config_recorder('111111111111', 'eu-west-1', 'Delete') == 'reset'
+    assert configservice.written == [CONTROL_TOWER_RECORDER]
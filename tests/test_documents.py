@@ -0,0 +1,75 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+import pytest
+
+from ct_configrecorder_documents import DocumentCache, find_parent_unit
+
+
+def counting_compiler(compiled):
+    def compile_document(location):
+        compiled.append(location)
+        return len(compiled)
+    return compile_document
+
+
+def test_each_document_is_compiled_again_after_its_own_refresh_interval(monkeypatch):
+    monkeypatch.setenv('FAKE_DOCUMENT', 'first.json')
+    compiled = []
+    often = DocumentCache('often refreshed document', counting_compiler(compiled), (('FAKE_DOCUMENT', ''),), 0)
+    rarely = DocumentCache('rarely refreshed document', counting_compiler(compiled), (('FAKE_DOCUMENT', ''),), 900)
+
+    assert often.get() == 1
+    assert rarely.get() == 2
+    assert often.get() == 3
+    assert rarely.get() == 2
+
+    monkeypatch.setenv('FAKE_DOCUMENT', 'second.json')
+    assert rarely.get() == 4
+    assert compiled[-1] == 'second.json'
+
+
+def test_the_previous_compilation_is_kept_when_compiling_again_fails(monkeypatch):
+    monkeypatch.setenv('FAKE_DOCUMENT', 'document.json')
+    results = [{'Version': 1}, ValueError('not a JSON object')]
+
+    def compile_document(location):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    cache = DocumentCache('document', compile_document, (('FAKE_DOCUMENT', ''),), 0)
+
+    assert cache.get() == {'Version': 1}
+    assert cache.get() == {'Version': 1}
+
+    monkeypatch.setenv('FAKE_DOCUMENT', 'other.json')
+    results.append(ValueError('not a JSON object'))
+    with pytest.raises(ValueError):
+        cache.get()
+
+
+def test_the_parents_of_an_account_are_walked_up_to_the_first_selected_unit(aws):
+    account = sorted(account for account, parent_id in aws.account_parents.items() if parent_id == 'ou-fake-dev00000')[0]
+    calls = aws.calls[('organizations', 'ListParents')]
+
+    assert find_parent_unit(account, {'ou-fake-workload', 'r-fake'}) == 'ou-fake-workload'
+    assert aws.calls[('organizations', 'ListParents')] - calls == 2
+    assert find_parent_unit(account, {'ou-fake-sandbox0'}) is None
@@ -0,0 +1,79 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import json
+
+import pytest
+
+from ct_configrecorder_messages import (
+    MessageFormatError, build_message, decode_message, encode_message, encode_v1_messages, message_pairs, with_regions
+)
+
+OPERATION_ID = '11111111-2222-3333-4444-555555555555'
+
+
+def test_v2_message_round_trip():
+    message = build_message('123456789012', 'controltower', ['us-east-1', 'eu-west-1'],
+                            operations={'us-east-1': OPERATION_ID}, fingerprints={'eu-west-1': 'abc'},
+                            trace_id='trace-1')
+
+    decoded = decode_message(encode_message(message))
+
+    assert decoded == dict(message, Attempt=1)
+    assert decoded['Regions'] == [{'Region': 'us-east-1', 'Operation': OPERATION_ID},
+                                  {'Region': 'eu-west-1', 'Fingerprint': 'abc'}]
+    assert message_pairs(decoded) == [('123456789012', 'us-east-1'), ('123456789012', 'eu-west-1')]
+
+
+def test_v1_messages_decode_into_the_v2_shape():
+    message = build_message('123456789012', 'Update', ['us-east-1', 'eu-west-1'],
+                            operations={'eu-west-1': OPERATION_ID}, trace_id='trace-1')
+
+    decoded = [decode_message(body) for body in encode_v1_messages(message)]
+
+    assert decoded == [
+        {'Version': 1, 'Account': '123456789012', 'Event': 'Update', 'Regions': [{'Region': 'us-east-1'}],
+         'TraceId': 'trace-1', 'Attempt': 1},
+        {'Version': 1, 'Account': '123456789012', 'Event': 'Update',
+         'Regions': [{'Region': 'eu-west-1', 'Operation': OPERATION_ID}], 'TraceId': 'trace-1', 'Attempt': 1},
+    ]
+
+
+def test_retries_keep_the_optional_fields():
+    message = decode_message(encode_message(build_message('123456789012', 'Create', ['us-east-1', 'eu-west-1'],
+                                                          trace_id='trace-1')))
+
+    retry = decode_message(encode_message(with_regions(message, message['Regions'][1:], Attempt=2)))
+
+    assert retry['Regions'] == [{'Region': 'eu-west-1'}]
+    assert retry['Attempt'] == 2
+    assert retry['TraceId'] == 'trace-1'
+
+
+@pytest.mark.parametrize('body', [
+    'not json',
+    '["123456789012"]',
+    json.dumps({'Version': 3, 'Account': '123456789012', 'Event': 'Update', 'Regions': [{'Region': 'us-east-1'}]}),
+    json.dumps({'Version': 2, 'Account': '123456789012', 'Event': 'Update', 'Regions': []}),
+    json.dumps({'Account': '123456789012', 'Event': 'Update'}),
+])
+def test_invalid_messages_are_rejected(body):
+    with pytest.raises(MessageFormatError):
+        decode_message(body)
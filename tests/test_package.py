@@ -0,0 +1,57 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+import ast
+import io
+import os
+import zipfile
+
+import ct_configrecorder_package as package
+
+
+def local_imports(path):
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            yield from (alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            yield node.module
+
+
+def test_committed_zips_are_built_from_the_sources():
+    assert package.stale_packages() == []
+
+
+def test_packages_hold_every_module_their_functions_import():
+    for name, files in package.PACKAGES.items():
+        modules = {file[:-len('.py')] for file in files if file.endswith('.py')}
+        for file in files:
+            if file.endswith('.py'):
+                imported = {module for module in local_imports(os.path.join(package.ROOT, file))
+                            if os.path.exists(os.path.join(package.ROOT, module + '.py'))}
+                assert imported <= modules, (name, file, imported - modules)
+
+
+def test_packages_are_reproducible():
+    for files in package.PACKAGES.values():
+        built = package.build_package(files)
+        assert built == package.build_package(files)
+        with zipfile.ZipFile(io.BytesIO(built)) as archive:
+            assert archive.namelist() == files
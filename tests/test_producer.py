@@ -0,0 +1,170 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+import json
+
+import fakes
+import pytest
+from fleet_simulator import (PRIORITY_QUEUE_URL, QUEUE_URL, UPDATE_LANDING_ZONE_EVENT, create_managed_account_event,
+                             run_consumer, run_producer)
+
+
+@pytest.fixture
+def producer(lambdas, monkeypatch):
+    producer = lambdas['ct_configrecorder_override_producer']
+    # Pages of 4 stack instances, and every page leaves less than the reserve of the sweep
+    monkeypatch.setattr(fakes, 'STACK_INSTANCES_PAGE_SIZE', 4)
+    monkeypatch.setattr(producer, 'SWEEP_TIME_RESERVE_MILLIS', 10 ** 9)
+    return producer
+
+
+@pytest.fixture
+def messages(lambdas):
+    return lambdas['ct_configrecorder_messages']
+
+
+def drain(aws, queue_url, messages):
+    """
+    Remove the messages of a queue and return them decoded.
+    """
+    queue = aws.queue(queue_url)
+    drained = [messages.decode_message(message['body']) for message in queue]
+    queue.clear()
+    return drained
+
+
+def enqueued_pairs(drained, event='controltower'):
+    return sorted((message['Account'], entry['Region'])
+                  for message in drained if message['Event'] == event for entry in message['Regions'])
+
+
+def selected_pairs(aws):
+    return sorted((item['Account'], item['Region']) for item in aws.stack_instances)
+
+
+def apply_sweep(lambdas, aws):
+    """
+    Let the Consumer Lambda apply every message of the queue.
+    """
+    run_consumer(aws, lambdas['ct_configrecorder_override_consumer'], QUEUE_URL, 10, 1, 3)
+
+
+def test_sweeps_checkpoint_and_continue_in_a_new_invocation(landing_zone, producer, messages):
+    producer.lambda_handler(dict(UPDATE_LANDING_ZONE_EVENT, id='sweep'), fakes.FakeContext())
+
+    # The continuation does not grow with the number of accounts swept, and keeps the trace of the sweep
+    [continuation] = landing_zone.invocations
+    checkpoint = continuation['Continuation']
+    assert {key: value for key, value in checkpoint.items() if key != 'Carry'} == {
+        'Event': 'controltower', 'NextToken': '4', 'Enqueued': 1, 'Invocation': 2, 'TraceId': 'sweep'}
+    # The stack instances of the last account listed wait for the next page
+    assert [item['Account'] for item in checkpoint['Carry']] == [landing_zone.stack_instances[3]['Account']] * 2
+    landing_zone.invocations.clear()
+
+    invocations = run_producer(landing_zone, producer, continuation)
+
+    assert 1 + invocations == -(-len(landing_zone.stack_instances) // 4)
+    assert enqueued_pairs(drain(landing_zone, QUEUE_URL, messages)) == selected_pairs(landing_zone)
+
+
+def test_accounts_split_across_pages_are_sent_in_one_message(landing_zone, producer, messages, monkeypatch):
+    # Pages of 3 stack instances split the 2 regions of every other account
+    monkeypatch.setattr(fakes, 'STACK_INSTANCES_PAGE_SIZE', 3)
+
+    run_producer(landing_zone, producer, UPDATE_LANDING_ZONE_EVENT)
+
+    drained = drain(landing_zone, QUEUE_URL, messages)
+    assert len(drained) == len(landing_zone.account_ids)
+    assert all(len(message['Regions']) == len(landing_zone.regions) for message in drained)
+    assert enqueued_pairs(drained) == selected_pairs(landing_zone)
+
+def test_update_sweeps_reset_the_excluded_accounts_of_each_page(landing_zone, producer, messages, monkeypatch):
+    excluded = landing_zone.account_ids[3]
+    monkeypatch.setenv('EXCLUDED_ACCOUNTS', f"['{fakes.MANAGEMENT_ACCOUNT}', '{excluded}']")
+    responses = []
+    monkeypatch.setattr(producer.cfnresponse, 'send', lambda event, context, status, *args: responses.append(status))
+
+    run_producer(landing_zone, producer, {'LogicalResourceId': 'ProducerLambdaTrigger', 'RequestType': 'Update'})
+
+    assert responses == [producer.cfnresponse.SUCCESS]
+    drained = drain(landing_zone, QUEUE_URL, messages)
+    assert enqueued_pairs(drained, 'Delete') == sorted((excluded, region) for region in landing_zone.regions)
+    assert excluded not in {account for account, _ in enqueued_pairs(drained, 'Update')}
+
+
+def test_sweeps_that_cannot_continue_log_where_they_stopped(landing_zone, producer, monkeypatch, caplog):
+    def invoke(self, FunctionName, Payload, InvocationType='RequestResponse', **kwargs):
+        raise fakes.client_error('AccessDeniedException', 'Invoke', 'Injected failure')
+
+    monkeypatch.setattr(fakes.FakeClient, 'invoke', invoke)
+    monkeypatch.setenv('LOG_LEVEL', 'INFO')
+
+    producer.lambda_handler(UPDATE_LANDING_ZONE_EVENT, fakes.FakeContext())
+
+    assert 'controltower sweep stopped in invocation 1 after 1 accounts, the stack instances from NextToken 4' in caplog.text
+
+
+def test_incremental_sweeps_only_enqueue_out_of_date_account_regions(lambdas, landing_zone, producer, messages):
+    run_producer(landing_zone, producer, UPDATE_LANDING_ZONE_EVENT)
+    apply_sweep(lambdas, landing_zone)
+
+    run_producer(landing_zone, producer, UPDATE_LANDING_ZONE_EVENT)
+    assert drain(landing_zone, QUEUE_URL, messages) == []
+
+    # A redeployed Control Tower baseline resets the recorder of the stack instance
+    landing_zone.stack_instances[0] = dict(landing_zone.stack_instances[0], LastOperationId='redeployed')
+    run_producer(landing_zone, producer, UPDATE_LANDING_ZONE_EVENT)
+    assert enqueued_pairs(drain(landing_zone, QUEUE_URL, messages)) == [
+        (landing_zone.stack_instances[0]['Account'], landing_zone.stack_instances[0]['Region'])]
+
+
+def test_repeated_account_events_are_coalesced_until_applied(lambdas, landing_zone, producer, messages):
+    account = landing_zone.account_ids[0]
+
+    run_producer(landing_zone, producer, create_managed_account_event(account))
+    run_producer(landing_zone, producer, create_managed_account_event(account))
+    assert enqueued_pairs(drain(landing_zone, PRIORITY_QUEUE_URL, messages)) == [
+        (account, region) for region in sorted(landing_zone.regions)]
+
+    # The Consumer Lambda releases the pending markers of the account/regions it applied
+    consumer = lambdas['ct_configrecorder_override_consumer']
+    records = [{'messageId': 'applied', 'body': messages.encode_message(
+        messages.build_message(account, 'controltower', landing_zone.regions))}]
+    consumer.process_records(records, consumer.PRIORITY_LANE, consumer.Counter())
+    run_producer(landing_zone, producer, create_managed_account_event(account))
+    assert len(drain(landing_zone, PRIORITY_QUEUE_URL, messages)) == 1
+
+
+def test_redrive_enqueues_the_failure_ledger_of_selected_accounts(lambdas, landing_zone, producer, messages):
+    state_store = lambdas['ct_configrecorder_state'].get_state_store()
+    account, other = landing_zone.account_ids[:2]
+    for failed in (account, other, fakes.MANAGEMENT_ACCOUNT):
+        state_store.put_failure(failed, landing_zone.regions[0], 'Update', None, 'AccessDeniedException', 'Denied', 5)
+    # The Delete events of excluded accounts are re-driven too
+    state_store.put_failure(fakes.MANAGEMENT_ACCOUNT, landing_zone.regions[1], 'Delete', None, 'AccessDeniedException',
+                            'Denied', 5)
+
+    producer.lambda_handler({'Redrive': {'Accounts': [account, fakes.MANAGEMENT_ACCOUNT]}}, fakes.FakeContext())
+
+    drained = drain(landing_zone, PRIORITY_QUEUE_URL, messages)
+    assert sorted((message['Account'], message['Event']) for message in drained) == [
+        (fakes.MANAGEMENT_ACCOUNT, 'Delete'), (account, 'Update')]
+    # Entries sent are removed; the ones filtered out or of excluded accounts are kept
+    assert sorted((failure['Account'], failure['Event']) for failure in state_store.list_failures()) == [
+        (fakes.MANAGEMENT_ACCOUNT, 'Update'), (other, 'Update')]
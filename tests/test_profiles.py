@@ -0,0 +1,108 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import json
+
+import pytest
+
+from ct_configrecorder_profiles import UnknownProfileError, compile_profiles
+from ct_configrecorder_recorder import DEFAULT_PROFILE, DEFAULT_PROFILE_ID, build_recorder_config
+
+DOCUMENT = {
+    'Profiles': {
+        'sandbox': {
+            'ExcludedResourceTypes': ['AWS::EC2::NetworkInterface', 'AWS::EC2::Volume'],
+            'DailyResourceTypes': ['AWS::EC2::Instance'],
+            'RecordingFrequency': 'DAILY',
+            'OrganizationalUnits': ['Root/Sandbox'],
+        },
+        'prod': {
+            'Strategy': 'INCLUSION',
+            'IncludedResourceTypes': ['AWS::S3::Bucket', ' AWS::S3::Bucket '],
+            'Accounts': ['100000000000'],
+            'OrganizationalUnits': ['ou-fake-prod0000'],
+        },
+    }
+}
+
+
+def write_document(tmp_path, document):
+    path = tmp_path / 'profiles.json'
+    path.write_text(json.dumps(document))
+    return str(path)
+
+
+def test_profiles_are_assigned_by_account_id_then_organizational_unit(aws, tmp_path):
+    profiles = compile_profiles(write_document(tmp_path, DOCUMENT))
+
+    for account, parent_id in aws.account_parents.items():
+        expected = {'ou-fake-sandbox0': 'sandbox', 'ou-fake-prod0000': 'prod'}.get(parent_id, DEFAULT_PROFILE_ID)
+        if account == '100000000000':
+            # Listed by ID in prod, although it is in Root/Sandbox
+            expected = 'prod'
+        assert profiles.profile_id(account) == expected, account
+    assert profiles.profile('100000000000') is profiles.get('prod')
+
+
+def test_omitted_settings_are_the_ones_of_the_default_profile(tmp_path):
+    profiles = compile_profiles(write_document(tmp_path, DOCUMENT), resolve_assignments=False)
+
+    sandbox = profiles.get('sandbox')
+    assert sandbox == DEFAULT_PROFILE._replace(
+        name='sandbox', excluded_resource_types=('AWS::EC2::NetworkInterface', 'AWS::EC2::Volume'),
+        daily_resource_types=('AWS::EC2::Instance',), recording_frequency='DAILY')
+    assert profiles.get('prod').included_resource_types == ('AWS::S3::Bucket',)
+    assert profiles.get() is DEFAULT_PROFILE
+    assert profiles.profile_id('100000000000') == DEFAULT_PROFILE_ID
+
+
+def test_profile_settings_build_the_recorder_payload(tmp_path):
+    profiles = compile_profiles(write_document(tmp_path, DOCUMENT), resolve_assignments=False)
+
+    sandbox = build_recorder_config(profiles.get('sandbox'), False, 'Update')
+    prod = build_recorder_config(profiles.get('prod'), False, 'Update')
+
+    assert sandbox['recordingGroup']['exclusionByResourceTypes']['resourceTypes'] == (
+        'AWS::EC2::NetworkInterface', 'AWS::EC2::Volume')
+    assert sandbox['recordingMode']['recordingFrequency'] == 'DAILY'
+    assert sandbox['recordingMode']['recordingModeOverrides'][0]['resourceTypes'] == ('AWS::EC2::Instance',)
+    assert prod['recordingGroup']['resourceTypes'] == ('AWS::S3::Bucket',)
+    assert prod['recordingGroup']['recordingStrategy']['useOnly'] == 'INCLUSION_BY_RESOURCE_TYPES'
+
+
+def test_unknown_profiles_are_rejected(tmp_path):
+    profiles = compile_profiles(write_document(tmp_path, DOCUMENT), resolve_assignments=False)
+
+    with pytest.raises(UnknownProfileError):
+        profiles.get('staging')
+
+
+@pytest.mark.parametrize('profile_id, settings', [
+    ('default', {}),
+    ('no spaces', {}),
+    ('sandbox', {'Strategy': 'ALL'}),
+    ('sandbox', {'ExcludedResourceTypes': 'AWS::EC2::Volume'}),
+    ('sandbox', {'Accounts': [100000000000]}),
+])
+def test_invalid_profiles_are_rejected(tmp_path, profile_id, settings):
+    location = write_document(tmp_path, {'Profiles': {profile_id: settings}})
+
+    with pytest.raises(ValueError):
+        compile_profiles(location, resolve_assignments=False)
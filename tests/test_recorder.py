@@ -0,0 +1,114 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import pytest
+
+from ct_configrecorder_recorder import DEFAULT_PROFILE, build_recorder_config, recorder_matches, thaw
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/aws-controltower-ConfigRecorderRole'
+
+EXCLUSION_PROFILE = DEFAULT_PROFILE._replace(
+    name='exclusion', strategy='EXCLUSION', excluded_resource_types=('AWS::EC2::Volume', 'AWS::EC2::NetworkInterface'),
+    daily_resource_types=('AWS::EC2::Instance', 'AWS::EC2::Volume'), daily_global_resource_types=('AWS::IAM::Role',),
+    recording_frequency='CONTINUOUS')
+INCLUSION_PROFILE = EXCLUSION_PROFILE._replace(
+    name='inclusion', strategy='INCLUSION', excluded_resource_types=(), included_resource_types=('AWS::S3::Bucket',))
+
+
+def test_exclusion_profile_records_daily_resource_types_not_excluded():
+    config = build_recorder_config(EXCLUSION_PROFILE, False, 'Update')
+
+    assert thaw(config) == {
+        'recordingGroup': {
+            'allSupported': False,
+            'includeGlobalResourceTypes': False,
+            'exclusionByResourceTypes': {'resourceTypes': ['AWS::EC2::Volume', 'AWS::EC2::NetworkInterface']},
+            'recordingStrategy': {'useOnly': 'EXCLUSION_BY_RESOURCE_TYPES'},
+        },
+        'recordingMode': {
+            'recordingFrequency': 'CONTINUOUS',
+            'recordingModeOverrides': [
+                {'description': 'DAILY_OVERRIDE', 'resourceTypes': ['AWS::EC2::Instance'], 'recordingFrequency': 'DAILY'},
+            ],
+        },
+    }
+
+
+def test_global_resource_types_are_recorded_daily_in_the_home_region_only():
+    home = build_recorder_config(EXCLUSION_PROFILE, True, 'Update')
+    other = build_recorder_config(EXCLUSION_PROFILE, False, 'Update')
+
+    assert home['recordingMode']['recordingModeOverrides'][0]['resourceTypes'] == ('AWS::EC2::Instance', 'AWS::IAM::Role')
+    assert other['recordingMode']['recordingModeOverrides'][0]['resourceTypes'] == ('AWS::EC2::Instance',)
+
+
+def test_inclusion_profile_includes_the_daily_resource_types():
+    config = build_recorder_config(INCLUSION_PROFILE, False, 'Create')
+
+    assert config['recordingGroup']['resourceTypes'] == ('AWS::S3::Bucket', 'AWS::EC2::Instance', 'AWS::EC2::Volume')
+    assert config['recordingGroup']['recordingStrategy']['useOnly'] == 'INCLUSION_BY_RESOURCE_TYPES'
+
+
+def test_empty_exclusion_list_records_all_supported_resource_types():
+    config = build_recorder_config(EXCLUSION_PROFILE._replace(excluded_resource_types=()), False, 'Update')
+
+    assert thaw(config['recordingGroup']) == {'allSupported': True, 'includeGlobalResourceTypes': True}
+
+
+def test_delete_restores_the_control_tower_settings():
+    assert thaw(build_recorder_config(EXCLUSION_PROFILE, True, 'Delete')) == {
+        'recordingGroup': {'allSupported': True, 'includeGlobalResourceTypes': True}}
+
+
+def test_settings_are_memoized_and_read_only():
+    config = build_recorder_config(EXCLUSION_PROFILE, False, 'Update')
+
+    assert build_recorder_config(EXCLUSION_PROFILE, False, 'Update') is config
+    with pytest.raises(TypeError):
+        config['recordingGroup']['allSupported'] = True
+
+
+def test_recorder_matches_ignores_order_and_defaults():
+    desired = dict(thaw(build_recorder_config(EXCLUSION_PROFILE, False, 'Update')), roleARN=ROLE_ARN)
+    described = {
+        'name': 'aws-controltower-BaselineConfigRecorder',
+        'roleARN': ROLE_ARN,
+        'recordingGroup': {
+            'allSupported': False,
+            'exclusionByResourceTypes': {'resourceTypes': ['AWS::EC2::NetworkInterface', 'AWS::EC2::Volume']},
+            'recordingStrategy': {'useOnly': 'EXCLUSION_BY_RESOURCE_TYPES'},
+        },
+        'recordingMode': {
+            'recordingFrequency': 'CONTINUOUS',
+            'recordingModeOverrides': [
+                {'description': 'DAILY_OVERRIDE', 'resourceTypes': ['AWS::EC2::Instance'], 'recordingFrequency': 'DAILY'},
+            ],
+        },
+    }
+
+    assert recorder_matches(described, desired)
+
+
+def test_recorder_matches_detects_changed_settings():
+    desired = dict(thaw(build_recorder_config(EXCLUSION_PROFILE, False, 'Update')), roleARN=ROLE_ARN)
+    control_tower = {'roleARN': ROLE_ARN, 'recordingGroup': {'allSupported': True, 'includeGlobalResourceTypes': True}}
+
+    assert not recorder_matches(control_tower, desired)
+    assert not recorder_matches(dict(desired, roleARN=ROLE_ARN + '2'), desired)
@@ -0,0 +1,101 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import json
+
+import pytest
+
+from ct_configrecorder_selection import AccountSelector, compile_selector
+
+
+def write_document(tmp_path, document):
+    path = tmp_path / 'selection.json'
+    path.write_text(json.dumps(document))
+    return str(path)
+
+
+def accounts_in(aws, unit_id):
+    return {account for account, parent_id in aws.account_parents.items() if parent_id == unit_id}
+
+
+def test_exclusion_mode_skips_listed_and_matching_accounts():
+    selector = AccountSelector('EXCLUSION', ['111111111111'], ['2222*', '33333333333?'])
+
+    assert not selector.should_process('111111111111')
+    assert not selector.should_process('222200000000')
+    assert not selector.should_process('333333333339')
+    assert selector.should_process('333333333300')
+    assert selector.should_process('444444444444')
+    assert selector.is_excluded('222200000000')
+    assert selector.counts == {'included': 2, 'excluded': 3}
+
+
+def test_inclusion_mode_only_processes_selected_accounts():
+    selector = AccountSelector('INCLUSION', ['111111111111'], ['2222*'])
+
+    assert selector.should_process('111111111111')
+    assert selector.should_process('222200000000')
+    assert not selector.should_process('444444444444')
+    assert not selector.is_excluded('444444444444')
+
+
+def test_organizational_unit_paths_select_the_accounts_below_them(aws, tmp_path):
+    location = write_document(tmp_path, {'IncludedOrganizationalUnits': ['Root/Workloads']})
+
+    selector = compile_selector('INCLUSION', document_location=location)
+
+    workloads = accounts_in(aws, 'ou-fake-prod0000') | accounts_in(aws, 'ou-fake-dev00000')
+    assert selector.organizational_units == {'ou-fake-workload', 'ou-fake-prod0000', 'ou-fake-dev00000'}
+    assert selector.organizational_unit_accounts == workloads
+    assert {account for account in aws.account_ids if selector.should_process(account)} == workloads
+
+
+def test_organizational_unit_ids_and_wildcard_paths_are_combined_with_account_rules(aws, tmp_path):
+    location = write_document(tmp_path, {
+        'ExcludedAccounts': ['10000000000[0-1]'],
+        'ExcludedOrganizationalUnits': ['ou-fake-sandbox0', 'Root/*/Dev'],
+    })
+
+    selector = compile_selector('EXCLUSION', excluded_accounts="['999999999999']", document_location=location)
+
+    excluded = (accounts_in(aws, 'ou-fake-sandbox0') | accounts_in(aws, 'ou-fake-dev00000')
+                | {'100000000000', '100000000001', '999999999999'})
+    assert {account for account in aws.account_ids + ['999999999999'] if selector.is_excluded(account)} == excluded
+
+
+def test_accounts_moved_since_compiling_are_resolved_with_their_current_unit(aws):
+    account = sorted(accounts_in(aws, 'ou-fake-sandbox0'))[0]
+    selector = AccountSelector('INCLUSION', organizational_units=['ou-fake-workload', 'ou-fake-prod0000'])
+
+    assert not selector.resolve(account)
+
+    aws.account_parents[account] = 'ou-fake-prod0000'
+    try:
+        assert selector.resolve(account)
+        assert selector.should_process(account)
+    finally:
+        aws.account_parents[account] = 'ou-fake-sandbox0'
+
+
+def test_invalid_documents_are_rejected(tmp_path):
+    location = write_document(tmp_path, {'ExcludedAccounts': '111111111111'})
+
+    with pytest.raises(ValueError):
+        compile_selector('EXCLUSION', document_location=location)
@@ -0,0 +1,68 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+import pytest
+
+from ct_configrecorder_state import FAILURE_PREFIX, DynamoDBStateStore, SQLiteStateStore
+
+
+class RecordingDynamoDB:
+    """
+    DynamoDB client stub recording the batch_write_item requests, and leaving the first ones unprocessed.
+    """
+
+    def __init__(self, unprocessed_calls=0):
+        self.requests = []
+        self.unprocessed_calls = unprocessed_calls
+
+    def batch_write_item(self, RequestItems):
+        self.requests.append(RequestItems)
+        if len(self.requests) <= self.unprocessed_calls:
+            return {'UnprocessedItems': RequestItems}
+        return {'UnprocessedItems': {}}
+
+
+def test_sqlite_put_clears_the_failure_ledger_entry(tmp_path):
+    state_store = SQLiteStateStore(str(tmp_path / 'state.db'))
+    state_store.put_failure('111111111111', 'us-east-1', 'Update', None, 'AccessDeniedException', 'Denied', 1)
+    state_store.put_failure('111111111111', 'us-west-2', 'Update', None, 'AccessDeniedException', 'Denied', 1)
+
+    state_store.put('111111111111', 'us-east-1', 'fingerprint')
+
+    applied = state_store.get_many([('111111111111', 'us-east-1')])
+    assert applied[('111111111111', 'us-east-1')]['Fingerprint'] == 'fingerprint'
+    assert [failure['Region'] for failure in state_store.list_failures()] == ['us-west-2']
+
+
+def test_dynamodb_put_deletes_the_failure_ledger_entry_in_the_same_write():
+    client = RecordingDynamoDB()
+    DynamoDBStateStore('state', client).put('111111111111', 'us-east-1', 'fingerprint', 'operation')
+
+    [request] = client.requests
+    put, delete = request['state']
+    assert put['PutRequest']['Item']['Fingerprint'] == {'S': 'fingerprint'}
+    assert delete['DeleteRequest']['Key'] == {
+        'Account': {'S': '111111111111'}, 'Region': {'S': FAILURE_PREFIX + 'us-east-1'}}
+
+
+def test_dynamodb_put_raises_when_the_write_stays_unprocessed():
+    client = RecordingDynamoDB(unprocessed_calls=100)
+
+    with pytest.raises(RuntimeError):
+        DynamoDBStateStore('state', client).put('111111111111', 'us-east-1', 'fingerprint')
@@ -0,0 +1,126 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify,merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#
+
+import botocore.exceptions
+import pytest
+
+from ct_configrecorder_throttling import RateController
+
+
+class VirtualClock:
+    """
+    Clock and sleep of a RateController that record the sleeps instead of waiting.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def client_error(code, operation_name):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operation_name)
+
+
+def flaky_operation(errors, result='ok'):
+    """
+    Return an operation raising the given error codes on its first calls, then returning result.
+    """
+    codes = list(errors)
+    calls = []
+
+    def operation():
+        calls.append(len(calls))
+        if codes:
+            raise client_error(codes.pop(0), 'PutConfigurationRecorder')
+        return result
+
+    operation.calls = calls
+    return operation
+
+
+def rate_controller(clock, **kwargs):
+    # The largest delay of each backoff, so the sleeps are predictable
+    return RateController(clock=clock.monotonic, sleep=clock.sleep, uniform=lambda low, high: high, **kwargs)
+
+
+def test_throttling_is_retried_with_backoff():
+    clock = VirtualClock()
+    controller = rate_controller(clock, base_delay=0.25)
+    operation = flaky_operation(['ThrottlingException', 'ThrottlingException'])
+
+    assert controller.call('config', 'us-east-1', operation) == 'ok'
+    assert len(operation.calls) == 3
+    assert clock.sleeps == [0.25, 0.5]
+    assert controller.drain_call_counts() == {('config', 'Throttled'): 2, ('config', 'Success'): 1}
+    assert controller.concurrency('config', 'us-east-1').limit == 1
+
+
+def test_transient_errors_are_retried():
+    clock = VirtualClock()
+    controller = rate_controller(clock)
+    operation = flaky_operation(['InternalFailure'])
+
+    assert controller.call('config', 'us-east-1', operation) == 'ok'
+    assert len(operation.calls) == 2
+    assert controller.drain_call_counts() == {('config', 'Error'): 1, ('config', 'Success'): 1}
+
+
+def test_permanent_errors_are_raised_without_retry():
+    clock = VirtualClock()
+    controller = rate_controller(clock)
+    operation = flaky_operation(['AccessDenied'])
+
+    with pytest.raises(botocore.exceptions.ClientError) as raised:
+        controller.call('sts', 'us-east-1', operation)
+    assert raised.value.response['Error']['Code'] == 'AccessDenied'
+    assert len(operation.calls) == 1
+    assert clock.sleeps == []
+
+
+def test_throttling_fails_after_max_attempts():
+    clock = VirtualClock()
+    controller = rate_controller(clock, max_attempts=3, base_delay=1.0, max_delay=1.5)
+    operation = flaky_operation(['ThrottlingException'] * 5)
+
+    with pytest.raises(botocore.exceptions.ClientError) as raised:
+        controller.call('config', 'us-east-1', operation)
+    assert raised.value.response['Error']['Code'] == 'ThrottlingException'
+    assert len(operation.calls) == 3
+    assert clock.sleeps == [1.0, 1.5]
+
+
+def test_token_bucket_limits_the_rate_per_service_and_region():
+    clock = VirtualClock()
+    controller = rate_controller(clock, rates={'config': 2.0})
+
+    for _ in range(6):
+        controller.call('config', 'us-east-1', lambda: None)
+    # The first two calls use the burst capacity, the next four wait for a token each
+    assert clock.now == pytest.approx(2.0)
+
+    controller.call('config', 'eu-west-1', lambda: None)
+    assert clock.now == pytest.approx(2.0)